@@ -0,0 +1,105 @@
+import numpy as np
+from collections import OrderedDict
+import hashlib
+import pickle
+import os
+import inputcache
+
+class ClimaProfile():
+    "A P-T-z-mixing ratio profile computed by `AdiabatClimate.make_profile_bg_gas`."
+
+    def __init__(self, c):
+        self.species_names = list(c.species_names)
+        self.P = c.P.copy() # dynes/cm^2
+        self.T = c.T.copy() # K
+        self.z = c.z.copy() # cm
+        self.f_i = c.f_i.copy() # (nz, nsp)
+        self.P_trop = c.P_trop
+        self.P_surf = c.P_surf
+        self.T_surf = c.T_surf
+
+class ClimaProfileCache():
+    """Memoizes `AdiabatClimate.make_profile_bg_gas`. Profiles are keyed on
+    the contents of the climate input files and on every input that changes
+    the profile when the tropopause temperature is fixed: T_surf, P_i, P_surf,
+    bg_gas, c.T_trop, c.P_top and c.RH. Radiative settings (e.g.
+    c.rad.surface_albedo, the instellation) do not change such a profile, so a
+    profile is reused across them. If c.solve_for_T_trop is True, T_trop
+    depends on the radiative transfer, and profiles are computed without the
+    cache. At most `maxsize` profiles are kept in memory (least recently used
+    are dropped). If `cache_dir` is given, profiles are also saved there.
+    """
+
+    def __init__(self, species_file, settings_file, star_file, maxsize=128, cache_dir=None):
+        h = hashlib.sha256()
+        for filename in [species_file, settings_file, star_file]:
+            h.update(inputcache.file_hash(filename).encode())
+        self.files_hash = h.hexdigest()
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.profiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, c, T_surf, P_i, P_surf, bg_gas):
+        h = hashlib.sha256()
+        h.update(self.files_hash.encode())
+        h.update(bg_gas.encode())
+        h.update(np.array([T_surf, P_surf, c.T_trop, c.P_top],dtype=np.float64).tobytes())
+        h.update(np.array(P_i,dtype=np.float64).tobytes())
+        h.update(np.array(c.RH,dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        if key in self.profiles:
+            self.profiles.move_to_end(key)
+            return self.profiles[key]
+        if self.cache_dir is not None:
+            filename = os.path.join(self.cache_dir, key+'.pkl')
+            if os.path.isfile(filename):
+                with open(filename,'rb') as f:
+                    prof = pickle.load(f)
+                self.put(key, prof, save=False)
+                return prof
+        return None
+
+    def put(self, key, prof, save=True):
+        self.profiles[key] = prof
+        self.profiles.move_to_end(key)
+        while len(self.profiles) > self.maxsize:
+            self.profiles.popitem(last=False)
+        if save and self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            filename = os.path.join(self.cache_dir, key+'.pkl')
+            with open(filename+'.tmp','wb') as f:
+                pickle.dump(prof, f)
+            os.replace(filename+'.tmp', filename)
+
+    def make_profile_bg_gas(self, c, T_surf, P_i, P_surf, bg_gas):
+        """Returns a ClimaProfile. `c` is only used to compute the profile
+        if it is not in the cache, so it should not be relied on for the
+        profile afterward.
+        """
+        if c.solve_for_T_trop:
+            self.misses += 1
+            c.make_profile_bg_gas(T_surf, P_i, P_surf, bg_gas)
+            return ClimaProfile(c)
+
+        key = self.key(c, T_surf, P_i, P_surf, bg_gas)
+        prof = self.get(key)
+        if prof is not None:
+            self.hits += 1
+            return prof
+
+        self.misses += 1
+        c.make_profile_bg_gas(T_surf, P_i, P_surf, bg_gas)
+        prof = ClimaProfile(c)
+        self.put(key, prof)
+        return prof
+
+def make_profile_bg_gas(c, T_surf, P_i, P_surf, bg_gas, cache=None):
+    "Computes a clima profile, going through `cache` if one is given."
+    if cache is None:
+        c.make_profile_bg_gas(T_surf, P_i, P_surf, bg_gas)
+        return ClimaProfile(c)
+    return cache.make_profile_bg_gas(c, T_surf, P_i, P_surf, bg_gas)
@@ -0,0 +1,145 @@
+import numpy as np
+import itertools
+from scipy import constants as const
+from astropy import constants
+
+import planets
+
+def level_radii(P, T, mmw, p_reference=1.0):
+    """Radius (cm) of each level from hydrostatic balance, with the planet
+    radius at `p_reference` (bar). P (bar) and T are on levels from the top
+    down, mmw (g/mol) on the layers between them.
+    """
+    radius = planets.k2_18b.radius*(constants.R_earth.value)*1e2
+    mass = planets.k2_18b.mass*(constants.M_earth.value)*1e3
+    grav = const.G*(mass/1e3)/(radius/1e2)**2*1e2 # cm/s^2
+    k_boltz = const.Boltzmann*1e7
+    T_layer = 0.5*(T[1:] + T[:-1])
+    dz = (k_boltz*T_layer*const.Avogadro)/(mmw*grav)*np.log(P[1:]/P[:-1])
+    z = np.append(np.cumsum(dz[::-1])[::-1], 0.0) # altitude above the bottom
+    z_ref = np.interp(np.log(p_reference), np.log(P), z)
+    return radius + z - z_ref
+
+def slant_path_matrix(r):
+    """G[i,j] is the path length (cm) through layer j of a ray whose impact
+    parameter is level radius r[i]. r decreases from the top down.
+    """
+    nlevel = r.shape[0]
+    G = np.zeros((nlevel, nlevel-1))
+    for i in range(1, nlevel):
+        b = r[i]
+        for j in range(i):
+            G[i,j] = 2.0*(np.sqrt(r[j]**2 - b**2) - np.sqrt(max(r[j+1]**2 - b**2, 0.0)))
+    return G
+
+def transit_depth(dtau, r, G, r_star):
+    """Transit depth for vertical layer optical depths `dtau`
+    (..., nlayer, nwno). Below the bottom level the planet is opaque.
+    """
+    dz = r[:-1] - r[1:]
+    k = dtau/dz[:,None] # extinction per cm
+    tau = G @ k # slant optical depth at each level
+    # integrate 2 b (1 - exp(-tau)) db from the bottom to the top level
+    f = 2.0*r[:,None]*(1.0 - np.exp(-tau))
+    area = np.sum(0.5*(f[...,1:,:] + f[...,:-1,:])*dz[:,None], axis=-2)
+    return (r[-1]**2 + area)/r_star**2
+
+def cloud_layer_optical_depth(P, p_top, dp, opd):
+    """Optical depth in each layer of a grey cloud with total optical depth `opd`
+    spread evenly in log pressure from `p_top` (bar) down `dp` (log10 bar).
+    """
+    lo = np.log10(P[:-1])
+    hi = np.log10(P[1:])
+    top = np.log10(p_top)
+    bottom = top + dp
+    overlap = np.clip(np.minimum(hi, bottom) - np.maximum(lo, top), 0.0, None)
+    return opd*overlap/dp
+
+class CloudSweep():
+    """Transmission spectra of one atmosphere for many cloud configurations.
+
+    picaso is run once, with the atmosphere (and haze clouds, if set) already
+    given to `case1`, to get the gas, Rayleigh and cloud layer optical depths
+    from its full output ('taugas', 'tauray', 'taucld', 'level' and 'layer').
+    Each configuration is then an additive change to the layer optical depths:
+    a grey cloud deck, and a scaling of the haze optical depth. Its spectrum
+    is picaso's spectrum plus the change in transit depth computed with the
+    same slant path geometry. Configurations are evaluated `chunk` at a time,
+    which bounds memory to about chunk*nlayer*nwno floats, so `opa` should be
+    resampled (e.g. `make_spectra.make_opannection(R=1000)`) for large sweeps.
+    """
+
+    def __init__(self, case1, opa, p_reference=1.0):
+        df = case1.spectrum(opa, full_output=True, calculation='transmission')
+        full = df['full_output']
+
+        def tau(key):
+            a = full.get(key)
+            if a is None:
+                return 0.0
+            a = np.asarray(a)
+            return a[:,:,0] if a.ndim == 3 else a
+
+        self.wno = np.asarray(df['wavenumber'])
+        self.rprs2 = np.asarray(df['transit_depth'])
+        self.P = np.asarray(full['level']['pressure'])
+        T = np.asarray(full['level']['temperature'])
+        mmw = np.asarray(full['layer']['mmw'])
+        self.tau_clear = tau('taugas') + tau('tauray')
+        self.tau_haze = tau('taucld')*np.ones(self.tau_clear.shape)
+
+        self.r = level_radii(self.P, T, mmw, p_reference)
+        self.G = slant_path_matrix(self.r)
+        self.r_star = planets.k2_18.radius*constants.R_sun.value*1e2
+        self.rprs2_base = transit_depth(self.tau_clear + self.tau_haze, self.r, self.G, self.r_star)
+
+    def spectra(self, configs, chunk=16):
+        """Spectra for a list of configurations, each a dict with 'p_top' (bar),
+        'dp' (log10 bar), 'opd' (total grey cloud optical depth) and 'haze'
+        (multiplies the haze optical depth). Returns wavelength (microns) and
+        transit depths with shape (len(configs), nwv), ordered by wavelength.
+        """
+        rprs2 = np.empty((len(configs), self.wno.shape[0]))
+        for i0 in range(0, len(configs), chunk):
+            block = configs[i0:i0+chunk]
+            dtau = np.empty((len(block),) + self.tau_clear.shape)
+            for i,c in enumerate(block):
+                cloud = cloud_layer_optical_depth(self.P, c['p_top'], c['dp'], c['opd'])
+                dtau[i] = self.tau_clear + c['haze']*self.tau_haze + cloud[:,None]
+            rprs2[i0:i0+len(block)] = transit_depth(dtau, self.r, self.G, self.r_star)
+        rprs2 += self.rprs2 - self.rprs2_base
+        wv = 1e4/self.wno[::-1].copy()
+        return wv, rprs2[:,::-1].copy()
+
+def sweep_configs(p_tops, dps, opds, hazes):
+    "Every combination of the given cloud parameters."
+    configs = []
+    for p_top, dp, opd, haze in itertools.product(p_tops, dps, opds, hazes):
+        configs.append({'p_top': p_top, 'dp': dp, 'opd': opd, 'haze': haze})
+    return configs
+
+def main(R=1000):
+    import pickle
+    import pandas as pd
+    import make_spectra
+    import jwst_data
+
+    opa = make_spectra.make_opannection(wave_range=[0.8,5.3], R=R)
+    case1 = make_spectra.make_case(opa)
+    case1.atmosphere(df = pd.read_csv('results/neptune/nominal_S_picaso.pt', delim_whitespace=True))
+    case1.clouds(df = pd.read_csv('results/neptune/nominal_S_clouds.txt', delim_whitespace=True))
+    sweep = CloudSweep(case1, opa)
+
+    configs = sweep_configs(np.logspace(-4,0,9), [0.5,1.0,2.0], [0.1,1.0,10.0], [0.0,1.0,10.0])
+    wv, rprs2 = sweep.spectra(configs)
+
+    data = jwst_data.load_data('lowres')
+    _, rchi2, sig = make_spectra.spectrum_statistics(wv, rprs2, data, [0.8,5.3])
+    out = {'configs': configs, 'wv': wv, 'rprs2': rprs2, 'rchi2': rchi2, 'sig': sig}
+    with open('results/spectra/cloud_sweep.pkl','wb') as f:
+        pickle.dump(out, f)
+    i = np.argmin(rchi2)
+    print('Best cloud configuration: '+str(configs[i])+', reduced chi^2 = %.2f'%rchi2[i])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+import numpy as np
+import pickle
+import os
+from itertools import combinations_with_replacement
+
+import utils
+import results_io
+
+# Model inputs, computed from `habitable.run_model` parameters
+FEATURES = [
+    ('log10_CH4_flux', lambda p: np.log10(1.0 + p['flux'].get('CH4',0.0))), # molecules/cm^2/s
+    ('log10_CO_vdep', lambda p: np.log10(1.0e-8 + p['vdep'].get('CO',0.0))), # cm/s
+    ('log10_CO2', lambda p: np.log10(p['mix']['CO2'])), # surface mixing ratio
+    ('log10_N2', lambda p: np.log10(p['mix']['N2'])), # surface mixing ratio
+    ('log10_Kzz', lambda p: np.log10(p['eddy'])), # cm^2/s
+    ('T_trop', lambda p: p['T_trop']) # K
+]
+
+LOG10MIX_MIN = -30.0 # mixing ratios below this are all treated the same
+
+def features(params_list):
+    "Emulator inputs for a list of `habitable.run_model` parameter dicts."
+    X = np.empty((len(params_list), len(FEATURES)))
+    for i,p in enumerate(params_list):
+        for j,(name, fcn) in enumerate(FEATURES):
+            X[i,j] = fcn(p)
+    return X
+
+def load_training_data(params_list, log10P=None, nz=100):
+    """Reads the `_result.npz` of every successful run in `params_list` and
+    puts temperature and log10 mixing ratios on a common log10 pressure grid.
+    Returns params, log10P, species and Y, where each row of Y is
+    [T, log10 mix of species[0], log10 mix of species[1], ...].
+    """
+    results = []
+    params_ok = []
+    for params in params_list:
+        filename = params['outfile']+'_result.npz'
+        if not os.path.isfile(filename):
+            continue
+        res = results_io.AtmosphereResult(filename)
+        if not res.success:
+            res.close()
+            continue
+        results.append(res)
+        params_ok.append(params)
+    if len(results) == 0:
+        raise Exception('No successful runs to train on.')
+
+    # Gases that all runs have in common
+    species = [sp for sp in results[0].species_names if 'aer' not in sp]
+    for res in results[1:]:
+        species = [sp for sp in species if sp in res.species_names]
+
+    # Pressure grid covered by every run
+    if log10P is None:
+        P_bottom = np.min([np.max(res.pressure) for res in results])
+        P_top = np.max([np.min(res.pressure) for res in results])
+        log10P = np.linspace(np.log10(P_bottom), np.log10(P_top), nz)
+
+    Y = np.empty((len(results), (len(species)+1)*log10P.shape[0]))
+    for i,res in enumerate(results):
+        x = np.log10(res.pressure)[::-1]
+        row = [np.interp(log10P, x, res.temperature[::-1])]
+        for sp in species:
+            tmp = np.log10(np.maximum(res.mix(sp), 10.0**LOG10MIX_MIN))[::-1]
+            row.append(np.interp(log10P, x, tmp))
+        Y[i,:] = np.concatenate(row)
+        res.close()
+
+    return params_ok, log10P, species, Y
+
+def polynomial_features(X, degree):
+    "All monomials of the columns of X up to `degree`, including a constant."
+    cols = [np.ones(X.shape[0])]
+    for d in range(1, degree+1):
+        for inds in combinations_with_replacement(range(X.shape[1]), d):
+            cols.append(np.prod(X[:,inds], axis=1))
+    return np.array(cols).T
+
+class PhotochemEmulator():
+    """Maps `habitable.run_model` parameters to steady-state temperature and
+    log10 mixing ratio profiles. The profiles are compressed with PCA and the
+    PCA coefficients are fit with ridge-regularized polynomial regression.
+    """
+
+    def __init__(self, degree=2, ridge=1.0e-6, variance=0.9999):
+        self.degree = degree
+        self.ridge = ridge
+        self.variance = variance # fraction of variance kept by the PCA
+
+        self.log10P = None
+        self.species = None
+        self.X_mean = None
+        self.X_std = None
+        self.Y_mean = None
+        self.Y_std = None
+        self.components = None
+        self.coeffs = None
+
+    def fit(self, X, Y):
+        self.X_mean = np.mean(X, axis=0)
+        self.X_std = np.std(X, axis=0)
+        self.X_std[self.X_std == 0.0] = 1.0
+        self.Y_mean = np.mean(Y, axis=0)
+        self.Y_std = np.std(Y, axis=0)
+        self.Y_std[self.Y_std == 0.0] = 1.0
+
+        # PCA
+        Yn = (Y - self.Y_mean)/self.Y_std
+        U, s, Vt = np.linalg.svd(Yn, full_matrices=False)
+        frac = np.cumsum(s**2)/np.maximum(np.sum(s**2), 1e-300)
+        ncomp = int(np.searchsorted(frac, self.variance)) + 1
+        ncomp = min(ncomp, Vt.shape[0])
+        self.components = Vt[:ncomp,:]
+        W = Yn @ self.components.T
+
+        # Ridge regression of the PCA weights
+        A = polynomial_features((X - self.X_mean)/self.X_std, self.degree)
+        reg = self.ridge*np.eye(A.shape[1])
+        reg[0,0] = 0.0 # don't penalize the constant
+        self.coeffs = np.linalg.solve(A.T @ A + reg, A.T @ W)
+
+    def predict(self, X):
+        "Predicts Y for every row of X (shape (n, len(FEATURES)))."
+        X = np.atleast_2d(X)
+        A = polynomial_features((X - self.X_mean)/self.X_std, self.degree)
+        return (A @ self.coeffs @ self.components)*self.Y_std + self.Y_mean
+
+    def predict_profiles(self, params_list):
+        """Predicts profiles for a list of parameter dicts. Returns temperature
+        (n, nz) and a dict of log10 mixing ratios (n, nz) for each species.
+        The mixing ratios are predicted independently, so at levels where they
+        sum to more than 1 they are scaled down to sum to 1.
+        """
+        Y = self.predict(features(params_list))
+        nz = self.log10P.shape[0]
+        T = Y[:,:nz]
+        log10mix = {}
+        for i,sp in enumerate(self.species):
+            log10mix[sp] = Y[:,(i+1)*nz:(i+2)*nz]
+
+        total = np.sum([10.0**log10mix[sp] for sp in self.species], axis=0)
+        log10scale = np.log10(np.maximum(total, 1.0))
+        if np.max(total) > 1.01:
+            print('Emulator: predicted mixing ratios sum to up to %.3f, renormalized'%np.max(total))
+        for sp in self.species:
+            log10mix[sp] = log10mix[sp] - log10scale
+        return T, log10mix
+
+    def picaso_atmosphere(self, params):
+        "picaso atmosphere DataFrame, in the `make_picaso_input_habitable` format, for one parameter dict."
+        T, log10mix = self.predict_profiles([params])
+        mix = {}
+        mix['press'] = 10.0**self.log10P
+        mix['temp'] = T[0]
+        for sp in self.species:
+            mix[sp] = 10.0**log10mix[sp][0]
+        return utils.picaso_atmosphere(mix, self.species)
+
+    def write_picaso_input(self, params, outfile):
+        "Writes outfile+'_picaso.pt' for one parameter dict."
+        df = self.picaso_atmosphere(params)
+        utils.write_picaso_table(df, outfile+'_picaso.pt', 25)
+        return df
+
+    def cross_validate(self, X, Y, nfolds=5, seed=0):
+        """k-fold cross validation. Returns RMS and maximum absolute errors of
+        temperature (K) and of each species' log10 mixing ratio (dex),
+        considering only levels where the true mixing ratio exceeds 1e-20.
+        """
+        rng = np.random.default_rng(seed)
+        folds = np.array_split(rng.permutation(X.shape[0]), nfolds)
+        Y_pred = np.empty(Y.shape)
+        for test in folds:
+            train = np.setdiff1d(np.arange(X.shape[0]), test)
+            em = PhotochemEmulator(self.degree, self.ridge, self.variance)
+            em.fit(X[train], Y[train])
+            Y_pred[test] = em.predict(X[test])
+
+        nz = self.log10P.shape[0]
+        report = {}
+        err = Y_pred[:,:nz] - Y[:,:nz]
+        report['T'] = {'rms': np.sqrt(np.mean(err**2)), 'max': np.max(np.abs(err))}
+        for i,sp in enumerate(self.species):
+            true = Y[:,(i+1)*nz:(i+2)*nz]
+            err = (Y_pred[:,(i+1)*nz:(i+2)*nz] - true)[true > -20.0]
+            if err.size == 0:
+                continue
+            report[sp] = {'rms': np.sqrt(np.mean(err**2)), 'max': np.max(np.abs(err))}
+        return report
+
+def train_emulator(params_list, degree=2, ridge=1.0e-6, variance=0.9999, nfolds=5):
+    "Fits an emulator to a grid of finished runs and cross validates it."
+    params_ok, log10P, species, Y = load_training_data(params_list)
+    X = features(params_ok)
+    em = PhotochemEmulator(degree, ridge, variance)
+    em.log10P = log10P
+    em.species = species
+    em.fit(X, Y)
+    report = None
+    if X.shape[0] >= nfolds:
+        report = em.cross_validate(X, Y, nfolds)
+    return em, report
+
+def print_report(report, n=15):
+    print('%-10s %10s %10s'%('','rms','max'))
+    print('%-10s %10.2f %10.2f'%('T (K)', report['T']['rms'], report['T']['max']))
+    species = sorted([a for a in report if a != 'T'], key=lambda a: -report[a]['rms'])
+    for sp in species[:n]:
+        print('%-10s %10.3f %10.3f'%(sp, report[sp]['rms'], report[sp]['max']))
+
+def save_emulator(em, filename):
+    with open(filename,'wb') as f:
+        pickle.dump(em, f)
+
+def load_emulator(filename):
+    with open(filename,'rb') as f:
+        em = pickle.load(f)
+    return em
+
+def grid_params(n, seed=0):
+    "Random grid of habitable models around `habitable.model2`."
+    import habitable
+    rng = np.random.default_rng(seed)
+    params_list = []
+    for i in range(n):
+        params = habitable.model2()
+        params['outfile'] = 'results/habitable/grid/model_%i'%i
+        params['flux'] = {'CH4': 10.0**rng.uniform(9.0,11.5)}
+        params['vdep'] = {'CO': 10.0**rng.uniform(-6.0,-3.0)}
+        params['mix'] = {'H2O': 200.0, 'CO2': 10.0**rng.uniform(-3.0,-1.0), 'N2': 10.0**rng.uniform(-3.0,-1.0)}
+        params['eddy'] = 10.0**rng.uniform(5.0,6.0)
+        params['T_trop'] = rng.uniform(200.0,230.0)
+        params_list.append(params)
+    return params_list
+
+def main():
+    import habitable
+    os.makedirs('results/habitable/grid/', exist_ok=True)
+    params_list = grid_params(200)
+    habitable.run_models(params_list, 4)
+
+    em, report = train_emulator(params_list)
+    print_report(report)
+    save_emulator(em, 'results/habitable/grid/emulator.pkl')
+    em.write_picaso_input(habitable.model2(), 'results/habitable/grid/model2_emulated')
+
+if __name__ == '__main__':
+    main()
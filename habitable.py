@@ -1,11 +1,17 @@
 import numpy as np
 from threadpoolctl import threadpool_limits
-from pathos.multiprocessing import ProcessingPool as Pool
 from photochemclima import PhotochemClima
 import pickle
 import utils
-
-def make_picaso_input_habitable(p, outfile):
+import results_io
+import sharedarrays
+from supervisor import SupervisedPool
+
+def make_picaso_input_habitable(p, outfile=None, rt_grid_tol=None):
+    """Returns the picaso atmosphere DataFrame, and writes outfile+'_picaso.pt' if `outfile` is given.
+    If `rt_grid_tol` is given (see `utils.default_rt_grid_tol`), the atmosphere is compacted to fewer layers
+    (see `utils.compact_picaso_input`).
+    """
     pc = p.pc
     mix = {}
     mix['press'] = pc.wrk.pressure
@@ -15,10 +21,14 @@ def make_picaso_input_habitable(p, outfile):
         tmp = pc.wrk.densities[ind,:]/pc.wrk.density
         mix[sp] = tmp
     species = pc.dat.species_names[pc.dat.np:-2]
-    utils.write_picaso_atmosphere(mix, outfile+'_picaso.pt', species)
-
-def run_model(outfile, T_surf, mix, flux, vdep, eddy, T_trop, relative_humidity,equilibrium_time,atol,atol_min,atol_max):
-
+    df = utils.picaso_atmosphere(mix, species)
+    if rt_grid_tol is not None:
+        df = utils.compact_picaso_input(df, rt_grid_tol, outfile)
+    if outfile is not None:
+        utils.write_picaso_table(df, outfile+'_picaso.pt', 25)
+    return df
+
+def make_PhotochemClima():
     p = PhotochemClima('input/zahnle_earth_new.yaml',
                    'input/habitable/settings_habitable_template.yaml',
                    'input/k2_18b_stellar_flux.txt',
@@ -26,24 +36,37 @@ def run_model(outfile, T_surf, mix, flux, vdep, eddy, T_trop, relative_humidity,
                    'input/habitable/species_climate.yaml',
                    'input/habitable/settings_climate_scale=0.7.yaml')
     p.pc.var.verbose = 1
-    p.pc.var.equilibrium_time=equilibrium_time
-    p.pc.var.atol=atol
-    p.atol_min = atol_min
-    p.atol_max = atol_max
-
-    # Other variables
-    p.constant_eddy = eddy
-    for sp in mix:
-        if sp == 'H2O' or sp == 'H2':
-            continue
-        else:
-            p.pc.set_lower_bc(sp,bc_type='mix',mix=mix[sp])
-    for sp in flux:
-        p.pc.set_lower_bc(sp,bc_type='flux',flux=flux[sp])
-    for sp in vdep:
-        p.pc.set_lower_bc(sp,bc_type='vdep',vdep=vdep[sp])
-    p.relative_humidity = relative_humidity
-    p.c.T_trop = T_trop
+    return p
+
+# PhotochemClima owned by the current (worker) process
+_p_worker = None
+
+def worker_PhotochemClima():
+    "Returns this process's PhotochemClima, building it on first use."
+    global _p_worker
+    if _p_worker is None:
+        _p_worker = make_PhotochemClima()
+        _p_worker.enable_clima_cache(cache_dir='input/cache/clima/')
+    return _p_worker
+
+def run_model(outfile, T_surf, mix, flux, vdep, eddy, T_trop, relative_humidity,equilibrium_time,atol,atol_min,atol_max,p=None,store=None,rt_grid_tol=None):
+
+    # Build a new model, or reuse one from a previous run
+    if p is None:
+        p = make_PhotochemClima()
+    params = {
+        'mix': mix,
+        'flux': flux,
+        'vdep': vdep,
+        'eddy': eddy,
+        'T_trop': T_trop,
+        'relative_humidity': relative_humidity,
+        'equilibrium_time': equilibrium_time,
+        'atol': atol,
+        'atol_min': atol_min,
+        'atol_max': atol_max
+    }
+    p.reset(params)
 
     # photochemical equilibrium
     res = p.find_equilibrium(T_surf, mix)
@@ -52,9 +75,17 @@ def run_model(outfile, T_surf, mix, flux, vdep, eddy, T_trop, relative_humidity,
     atmosphere_out_c = outfile+"_atmosphere.pkl"
     with open(atmosphere_out_c,'wb') as f:
         pickle.dump(res,f)
+    results_io.write_photochem_result(outfile+'_result.npz', p.pc, res[0])
+    if store is not None:
+        # Also keep the result in an indexed store, keyed by the physical parameters
+        key = {'outfile': outfile, 'T_surf': T_surf, 'mix': mix, 'flux': flux, 'vdep': vdep,
+               'eddy': eddy, 'T_trop': T_trop, 'relative_humidity': relative_humidity}
+        arrays = results_io.photochem_arrays(p.pc)
+        arrays['success'] = np.array(res[0])
+        results_io.ResultStore(store).append(key, arrays)
     
     # Write picaso file
-    make_picaso_input_habitable(p, outfile)
+    make_picaso_input_habitable(p, outfile, rt_grid_tol)
     
     # haze column density (particles/cm^2)
     ind = p.pc.dat.species_names.index('HCaer1')
@@ -69,7 +100,11 @@ def run_model(outfile, T_surf, mix, flux, vdep, eddy, T_trop, relative_humidity,
     haze_file = outfile+'_clouds.txt'
     make_cloud_file(p.pc, p.P_trop, haze_file)
 
-def make_cloud_file(pc, P_trop, outfile):
+def make_cloud_file(pc, P_trop, outfile=None, size_distributions={}):
+    """Returns the picaso cloud DataFrame, and writes it to `outfile` if given.
+    `size_distributions` replaces the single particle radius of any of the
+    'H2O', 'HC' and 'S' aerosols (see `utils.size_distribution`).
+    """
 
     particle_radius = {}
     col = {}
@@ -125,7 +160,8 @@ def make_cloud_file(pc, P_trop, outfile):
     for key in col:
         col[key] = col[key][:-1].copy()
     
-    utils.make_haze_opacity_file(pressure, col, particle_radius, outfile)
+    particle_radius.update(size_distributions)
+    return utils.make_haze_opacity_file(pressure, col, particle_radius, outfile)
 
 def default_params():
     params = {}
@@ -141,6 +177,7 @@ def default_params():
     params['atol'] = 1.0e-27
     params['atol_min'] = 1.0e-29
     params['atol_max'] = 1.0e-26
+    params['rt_grid_tol'] = None # e.g. utils.default_rt_grid_tol() for fewer picaso layers
     return params
 
 def model1():
@@ -164,6 +201,38 @@ def model2():
     params['equilibrium_time'] = 1.0e15
     return params
 
+def run_model_pooled(handle=None, **params):
+    sharedarrays.use(handle)
+    run_model(p=worker_PhotochemClima(), **params)
+
+def retry_settings():
+    "Alternative integration settings to try if a model fails."
+    retries = [
+        {'atol': 1.0e-25, 'atol_min': 1.0e-26, 'atol_max': 1.0e-24},
+        {'atol': 1.0e-23, 'atol_min': 1.0e-24, 'atol_max': 1.0e-22}
+    ]
+    return retries
+
+def run_models(params_list, nprocesses, timeout=None, memory_limit=None):
+    """Runs many models in supervised worker processes. Each worker builds one
+    PhotochemClima and reuses it for every model it is given. Aerosol
+    optical properties are shared with the workers through shared memory.
+    A model that crashes, hangs or runs out of memory is retried with
+    `retry_settings`, and reported as a failure if no attempt works.
+    """
+    with open('data/aerosol_optical_props.pkl','rb') as f:
+        opt = pickle.load(f)
+    with sharedarrays.SharedArrays() as shared:
+        shared.publish_dict('aerosol_optical_props', opt)
+        inputs = [dict(params, handle=shared.handle) for params in params_list]
+        p = SupervisedPool(nprocesses, timeout, memory_limit, retry_settings())
+        results = p.map(run_model_pooled, inputs)
+
+    for params, res in zip(params_list, results):
+        if not res['success']:
+            print('Failed: '+params['outfile']+'\n'+res['error'])
+    return results
+
 def main():
     np.random.seed(0)
     threadpool_limits(limits=1)
@@ -171,10 +240,7 @@ def main():
         model1,
         model2
     ]
-    def wrap(model):
-        run_model(**model())
-    p = Pool(2)
-    p.map(wrap, models)
+    run_models([model() for model in models], 2)
 
 if __name__ == "__main__":
     main()
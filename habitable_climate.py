@@ -2,6 +2,168 @@ import numpy as np
 from matplotlib import pyplot as plt
 from photochem.clima import AdiabatClimate
 from labellines import labelLine
+from scipy import optimize
+from pathos.multiprocessing import ProcessingPool as Pool
+import climacache
+
+# AdiabatClimate objects owned by the current (worker) process, one per settings file
+_c_workers = {}
+
+def worker_AdiabatClimate(settings_file, T_trop, albedo):
+    if settings_file not in _c_workers:
+        c = AdiabatClimate('input/habitable/species_climate.yaml',
+                           settings_file,
+                           'input/k2_18b_stellar_flux.txt')
+        c.solve_for_T_trop = False
+        c.RH = np.ones(len(c.species_names))*1
+        _c_workers[settings_file] = c
+    c = _c_workers[settings_file]
+    c.T_trop = T_trop
+    c.rad.surface_albedo = albedo
+    return c
+
+def toa_fluxes_worker(args):
+    "Returns ISR and OLR in W/m^2."
+    settings_file, T_trop, albedo, T, P_i = args
+    c = worker_AdiabatClimate(settings_file, T_trop, albedo)
+    ISR, OLR = c.TOA_fluxes(T, P_i)
+    return ISR/1.0e3, OLR/1.0e3
+
+class TOAFluxCurve():
+    """Incoming shortwave (ISR) and outgoing longwave (OLR) radiation as a
+    function of surface temperature. Points are computed in a process pool,
+    and `refine` only adds points where the curve is interesting.
+
+    `instellation` scales the stellar flux relative to the settings file.
+    ISR is linear in the incident stellar flux and OLR does not depend on it,
+    so changing `instellation` needs no new climate calculations.
+    """
+
+    def __init__(self, settings_file, P_i, albedo=0.06, T_trop=215.0, instellation=1.0, nprocesses=1):
+        self.settings_file = settings_file
+        self.P_i = np.array(P_i)
+        self.albedo = albedo
+        self.T_trop = T_trop
+        self.instellation = instellation
+        self.nprocesses = nprocesses
+
+        # Intervals narrower than dT_min (K) are not refined. Intervals are
+        # refined where linear interpolation of OLR between their ends is
+        # estimated to be off by more than flux_tol (W/m^2), e.g. where OLR flattens.
+        self.dT_min = 1.0
+        self.flux_tol = 0.5
+
+        self.fluxes = {} # T -> (ISR, OLR), unscaled
+        self.nevaluations = 0
+
+    def evaluate(self, TT):
+        """Computes the fluxes at surface temperatures `TT` that have not been
+        computed already. Returns T, ISR and OLR sorted by T.
+        """
+        TT_new = [float(T) for T in TT if float(T) not in self.fluxes]
+        args = [(self.settings_file, self.T_trop, self.albedo, T, self.P_i) for T in TT_new]
+        if self.nprocesses > 1 and len(args) > 1:
+            out = Pool(self.nprocesses).map(toa_fluxes_worker, args)
+        else:
+            out = [toa_fluxes_worker(a) for a in args]
+        for T, fluxes in zip(TT_new, out):
+            self.fluxes[T] = fluxes
+        self.nevaluations += len(TT_new)
+        return self.curve()
+
+    def curve(self):
+        T = np.array(sorted(self.fluxes))
+        ISR = np.array([self.fluxes[a][0] for a in T])*self.instellation
+        OLR = np.array([self.fluxes[a][1] for a in T])
+        return T, ISR, OLR
+
+    def refine(self, T_min, T_max, n_initial=16, max_iters=10):
+        """Computes a coarse curve between T_min and T_max, then repeatedly
+        bisects intervals where ISR crosses OLR or where the interpolation
+        error of OLR, estimated from its curvature, exceeds `flux_tol`.
+        """
+        self.evaluate(np.linspace(T_min, T_max, n_initial))
+        for i in range(max_iters):
+            T, ISR, OLR = self.curve()
+            inds = np.where((T >= T_min) & (T <= T_max))[0]
+            T, ISR, OLR = T[inds], ISR[inds], OLR[inds]
+
+            net = ISR - OLR
+            crosses = np.sign(net[1:]) != np.sign(net[:-1])
+            dT = np.diff(T)
+            slope = np.diff(OLR)/dT
+            # Second derivative at interior points, and the largest one at
+            # the ends of each interval
+            d2 = np.abs(np.diff(slope))/(0.5*(dT[1:] + dT[:-1]))
+            curvature = np.zeros(dT.shape[0])
+            curvature[1:] = d2
+            curvature[:-1] = np.maximum(curvature[:-1], d2)
+            # Error of linear interpolation at the middle of the interval
+            kinks = curvature*dT**2/8.0 > self.flux_tol
+            wide = dT > self.dT_min
+            refine = (crosses | kinks) & wide
+            if not np.any(refine):
+                break
+            self.evaluate(0.5*(T[1:][refine] + T[:-1][refine]))
+        return self.curve()
+
+    def net_flux(self, T):
+        "ISR - OLR (W/m^2) at one surface temperature, computed in this process."
+        if float(T) not in self.fluxes:
+            self.fluxes[float(T)] = toa_fluxes_worker((self.settings_file, self.T_trop, self.albedo, float(T), self.P_i))
+            self.nevaluations += 1
+        ISR, OLR = self.fluxes[float(T)]
+        return ISR*self.instellation - OLR
+
+    def flux_ratio(self, T):
+        "OLR/ISR at one surface temperature, for the settings file instellation."
+        self.net_flux(T)
+        ISR, OLR = self.fluxes[float(T)]
+        return OLR/ISR
+
+    def equilibrium_temperatures(self, T_min, T_max, xtol=0.01):
+        "Surface temperatures where ISR = OLR, found by root finding."
+        T, ISR, OLR = self.refine(T_min, T_max)
+        net = ISR - OLR
+        roots = []
+        for i in np.where(np.sign(net[1:]) != np.sign(net[:-1]))[0]:
+            roots.append(optimize.brentq(self.net_flux, T[i], T[i+1], xtol=xtol))
+        return roots
+
+    def runaway_limit(self, T_min, T_max, xtol=0.01):
+        """Finds the runaway greenhouse limit. Returns the instellation (relative
+        to the settings file) above which ISR exceeds OLR at every surface
+        temperature, and the surface temperature where the limit is set.
+        """
+        instellation = self.instellation
+        self.instellation = 1.0
+        try:
+            T, ISR, OLR = self.refine(T_min, T_max)
+            ratio = OLR/ISR
+            i = np.argmax(ratio)
+            bounds = (T[max(i-1,0)], T[min(i+1,T.shape[0]-1)])
+            if bounds[0] < bounds[1]:
+                fcn = lambda T_: -self.flux_ratio(T_)
+                sol = optimize.minimize_scalar(fcn, bounds=bounds, method='bounded', options={'xatol': xtol})
+                T_limit, ratio_max = sol.x, -sol.fun
+            else:
+                T_limit, ratio_max = T[i], ratio[i]
+        finally:
+            self.instellation = instellation
+        return ratio_max, T_limit
+
+def runaway_limit_map(settings_file, albedos, P_H2s, T_min=216.0, T_max=640.0, T_trop=215.0, nprocesses=1):
+    """Maps the runaway limit over surface albedo and H2 pressure (bar), for an
+    atmosphere saturated with H2O. Returns the critical instellation, relative to
+    the settings file, with shape (len(albedos), len(P_H2s)).
+    """
+    limit = np.empty((len(albedos),len(P_H2s)))
+    for i,albedo in enumerate(albedos):
+        for j,P_H2 in enumerate(P_H2s):
+            P_i = np.array([1.0e6, 1.0e-10, 1.0e-10, P_H2, 1.0e-10, 1.0e-10])*1e6
+            curve = TOAFluxCurve(settings_file, P_i, albedo, T_trop, nprocesses=nprocesses)
+            limit[i,j], _ = curve.runaway_limit(T_min, T_max)
+    return limit
 
 def figure1():
     TT = np.linspace(216,640,100)
@@ -9,56 +171,26 @@ def figure1():
     T_trop = 215
     res = {}
 
-    c = AdiabatClimate('input/habitable/species_climate.yaml',
-                  'input/habitable/settings_climate.yaml',
-                  'input/k2_18b_stellar_flux.txt')
-
-    c.T_trop = T_trop
-    c.solve_for_T_trop = False
-    c.RH = np.ones(len(c.species_names))*1
     albedos = [0.06]
     res['full'] = {}
+    res['part'] = {}
     for albedo in albedos:
-        c.rad.surface_albedo = albedo
-        
-        OLR = np.empty(TT.shape[0])
-        ISR = np.empty(TT.shape[0])
-        for i,T in enumerate(TT):
-            ISR_, OLR_ = c.TOA_fluxes(T, P_i)
-            OLR[i] = OLR_/1.0e3
-            ISR[i] = ISR_/1.0e3
+        for key,settings_file in [('full','input/habitable/settings_climate.yaml'),
+                                  ('part','input/habitable/settings_climate_scale=0.7.yaml')]:
+            curve = TOAFluxCurve(settings_file, P_i, albedo, T_trop, nprocesses=4)
+            T, ISR, OLR = curve.evaluate(TT)
         
-        res['full'][albedo] = {}
-        res['full'][albedo]['T'] = TT
-        res['full'][albedo]['OLR'] = OLR
-        res['full'][albedo]['ISR'] = ISR
+            res[key][albedo] = {}
+            res[key][albedo]['T'] = T
+            res[key][albedo]['OLR'] = OLR
+            res[key][albedo]['ISR'] = ISR
 
+    c = worker_AdiabatClimate('input/habitable/settings_climate.yaml', T_trop, albedos[-1])
+    c.TOA_fluxes(TT[-1], P_i)
     total_solar_energy = 4*c.rad.wrk_sol.fdn_n[-1]/1e3 # W/m^2
     print('Solar energy relative to Modern = %.3f'%(total_solar_energy))
 
-    c = AdiabatClimate('input/habitable/species_climate.yaml',
-                    'input/habitable/settings_climate_scale=0.7.yaml',
-                    'input/k2_18b_stellar_flux.txt')
-
-    c.T_trop = T_trop
-    c.solve_for_T_trop = False
-    c.RH = np.ones(len(c.species_names))*1
-    albedos = [0.06]
-    res['part'] = {}
-    for albedo in albedos:
-        c.rad.surface_albedo = albedo
-        
-        OLR = np.empty(TT.shape[0])
-        ISR = np.empty(TT.shape[0])
-        for i,T in enumerate(TT):
-            ISR_, OLR_ = c.TOA_fluxes(T, P_i)
-            OLR[i] = OLR_/1.0e3
-            ISR[i] = ISR_/1.0e3
-        
-        res['part'][albedo] = {}
-        res['part'][albedo]['T'] = TT
-        res['part'][albedo]['OLR'] = OLR
-        res['part'][albedo]['ISR'] = ISR
+    c = worker_AdiabatClimate('input/habitable/settings_climate_scale=0.7.yaml', T_trop, albedos[-1])
 
     # plot
     plt.rcParams.update({'font.size': 15})
@@ -87,8 +219,11 @@ def figure1():
             size = 20,ha='left', va='top',transform=ax.transAxes)
 
     ax = axs[1]
-    c.make_profile_bg_gas(320,P_i,1e6,'H2')
-    ax.plot(c.T,c.P/1e6, c='k', lw=2)
+    cache = climacache.ClimaProfileCache('input/habitable/species_climate.yaml',
+                                         'input/habitable/settings_climate_scale=0.7.yaml',
+                                         'input/k2_18b_stellar_flux.txt', cache_dir='input/cache/clima/')
+    prof = cache.make_profile_bg_gas(c, 320, P_i, 1e6, 'H2')
+    ax.plot(prof.T,prof.P/1e6, c='k', lw=2)
     ax.set_yscale('log')
     ax.set_ylim(1,1e-8)
     ax.grid(alpha=0.4)
@@ -1,57 +1,17 @@
 import numpy as np
 from matplotlib import pyplot as plt
-import pickle
 
-from photochemclima import PhotochemClima
 import habitable
-
-def make_PhotochemClima(params):
-    p = PhotochemClima('input/zahnle_earth_new.yaml',
-                       'input/habitable/settings_habitable_template.yaml',
-                       'input/k2_18b_stellar_flux.txt',
-                       'input/habitable/atmosphere_init.txt',
-                       'input/habitable/species_climate.yaml',
-                       'input/habitable/settings_climate_scale=0.7.yaml')
-    p.pc.var.verbose = 1
-    p.constant_eddy = params['eddy']
-    p.relative_humidity = params['relative_humidity']
-    p.pc.var.relative_humidity = params['relative_humidity']
-    for sp in params['mix']:
-        if sp == 'H2O' or sp == 'H2':
-            continue
-        else:
-            p.pc.set_lower_bc(sp,bc_type='mix',mix=params['mix'][sp])
-    for sp in params['flux']:
-        p.pc.set_lower_bc(sp,bc_type='flux',flux=params['flux'][sp])
-    for sp in params['vdep']:
-        p.pc.set_lower_bc(sp,bc_type='vdep',vdep=params['vdep'][sp])
-
-    p.c.RH = np.ones(len(p.c.species_names))*params['relative_humidity']
-    p.c.T_trop = params['T_trop']
-
-    p.initialize_atmosphere(params['T_surf'],params['mix'])
-
-    with open(params['outfile']+'_atmosphere.pkl','rb') as f:
-        res = pickle.load(f)
-    success, out = res
-
-    p.pc.update_vertical_grid(TOA_alt=out['top_atmos'])
-    p.pc.set_temperature(out['temperature'], out['trop_alt'])
-    p.pc.var.edd = out['edd']
-    p.pc.wrk.usol = out['usol']
-    p.pc.prep_atmosphere(p.pc.wrk.usol)
-    return p
+import results_io
 
 def figure2():
     params = habitable.model1()
-    p1 = make_PhotochemClima(params)
-    pc1 = p1.pc
+    res1 = results_io.AtmosphereResult(params['outfile']+'_result.npz')
 
     params = habitable.model2()
-    p2 = make_PhotochemClima(params)
-    pc2 = p2.pc
+    res2 = results_io.AtmosphereResult(params['outfile']+'_result.npz')
 
-    pcs = [pc1,pc2]
+    results = [res1,res2]
 
     plt.rcParams.update({'font.size': 13})
     fig,axs = plt.subplots(1,2,figsize=[8,3],sharey=True)
@@ -66,15 +26,14 @@ def figure2():
     model_labels = ['(lifeless)', '(inhabited)']
     fig_letter = ['(a)','(b)','(c)']
     for i,ax in enumerate(axs):
-        pc = pcs[i]
+        res = results[i]
         for j,sp in enumerate(species):
-            ind = pc.dat.species_names.index(sp)
-            tmp = pc.wrk.densities[ind,:]/pc.wrk.density
+            tmp = res.mix(sp)
             if i == 1:
                 label = labels[j]
             else:
                 label = None
-            ax.plot(tmp,pc.wrk.pressure/1e6, c=colors[j],label=label, lw=2, ls=ls[j])
+            ax.plot(tmp,res.pressure/1e6, c=colors[j],label=label, lw=2, ls=ls[j])
 
         note =  'surf. CH$_4$ flux = '+CH4_fluxes[i]
         ax.text(.98, .99, note, \
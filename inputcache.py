@@ -0,0 +1,112 @@
+import numpy as np
+import hashlib
+import pickle
+import yaml
+import os
+import uuid
+import zipfile
+
+# Binary copies of text inputs live here, keyed by the hash of the source file:
+# parsed YAML (PhotochemClima settings, and the reaction networks and settings
+# read by network_reduction) and JWST spectra (jwst_data.load_data). The Mie
+# tables of utils.mie_table are kept here too.
+CACHE_DIR = 'input/cache/'
+
+def file_hash(filename):
+    "sha256 hash of the contents of a file."
+    h = hashlib.sha256()
+    with open(filename,'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cache_filename(filename, sha, extension):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(CACHE_DIR, name+'_'+sha[:16]+extension)
+
+def _savez_atomic(cache_file, **arrays):
+    "Writes an npz next to `cache_file` and moves it into place, so readers never see a partial file."
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = cache_file+'.'+uuid.uuid4().hex+'.tmp.npz'
+    np.savez(tmp, **arrays)
+    os.replace(tmp, cache_file)
+
+def _pickle_atomic(cache_file, obj):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = cache_file+'.'+uuid.uuid4().hex+'.tmp'
+    with open(tmp,'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(tmp, cache_file)
+
+# A cache file that can't be read is treated as missing
+_LOAD_ERRORS = (EOFError, pickle.UnpicklingError, zipfile.BadZipFile, KeyError, ValueError)
+
+def transmission_data(filename):
+    """Loads a JWST transmission spectrum text file (wavelength in microns, bin
+    half-width, transit depth, uncertainty). The first call converts the text
+    file to an npz, later calls load the npz as long as the text file has not
+    changed. Returns a dict in the format of `lowres.pkl`.
+    """
+    sha = file_hash(filename)
+    cache_file = cache_filename(filename, sha, '.npz')
+
+    if os.path.isfile(cache_file):
+        try:
+            with np.load(cache_file) as out:
+                if str(out['sha256']) == sha:
+                    return {a: out[a].copy() for a in out.files if a != 'sha256'}
+        except _LOAD_ERRORS:
+            pass
+
+    tmp = np.loadtxt(filename, skiprows=1)
+    data = {}
+    data['wv'] = tmp[:,0].copy()
+    data['wv_err'] = tmp[:,1].copy()
+    data['wv_bins'] = np.array([tmp[:,0] - tmp[:,1], tmp[:,0] + tmp[:,1]]).T.copy()
+    data['rprs2'] = tmp[:,2].copy()
+    data['rprs2_err'] = tmp[:,3].copy()
+    _savez_atomic(cache_file, sha256=sha, **data)
+    return data
+
+def load_yaml(filename):
+    """Loads a YAML file, using a pickled copy of the parsed result if one
+    exists for the current contents of the file.
+    """
+    sha = file_hash(filename)
+    cache_file = cache_filename(filename, sha, '.pkl')
+
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file,'rb') as f:
+                out = pickle.load(f)
+            if out['sha256'] == sha:
+                return out['data']
+        except _LOAD_ERRORS:
+            pass
+
+    Loader = getattr(yaml, 'CLoader', yaml.Loader)
+    with open(filename,'r') as f:
+        data = yaml.load(f, Loader=Loader)
+    _pickle_atomic(cache_file, {'sha256': sha, 'data': data})
+    return data
+
+def reaction_network(filename):
+    "Loads a photochem reaction network YAML file through the cache."
+    network = load_yaml(filename)
+    for key in ['atoms','species','reactions']:
+        if key not in network:
+            raise Exception('"'+filename+'" is not a reaction network. It is missing "'+key+'".')
+    return network
+
+def main():
+    # Compile all the large inputs used by the pipeline
+    for filename in ['input/zahnle_earth_new.yaml',
+                     'input/zahnle_earth_new_S8.yaml',
+                     'input/zahnle_earth_new_noparticles.yaml']:
+        reaction_network(filename)
+    for filename in ['data/osfstorage-archive/K2-18b_niriss_soss_native.txt',
+                     'data/osfstorage-archive/K2-18b_nirspec_g395h_native.txt']:
+        transmission_data(filename)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import numpy as np
+import pickle
+from scipy import sparse
+from scipy.stats import distributions
+from scipy.stats import norm
+
+import inputcache
+
+DATA_FOLDER = 'data/osfstorage-archive/'
+
+def load_data(resolution='lowres'):
+    """JWST transmission spectrum of K2-18b (Madhusudhan et al. 2023), as a dict
+    with 'soss', 'g395h' and 'all' in the format of `lowres.pkl`. `resolution`
+    is 'lowres' or 'native'. The native text files are read through an npz cache.
+    """
+    if resolution == 'lowres':
+        with open(DATA_FOLDER+'lowres.pkl','rb') as f:
+            data = pickle.load(f)
+        return data
+
+    data = {}
+    data['soss'] = inputcache.transmission_data(DATA_FOLDER+'K2-18b_niriss_soss_'+resolution+'.txt')
+    data['g395h'] = inputcache.transmission_data(DATA_FOLDER+'K2-18b_nirspec_g395h_'+resolution+'.txt')
+    data['all'] = {}
+    for key in data['soss']:
+        data['all'][key] = np.concatenate((data['soss'][key], data['g395h'][key]))
+    return data
+
+def bin_edges(wv):
+    "Edges of bins centered on `wv`, as in `utils.rebin_picaso_to_data`."
+    d = np.diff(wv)
+    return np.concatenate(([wv[0]-d[0]/2], wv[:-1]+d/2.0, [wv[-1]+d[-1]/2]))
+
+# Rebinning operators, keyed by the model and data wavelengths
+_operators = {}
+
+def rebin_operator(wv, wv_bins_data):
+    """Sparse matrix A such that A @ flux is `flux`, given at wavelengths `wv`,
+    averaged over each data bin in `wv_bins_data` (shape (n, 2)). This is the
+    same average as `utils.rebin_picaso_to_data`. Operators are kept for reuse.
+    """
+    key = (hash(wv.tobytes()), hash(wv_bins_data.tobytes()))
+    if key in _operators:
+        return _operators[key]
+
+    edges = bin_edges(wv)
+    if np.min(wv_bins_data) < edges[0] or np.max(wv_bins_data) > edges[-1]:
+        raise Exception('The data bins extend beyond the model wavelengths.')
+    rows = []
+    cols = []
+    vals = []
+    for i in range(wv_bins_data.shape[0]):
+        a, b = wv_bins_data[i,:]
+        j0 = np.searchsorted(edges, a, side='right') - 1
+        j1 = np.searchsorted(edges, b, side='left')
+        j = np.arange(j0, j1)
+        overlap = np.minimum(edges[j+1], b) - np.maximum(edges[j], a)
+        rows.append(np.full(j.shape[0], i))
+        cols.append(j)
+        vals.append(overlap/np.sum(overlap))
+    A = sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                          shape=(wv_bins_data.shape[0], wv.shape[0]))
+    _operators[key] = A
+    return A
+
+def data_mask(data, wv_range=None):
+    "Indices of data points with wavelengths inside `wv_range`."
+    if wv_range is None:
+        return np.arange(data['wv'].shape[0])
+    return np.where((data['wv'] > wv_range[0]) & (data['wv'] < wv_range[1]))[0]
+
+def rebin(wv, rprs2, data, inds=None):
+    "Rebins a spectrum, or a stack of spectra (nspectra, nwv), to the data bins `inds`."
+    if inds is None:
+        inds = np.arange(data['wv'].shape[0])
+    A = rebin_operator(wv, data['wv_bins'][inds])
+    return (A @ np.atleast_2d(rprs2).T).T.reshape(np.shape(rprs2)[:-1]+(inds.shape[0],))
+
+def offset_statistics(groups):
+    """Chi^2 of binned models against data, where each group of data (e.g. an
+    instrument) gets its own transit depth offset. `groups` is a list of
+    (data_y, err, model_b), where model_b is (ndata,) or (nmodels, ndata).
+    The best offsets are found in closed form. Returns offsets (one per group)
+    and chi2, rchi2, p and sig, with the number of data points as the dof.
+    """
+    out = {}
+    out['offset'] = []
+    chi2 = 0.0
+    dof = 0
+    for data_y, err, model_b in groups:
+        w = 1.0/err**2
+        resid = data_y - model_b
+        offset = np.sum(w*resid, axis=-1)/np.sum(w)
+        chi2 = chi2 + np.sum(w*(resid - offset[...,None])**2, axis=-1)
+        dof += data_y.shape[0]
+        out['offset'].append(offset)
+    out['chi2'] = chi2
+    out['dof'] = dof
+    out['rchi2'] = chi2/dof
+    out['p'] = distributions.chi2.sf(chi2, dof)
+    out['sig'] = norm.ppf(1 - out['p'])
+    return out
+
+def fit_offsets(wv, rprs2, data, keys=['all'], wv_range=None):
+    """Rebins a spectrum, or a stack of spectra (nspectra, nwv), to the data and
+    fits one offset for each instrument in `keys` (e.g. ['all'] or
+    ['soss','g395h']), using data inside `wv_range`. Returns the output of
+    `offset_statistics`, with the binned spectra in 'rprs2_b' (one per key).
+    """
+    groups = []
+    rprs2_b = []
+    for key in keys:
+        inds = data_mask(data[key], wv_range)
+        model_b = rebin(wv, rprs2, data[key], inds)
+        groups.append((data[key]['rprs2'][inds], data[key]['rprs2_err'][inds], model_b))
+        rprs2_b.append(model_b)
+    out = offset_statistics(groups)
+    out['rprs2_b'] = rprs2_b
+    return out
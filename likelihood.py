@@ -0,0 +1,135 @@
+import numpy as np
+from scipy import linalg
+from scipy.stats import distributions
+from scipy.stats import norm
+
+import jwst_data
+
+def squared_exponential_covariance(wv, amplitude, length_scale):
+    "Squared exponential kernel over wavelength (microns), amplitude in transit depth."
+    d = wv[:,None] - wv[None,:]
+    return amplitude**2*np.exp(-0.5*(d/length_scale)**2)
+
+def matern32_covariance(wv, amplitude, length_scale):
+    "Matern-3/2 kernel over wavelength (microns), amplitude in transit depth."
+    d = np.sqrt(3.0)*np.abs(wv[:,None] - wv[None,:])/length_scale
+    return amplitude**2*(1.0 + d)*np.exp(-d)
+
+def constant_covariance(wv, amplitude):
+    """Fully correlated noise, i.e. an offset of the instrument with standard
+    deviation `amplitude`, marginalized over. This only changes chi^2 if that
+    offset is not also fit: give the instrument `fit_offset=False` in
+    `CorrelatedLikelihood`, or use it in the shared-offset ['all'] fit, where
+    it acts as a prior on the SOSS/G395H offset.
+    """
+    return amplitude**2*np.ones((wv.shape[0],wv.shape[0]))
+
+def instrument_covariance(data, key, inds, covariances):
+    """Covariance of data[key] at `inds`. `covariances` maps an instrument
+    ('soss' or 'g395h') to a function of wavelength that returns the
+    correlated part of its covariance, added to the white noise, or to a full
+    covariance matrix over all of that instrument's data points. The
+    instruments are independent of each other, so 'all' is block diagonal.
+    If no instrument involved has a covariance, returns just the variances (1D).
+    """
+    if key == 'all':
+        n = data['soss']['wv'].shape[0]
+        parts = [('soss', inds[inds < n]), ('g395h', inds[inds >= n] - n)]
+    else:
+        parts = [(key, inds)]
+
+    if all(covariances.get(name) is None for name, j in parts):
+        return np.concatenate([data[name]['rprs2_err'][j]**2 for name, j in parts])
+
+    blocks = []
+    for name, j in parts:
+        cov = covariances.get(name)
+        if cov is None:
+            block = np.diag(data[name]['rprs2_err'][j]**2)
+        elif callable(cov):
+            block = np.diag(data[name]['rprs2_err'][j]**2) + cov(data[name]['wv'][j])
+        else:
+            block = cov[np.ix_(j,j)]
+        blocks.append(block)
+    return linalg.block_diag(*blocks)
+
+def whiten(L, x):
+    """Solves L y = x, where L is a lower Cholesky factor, or the standard
+    deviations (1D) of a diagonal covariance. x is (n,) or (n, m).
+    """
+    if L.ndim == 1:
+        return x/(L if x.ndim == 1 else L[:,None])
+    return linalg.solve_triangular(L, x, lower=True)
+
+class CorrelatedLikelihood():
+    """chi^2 and log-likelihood of model spectra against data with correlated
+    noise, using the data inside `wv_range`. Each instrument group in `keys`
+    gets its own best fit offset, as in `jwst_data.fit_offsets`, unless
+    `fit_offset` (one bool per key) says otherwise. Covariances are factored
+    once when the object is made and kept with it; groups without correlated
+    noise use the diagonal directly. Each call then whitens a whole stack of
+    binned spectra with one triangular solve per group.
+    """
+
+    def __init__(self, data, keys=['all'], wv_range=None, covariances={}, fit_offset=None):
+        if fit_offset is None:
+            fit_offset = [True for key in keys]
+        self.data = data
+        self.keys = keys
+        self.fit_offset = fit_offset
+        self.inds = []
+        self.L = []
+        self.y_w = []
+        self.ones_w = []
+        self.logdet = 0.0
+        self.ndata = 0
+        for key in keys:
+            inds = jwst_data.data_mask(data[key], wv_range)
+            cov = instrument_covariance(data, key, inds, covariances)
+            if cov.ndim == 1:
+                L = np.sqrt(cov)
+            else:
+                L = linalg.cholesky(cov, lower=True)
+            self.inds.append(inds)
+            self.L.append(L)
+            self.y_w.append(whiten(L, data[key]['rprs2'][inds]))
+            self.ones_w.append(whiten(L, np.ones(inds.shape[0])))
+            self.logdet += 2.0*np.sum(np.log(L if L.ndim == 1 else np.diag(L)))
+            self.ndata += inds.shape[0]
+
+    def binned_statistics(self, models_b):
+        """Statistics of spectra already binned to the data, with one array
+        (ndata,) or (nmodels, ndata) per instrument. Returns a dict like
+        `jwst_data.offset_statistics`, with the log-likelihood in 'lnlike'.
+        Offsets that are not fit are zero.
+        """
+        out = {}
+        out['offset'] = []
+        chi2 = 0.0
+        for i,model_b in enumerate(models_b):
+            m_w = whiten(self.L[i], np.atleast_2d(model_b).T).T
+            resid = self.y_w[i] - m_w
+            if self.fit_offset[i]:
+                offset = (resid @ self.ones_w[i])/(self.ones_w[i] @ self.ones_w[i])
+                resid = resid - offset[:,None]*self.ones_w[i]
+            else:
+                offset = np.zeros(resid.shape[0])
+            chi2 = chi2 + np.sum(resid**2, axis=1)
+            out['offset'].append(offset.reshape(np.shape(model_b)[:-1]))
+        chi2 = chi2.reshape(np.shape(models_b[0])[:-1])
+        out['chi2'] = chi2
+        out['dof'] = self.ndata
+        out['rchi2'] = chi2/self.ndata
+        out['p'] = distributions.chi2.sf(chi2, self.ndata)
+        out['sig'] = norm.ppf(1 - out['p'])
+        out['lnlike'] = -0.5*(chi2 + self.logdet + self.ndata*np.log(2*np.pi))
+        return out
+
+    def statistics(self, wv, rprs2):
+        "Rebins a spectrum, or a stack of spectra (nspectra, nwv), and computes its statistics."
+        models_b = []
+        for key, inds in zip(self.keys, self.inds):
+            models_b.append(jwst_data.rebin(wv, rprs2, self.data[key], inds))
+        out = self.binned_statistics(models_b)
+        out['rprs2_b'] = models_b
+        return out
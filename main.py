@@ -6,16 +6,24 @@ import neptune
 import neptune_plot
 import make_spectra
 import spectra_plot
+from profiling import PipelineProfiler
 
-def main():
-    habitable_climate.main()
-    habitable.main()
-    habitable_plot.main()
-    neptune_climate.main()
-    neptune.main()
-    neptune_plot.main()
-    make_spectra.main()
-    spectra_plot.main()
+def main(profile=False):
+    stages = [
+        ('habitable_climate', habitable_climate.main),
+        ('habitable', habitable.main),
+        ('habitable_plot', habitable_plot.main),
+        ('neptune_climate', neptune_climate.main),
+        ('neptune', neptune.main),
+        ('neptune_plot', neptune_plot.main),
+        ('make_spectra', make_spectra.main),
+        ('spectra_plot', spectra_plot.main)
+    ]
+    profiler = PipelineProfiler(profile=profile)
+    for name, fcn in stages:
+        with profiler.stage(name):
+            fcn()
+    profiler.save()
 
 if __name__ == '__main__':
     main()
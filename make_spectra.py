@@ -1,20 +1,33 @@
 import utils
 import numpy as np
 from picaso import justdoit as jdi
-from scipy.stats import distributions
-from scipy import optimize
-from scipy.stats import norm
 import os
 import planets
+import jwst_data
+import likelihood
 import pickle
 import yaml
 import pandas as pd
 import warnings
 warnings.filterwarnings('ignore')
 
-def compute_spectra(add_water_cloud, add_all_clouds, outfile):
+NATIVE_R = 60000 # resolving power of the opacity database
+
+def resample_for_R(R):
+    "Opacity resampling that gives roughly resolving power `R`."
+    return max(1, int(round(NATIVE_R/R)))
+
+def make_opannection(wave_range=[0.01,100], resample=1, R=None):
+    """`resample` > 1 keeps every resample-th opacity point, for quick low resolution spectra.
+    Alternatively, `R` sets the resolving power (e.g. 1000-3000 for screening).
+    """
+    if R is not None:
+        resample = resample_for_R(R)
     filename_db = os.path.join(os.getenv('picaso_refdata'), 'opacities','all_opacities_0.6_6_R60000.db')
-    opa = jdi.opannection(wave_range=[0.01,100],filename_db=filename_db)
+    opa = jdi.opannection(wave_range=wave_range,filename_db=filename_db,resample=resample)
+    return opa
+
+def make_case(opa):
     case1 = jdi.inputs()
     case1.phase_angle(0)
     case1.gravity(mass=planets.k2_18b.mass, mass_unit=jdi.u.Unit('M_earth'),
@@ -22,6 +35,20 @@ def compute_spectra(add_water_cloud, add_all_clouds, outfile):
     case1.star(opa, planets.k2_18.Teff, planets.k2_18.metal, planets.k2_18.logg, radius=planets.k2_18.radius, 
             radius_unit = jdi.u.Unit('R_sun'),database='phoenix')
     case1.approx(p_reference=1.0)
+    return case1
+
+def transmission_spectrum(case1, opa):
+    "Returns wavelength (microns) and transit depth, ordered by wavelength."
+    df = case1.spectrum(opa, full_output=True,calculation='transmission')
+    wno_h, rprs2_h  = df['wavenumber'] , df['transit_depth']
+    wv = 1e4/wno_h[::-1].copy()
+    rprs2 = rprs2_h[::-1].copy()
+    return wv, rprs2
+
+def compute_spectra(add_water_cloud, add_all_clouds, outfile, R=None):
+    "`R` computes the spectra at a lower resolving power, for quick looks."
+    opa = make_opannection(R=R)
+    case1 = make_case(opa)
 
     model_type = ['habitable','habitable','neptune']
     model_names = ['model1','model2','nominal_S']
@@ -34,8 +61,10 @@ def compute_spectra(add_water_cloud, add_all_clouds, outfile):
     species_to_exclude = [['H2O'],['NH3'],['CO2'],['CH4'],['CO'],['HCN'],['C2H6'],['H2S']]
     res = {}
     for i in range(len(model_folders)):
+        # Parse the inputs once, and reuse them for every spectrum
         atmosphere_file = model_folders[i]+model_names[i]+'_picaso.pt'
-        case1.atmosphere(filename = atmosphere_file, delim_whitespace=True)
+        atm = pd.read_csv(atmosphere_file, delim_whitespace=True)
+        case1.atmosphere(df = atm.copy())
 
         if add_water_cloud:
             # Get cloud region from settings file
@@ -54,153 +83,175 @@ def compute_spectra(add_water_cloud, add_all_clouds, outfile):
             case1.clouds(g0=[0.9], w0=[0.9], opd=[10], p=[p_cloud_base], dp=[cloud_thickness])
 
         if add_all_clouds:
-            case1.clouds(filename=model_folders[i]+model_names[i]+'_clouds.txt', delim_whitespace=True)
+            clouds = pd.read_csv(model_folders[i]+model_names[i]+'_clouds.txt', delim_whitespace=True)
+            case1.clouds(df = clouds)
 
-        df = case1.spectrum(opa, full_output=True,calculation='transmission')
-        wno_h, rprs2_h  = df['wavenumber'] , df['transit_depth']
         entry = {}
         entry['all'] = {}
-        entry['all']['wv'] = 1e4/wno_h[::-1].copy()
-        entry['all']['rprs2'] = rprs2_h[::-1].copy()
+        entry['all']['wv'], entry['all']['rprs2'] = transmission_spectrum(case1, opa)
         for sp in species_to_exclude:
-            case1.atmosphere(filename = atmosphere_file,exclude_mol=sp, delim_whitespace=True)
-            df = case1.spectrum(opa, full_output=True,calculation='transmission')
-            wno_h, rprs2_h  = df['wavenumber'] , df['transit_depth']
+            case1.atmosphere(df = atm.copy(), exclude_mol=sp)
             key = '_'.join(sp)
             entry[key] = {}
-            entry[key]['wv'] = 1e4/wno_h[::-1].copy()
-            entry[key]['rprs2'] = rprs2_h[::-1].copy()
+            entry[key]['wv'], entry[key]['rprs2'] = transmission_spectrum(case1, opa)
 
         res[model_names[i]] = entry
 
     with open(outfile,'wb') as f:
         pickle.dump(res,f)
 
-def stats_objective(x, data_y, err, expected_y):
-    return utils.chi_squared(data_y, err, expected_y+x[0])
+def spectrum_statistics(wv, rprs2, data, wv_range):
+    """Rebins a spectrum, or a stack of spectra (nspectra, nwv), to the data in
+    `wv_range` and fits an offset. Returns the binned spectra, rchi2 and sig.
+    """
+    out = jwst_data.fit_offsets(wv, rprs2, data, ['all'], wv_range)
+    return out['rprs2_b'][0], out['rchi2'], out['sig']
+
+def resolution_error(R_values, outfile, wv_range=[0.8,5.3], data_file='data/osfstorage-archive/lowres.pkl'):
+    """Error of low resolution spectra, binned to the data, relative to spectra
+    at the native resolution, for the nominal models. For each model and R, reports
+    the maximum and RMS difference (ppm) and the maximum difference in units of
+    the data uncertainty.
+    """
+    with open(data_file,'rb') as f:
+        data = pickle.load(f)
+    inds = np.where((data['all']['wv'] > wv_range[0]) & (data['all']['wv'] < wv_range[1]))
+    err = data['all']['rprs2_err'][inds]
 
-def stats_objective_1(x, i, data, rprs2_soss, rprs2_g395h):
-    tmp1 = utils.chi_squared(data['soss']['rprs2'][i:], data['soss']['rprs2_err'][i:], rprs2_soss[i:]+x[0])
-    tmp2 = utils.chi_squared(data['g395h']['rprs2'][:], data['g395h']['rprs2_err'][:], rprs2_g395h[:]+x[1])
-    return tmp1 + tmp2
+    models = ['results/habitable/model1','results/habitable/model2','results/neptune/nominal_S']
+    atms = [pd.read_csv(a+'_picaso.pt', delim_whitespace=True) for a in models]
 
-def compute_statistics(infile, out_stats_file):
+    def binned_spectra(opa):
+        case1 = make_case(opa)
+        out = []
+        for atm in atms:
+            case1.atmosphere(df = atm.copy())
+            wv, rprs2 = transmission_spectrum(case1, opa)
+            out.append(spectrum_statistics(wv, rprs2, data, wv_range)[0])
+        return out
 
-    i_values = [0,6]
+    ref = binned_spectra(make_opannection(wave_range=wv_range))
+    res = {}
+    for R in R_values:
+        low = binned_spectra(make_opannection(wave_range=wv_range, R=R))
+        res[R] = {}
+        for model, a, b in zip(models, ref, low):
+            diff = np.abs(b - a)
+            name = os.path.basename(model)
+            res[R][name] = {}
+            res[R][name]['max_ppm'] = np.max(diff)*1e6
+            res[R][name]['rms_ppm'] = np.sqrt(np.mean(diff**2))*1e6
+            res[R][name]['max_sigma'] = np.max(diff/err)
+            print('R = %6i, %-10s max = %6.1f ppm, rms = %6.1f ppm, max = %.3f sigma'
+                  %(R, name, res[R][name]['max_ppm'], res[R][name]['rms_ppm'], res[R][name]['max_sigma']))
+
+    with open(outfile,'wb') as f:
+        pickle.dump(res,f)
+    return res
 
-    with open('data/osfstorage-archive/lowres.pkl','rb') as f:
+def rt_grid_error(atm, grid_tol=None, wv_range=[0.8,5.3], data_file='data/osfstorage-archive/lowres.pkl', opa=None):
+    """Transit depth error from compacting a picaso atmosphere DataFrame with
+    `utils.compact_picaso_atmosphere`. Reports the layer counts, the column
+    error and the maximum spectrum difference (ppm) at native resolution and
+    binned to the data, and binned in units of the data uncertainty.
+    """
+    with open(data_file,'rb') as f:
         data = pickle.load(f)
+    inds = np.where((data['all']['wv'] > wv_range[0]) & (data['all']['wv'] < wv_range[1]))
+    err = data['all']['rprs2_err'][inds]
+    if opa is None:
+        opa = make_opannection(wave_range=wv_range)
+    case1 = make_case(opa)
+
+    atm_c, col_err = utils.compact_picaso_atmosphere(atm, grid_tol)
+    spectra = []
+    for df in [atm, atm_c]:
+        case1.atmosphere(df = df.copy())
+        wv, rprs2 = transmission_spectrum(case1, opa)
+        spectra.append((rprs2, spectrum_statistics(wv, rprs2, data, wv_range)[0]))
+    diff = np.abs(spectra[1][0] - spectra[0][0])
+    diff_b = np.abs(spectra[1][1] - spectra[0][1])
+
+    out = {}
+    out['nz'] = atm.shape[0]
+    out['nz_compact'] = atm_c.shape[0]
+    out['column_error'] = col_err
+    out['max_ppm'] = np.max(diff)*1e6
+    out['max_ppm_binned'] = np.max(diff_b)*1e6
+    out['max_sigma_binned'] = np.max(diff_b/err)
+    print('%i -> %i levels, column error = %.1e, max error = %.1f ppm (%.1f ppm binned, %.3f sigma)'
+          %(out['nz'], out['nz_compact'], col_err, out['max_ppm'], out['max_ppm_binned'], out['max_sigma_binned']))
+    return out
+
+def statistics_entry(data, rprs2_all, rprs2_soss, rprs2_g395h, single, split, j):
+    "Output of `compute_statistics` for spectrum j of the fits `single` and `split`."
+    entry = {}
+    entry['wv'] = data['all']['wv']
+    entry['rprs2'] = rprs2_all
+    entry['offset'] = single['offset'][0][j]
+    entry['rchi2'] = single['rchi2'][j]
+    entry['p'] = single['p'][j]
+    entry['sig'] = single['sig'][j]
+    entry['split'] = {}
+    entry['split']['wv_soss'] = data['soss']['wv']
+    entry['split']['rprs2_soss'] = rprs2_soss
+    entry['split']['wv_g395h'] = data['g395h']['wv']
+    entry['split']['rprs2_g395h'] = rprs2_g395h
+    entry['split']['offset_soss'] = split['offset'][0][j]
+    entry['split']['offset_g395h'] = split['offset'][1][j]
+    entry['split']['rchi2'] = split['rchi2'][j]
+    entry['split']['p'] = split['p'][j]
+    entry['split']['sig'] = split['sig'][j]
+    return entry
+
+def compute_statistics(infile, out_stats_file, resolution='lowres', covariances={}):
+    """Fits the spectra in `infile` to the data at `resolution` ('lowres' or
+    'native'), with one offset, and with separate SOSS and G395H offsets. For
+    each i in `i_values`, data blueward of the i-th lowres SOSS bin is dropped.
+    `covariances` gives correlated noise for each instrument (see
+    `likelihood.instrument_covariance`). All spectra are rebinned and fit together.
+    """
+
+    i_values = [0,6]
+
+    data = jwst_data.load_data(resolution)
+    lowres = jwst_data.load_data('lowres')
 
     with open(infile,'rb') as f:
         models = pickle.load(f)
 
+    # Stack every spectrum
+    names = []
+    for model in models:
+        for case in models[model]:
+            names.append((model, case))
+    wv = models[names[0][0]][names[0][1]]['wv']
+    rprs2 = np.array([models[model][case]['rprs2'] for model, case in names])
+    assert all(np.array_equal(models[model][case]['wv'], wv) for model, case in names)
+
+    # rebin models to data
+    rprs2_b = {}
+    for key in ['all','soss','g395h']:
+        rprs2_b[key] = jwst_data.rebin(wv, rprs2, data[key])
+        # Flat line
+        rprs2_b[key] = np.append(rprs2_b[key], np.ones((1,data[key]['wv'].shape[0]))*0.002944, axis=0)
+    names.append(('flat','all'))
+
     models_binned = {}
     for i in i_values:
-        # rebin models to data
+        wv_range = [lowres['soss']['wv_bins'][i,0], np.inf]
+
+        # Find offsets, and stats
+        like = likelihood.CorrelatedLikelihood(data, ['all'], wv_range, covariances)
+        single = like.binned_statistics([rprs2_b['all'][:,like.inds[0]]])
+        like = likelihood.CorrelatedLikelihood(data, ['soss','g395h'], wv_range, covariances)
+        split = like.binned_statistics([rprs2_b['soss'][:,like.inds[0]], rprs2_b['g395h'][:,like.inds[1]]])
+
         models_r = {}
-        for model in models:
-            models_r[model] = {}
-            for case in models[model]:
-                
-                # regrid spectrum to data
-                _, _, rprs2 = utils.rebin_picaso_to_data(models[model][case]['wv'], models[model][case]['rprs2'], data['all']['wv_bins'])
-
-                # Save results
-                models_r[model][case] = {}
-                models_r[model][case]['wv'] = data['all']['wv']
-                models_r[model][case]['rprs2'] = rprs2
-                
-                # Find offset
-                init = np.array([1e-5])
-                args = (data['all']['rprs2'][i:], data['all']['rprs2_err'][i:], rprs2[i:])
-                sol = optimize.minimize(stats_objective, init, method = 'Nelder-Mead', args = args)
-                assert sol.success
-                models_r[model][case]['offset'] = sol.x[0]
-
-                # stats
-                dof = data['all']['wv'][i:].shape[0]
-                chi2 = utils.chi_squared(data['all']['rprs2'][i:], data['all']['rprs2_err'][i:], rprs2[i:]+sol.x[0])
-                rchi2 = chi2/dof
-                p = distributions.chi2.sf(chi2, dof)
-                sig = norm.ppf(1 - p)
-                models_r[model][case]['rchi2'] = rchi2
-                models_r[model][case]['p'] = p
-                models_r[model][case]['sig'] = sig
-
-                # Find split offset
-                _, _, rprs2_soss = utils.rebin_picaso_to_data(models[model][case]['wv'], models[model][case]['rprs2'], data['soss']['wv_bins'])
-                _, _, rprs2_g395h = utils.rebin_picaso_to_data(models[model][case]['wv'], models[model][case]['rprs2'], data['g395h']['wv_bins'])
-
-                init = np.array([1e-5,1e-5])
-                args = (i,data,rprs2_soss,rprs2_g395h)
-                sol = optimize.minimize(stats_objective_1, init, method = 'Nelder-Mead', args = args)
-                assert sol.success
-                models_r[model][case]['split'] = {}
-                models_r[model][case]['split']['wv_soss'] = data['soss']['wv']
-                models_r[model][case]['split']['rprs2_soss'] = rprs2_soss
-                models_r[model][case]['split']['wv_g395h'] = data['g395h']['wv']
-                models_r[model][case]['split']['rprs2_g395h'] = rprs2_g395h
-                models_r[model][case]['split']['offset_soss'] = sol.x[0]
-                models_r[model][case]['split']['offset_g395h'] = sol.x[1]
-
-                # stats
-                dof = data['all']['wv'][i:].shape[0]
-                chi2 = utils.chi_squared(data['soss']['rprs2'][i:], data['soss']['rprs2_err'][i:], rprs2_soss[i:]+sol.x[0]) \
-                     + utils.chi_squared(data['g395h']['rprs2'][:], data['g395h']['rprs2_err'][:], rprs2_g395h[:]+sol.x[1])
-                rchi2 = chi2/dof
-                p = distributions.chi2.sf(chi2, dof)
-                sig = norm.ppf(1 - p)
-                models_r[model][case]['split']['rchi2'] = rchi2
-                models_r[model][case]['split']['p'] = p
-                models_r[model][case]['split']['sig'] = sig
-
-        model = 'flat'
-        case = 'all'
-        models_r[model] = {}
-        rprs2[:] = 0.002944
-        models_r[model][case] = {}
-        models_r[model][case]['wv'] = data['all']['wv']
-        models_r[model][case]['rprs2'] = rprs2
-
-        init = np.array([1e-5])
-        args = (data['all']['rprs2'][i:], data['all']['rprs2_err'][i:], rprs2[i:])
-        sol = optimize.minimize(stats_objective, init, method = 'Nelder-Mead', args = args)
-        assert sol.success
-        models_r[model][case]['offset'] = sol.x[0]
-
-        dof = data['all']['wv'][i:].shape[0]
-        chi2 = utils.chi_squared(data['all']['rprs2'][i:], data['all']['rprs2_err'][i:], rprs2[i:]+sol.x[0])
-        rchi2 = chi2/dof
-        p = distributions.chi2.sf(chi2, dof)
-        sig = norm.ppf(1 - p)
-        models_r[model][case]['rchi2'] = rchi2
-        models_r[model][case]['p'] = p
-        models_r[model][case]['sig'] = sig
-
-        rprs2_soss[:] = 0.002944
-        rprs2_g395h[:] = 0.002944
-        init = np.array([1e-5,1e-5])
-        args = (i,data,rprs2_soss,rprs2_g395h)
-        sol = optimize.minimize(stats_objective_1, init, method = 'Nelder-Mead', args = args)
-        assert sol.success
-        models_r[model][case]['split'] = {}
-        models_r[model][case]['split']['wv_soss'] = data['soss']['wv']
-        models_r[model][case]['split']['rprs2_soss'] = rprs2_soss
-        models_r[model][case]['split']['wv_g395h'] = data['g395h']['wv']
-        models_r[model][case]['split']['rprs2_g395h'] = rprs2_g395h
-        models_r[model][case]['split']['offset_soss'] = sol.x[0]
-        models_r[model][case]['split']['offset_g395h'] = sol.x[1]
-
-        # stats
-        dof = data['all']['wv'][i:].shape[0]
-        chi2 = utils.chi_squared(data['soss']['rprs2'][i:], data['soss']['rprs2_err'][i:], rprs2_soss[i:]+sol.x[0]) \
-             + utils.chi_squared(data['g395h']['rprs2'][:], data['g395h']['rprs2_err'][:], rprs2_g395h[:]+sol.x[1])
-        rchi2 = chi2/dof
-        p = distributions.chi2.sf(chi2, dof)
-        sig = norm.ppf(1 - p)
-        models_r[model][case]['split']['rchi2'] = rchi2
-        models_r[model][case]['split']['p'] = p
-        models_r[model][case]['split']['sig'] = sig
+        for j,(model, case) in enumerate(names):
+            if model not in models_r:
+                models_r[model] = {}
+            models_r[model][case] = statistics_entry(data, rprs2_b['all'][j], rprs2_b['soss'][j], rprs2_b['g395h'][j], single, split, j)
 
         models_binned[i] = models_r
 
@@ -214,6 +265,7 @@ def main():
     out_stats_file = 'results/spectra/spectra_stats.pkl'
     compute_spectra(add_water_cloud, add_all_clouds, outfile)
     compute_statistics(outfile, out_stats_file)
+    compute_statistics(outfile, 'results/spectra/spectra_stats_native.pkl', 'native')
 
     add_water_cloud = False
     add_all_clouds = True
@@ -221,6 +273,7 @@ def main():
     out_stats_file = 'results/spectra/spectra_cloudy_stats.pkl'
     compute_spectra(add_water_cloud, add_all_clouds, outfile)
     compute_statistics(outfile, out_stats_file)
+    compute_statistics(outfile, 'results/spectra/spectra_cloudy_stats_native.pkl', 'native')
 
 if __name__ == '__main__':
     main()
@@ -9,6 +9,8 @@ from photochem import Atmosphere, PhotoException
 from photochem.clima import AdiabatClimate
 import utils
 import planets
+import results_io
+import climacache
 from photochem.utils._format import FormatSettings_main, MyDumper, Loader, yaml
 
 
@@ -44,9 +46,10 @@ def rhs_alt(P, u, mubar, radius, mass, pt):
 
     return np.array([dz_dP])
 
-def chemical_equilibrium_PT(P, T, ct_file, atoms, M_H_metalicity, CtoO):
+def chemical_equilibrium_PT(P, T, ct_file, atoms, M_H_metalicity, CtoO, gas=None):
     '''Given a P-T profile and metalicity, this function computes chemical
     chemical equilibrium for the entire atmospheric column. CGS units.
+    A cantera Solution for `ct_file` can be passed as `gas` to save reloading it.
     '''
 
     comp = utils.composition_from_metalicity_for_atoms(atoms, M_H_metalicity)
@@ -57,7 +60,8 @@ def chemical_equilibrium_PT(P, T, ct_file, atoms, M_H_metalicity, CtoO):
     comp['C'] = comp['C'] + a
     comp['O'] = comp['O'] - a
     
-    gas = ct.Solution(ct_file)
+    if gas is None:
+        gas = ct.Solution(ct_file)
 
     mubar = np.empty(P.shape[0])
     equi = {}
@@ -89,7 +93,7 @@ def altitude_profile_PT(P, T, radius, mass, mubar):
 
     return z
 
-def write_atmosphere_file(filename, alt, press, den, temp, eddy, mix):
+def write_atmosphere_file(filename, alt, press, den, temp, eddy, mix, num_fmt='%e'):
 
     fmt = '{:25}'
     with open(filename, 'w') as f:
@@ -105,14 +109,14 @@ def write_atmosphere_file(filename, alt, press, den, temp, eddy, mix):
         f.write('\n')
 
         for i in range(press.shape[0]):
-            f.write(fmt.format('%e'%alt[i]))
-            f.write(fmt.format('%e'%press[i]))
-            f.write(fmt.format('%e'%den[i]))
-            f.write(fmt.format('%e'%temp[i]))
-            f.write(fmt.format('%e'%eddy[i]))
+            f.write(fmt.format(num_fmt%alt[i]))
+            f.write(fmt.format(num_fmt%press[i]))
+            f.write(fmt.format(num_fmt%den[i]))
+            f.write(fmt.format(num_fmt%temp[i]))
+            f.write(fmt.format(num_fmt%eddy[i]))
 
             for key in mix:
-                f.write(fmt.format('%e'%mix[key][i]))
+                f.write(fmt.format(num_fmt%mix[key][i]))
 
             f.write('\n')
 
@@ -150,12 +154,15 @@ def write_quench_settings_file(settings_in, settings_out, surf, min_mix, sp_to_e
     with open(settings_out,'w') as f:
         yaml.dump(out, f, Dumper=MyDumper ,sort_keys=False, width=70)
 
-def write_quench_files(settings_in, settings_out, atmosphere_out, P, T, M_H_metalicity, CtoO, ct_file, atoms, min_mix, nz, eddy):
+def write_quench_files(settings_in, settings_out, atmosphere_out, P, T, M_H_metalicity, CtoO, ct_file, atoms, min_mix, nz, eddy, equilibrium=None):
+    "`equilibrium` is (equi, surf, mubar) on P, if it has already been computed."
 
     radius = planets.k2_18b.radius*(constants.R_earth.value)*1e2
     mass = planets.k2_18b.mass*(constants.M_earth.value)*1e3
 
-    equi, surf, mubar = chemical_equilibrium_PT(P, T, ct_file, atoms, M_H_metalicity, CtoO)
+    if equilibrium is None:
+        equilibrium = chemical_equilibrium_PT(P, T, ct_file, atoms, M_H_metalicity, CtoO)
+    equi, surf, mubar = equilibrium
     z = altitude_profile_PT(P, T, radius, mass, mubar[0])
     write_quench_settings_file(settings_in, settings_out, surf, min_mix, ['H2'], z[-1], nz, P[0])
 
@@ -166,8 +173,7 @@ def write_quench_files(settings_in, settings_out, atmosphere_out, P, T, M_H_meta
     eddy_ = np.ones(P.shape[0])*eddy
     write_atmosphere_file(atmosphere_out, alt, press, den, temp, eddy_, equi)
 
-def P_T_from_file(filename, P_bottom, P_top):
-    nz = 100
+def P_T_from_file(filename, P_bottom, P_top, nz=100):
 
     with open(filename,'rb') as f:
         out = pickle.load(f)
@@ -232,7 +238,7 @@ def integrate_quench_equilibrium(pc, P, T, P_top):
         # Manually stop integration, if desired.
         pass
 
-def make_clima_profile_from_quench(c, pc, T_trop, P_top):
+def make_clima_profile_from_quench(c, pc, T_trop, P_top, clima_cache=None):
     
     surf = {}
     for sp in pc.dat.species_names[:-2]:
@@ -252,29 +258,43 @@ def make_clima_profile_from_quench(c, pc, T_trop, P_top):
     c.RH = np.ones(len(c.species_names))
     c.P_top = P_top
     T_surf = pc.var.temperature[-1]
-    c.make_profile_bg_gas(T_surf, P_i, P_surf, bg_gas)
+    prof = climacache.make_profile_bg_gas(c, T_surf, P_i, P_surf, bg_gas, clima_cache)
 
     # Find pressure where H2O condenses
-    ind = c.species_names.index('H2O')
-    assert c.f_i[0,ind] == c.f_i[1,ind]
+    ind = prof.species_names.index('H2O')
+    assert prof.f_i[0,ind] == prof.f_i[1,ind]
 
-    for i in range(c.f_i[:,ind].shape[0]):
-        if c.f_i[i,ind] < c.f_i[0,ind]:
+    for i in range(prof.f_i[:,ind].shape[0]):
+        if prof.f_i[i,ind] < prof.f_i[0,ind]:
             ind1 = i
-            P_condense = c.P[ind1]
+            P_condense = prof.P[ind1]
             break
 
-    P_trop = c.P_trop
+    P_trop = prof.P_trop
+
+    return surf, P_condense, P_trop, prof
 
-    return surf, P_condense, P_trop
+def write_clima_atmosphere_file(filename, prof, eddy):
+    """Writes a photochem atmosphere file from a climacache.ClimaProfile, at full
+    precision so that a cached profile gives the same file as a new one.
+    """
+    mix = {}
+    for i,sp in enumerate(prof.species_names):
+        mix[sp] = np.maximum(prof.f_i[:,i],1e-40)
+    alt = prof.z/1e5 # to km
+    press = prof.P/1e6 # to bar
+    den = prof.P/(const.Boltzmann*1e7*prof.T)
+    write_atmosphere_file(filename, alt, press, den, prof.T, eddy, mix, '%.16e')
 
-def write_photochem_settings_file(settings_in, settings_out, surf, min_mix, sp_to_exclude, top, P_surf, P_condense, P_trop):
+def write_photochem_settings_file(settings_in, settings_out, surf, min_mix, sp_to_exclude, top, P_surf, P_condense, P_trop, nz=None):
 
     fil = open(settings_in,'r')
     settings = yaml.load(fil,Loader=Loader)
     fil.close()
 
     settings['atmosphere-grid']['top'] = float(top)
+    if nz is not None:
+        settings['atmosphere-grid']['number-of-layers'] = int(nz)
     settings['planet']['surface-pressure'] = float(P_surf/1e6)
 
     # boundary conditions
@@ -289,7 +309,11 @@ def write_photochem_settings_file(settings_in, settings_out, surf, min_mix, sp_t
     with open(settings_out,'w') as f:
         yaml.dump(out, f, Dumper=MyDumper ,sort_keys=False, width=70)
 
-def make_picaso_input_neptune(outfile):
+def make_picaso_input_neptune(outfile, rt_grid_tol=None):
+    """Writes the quench and photochem atmospheres as one picaso atmosphere. If `rt_grid_tol`
+    is given (see `utils.default_rt_grid_tol`), it is compacted to fewer layers
+    (see `utils.compact_picaso_input`).
+    """
     pc1 = Atmosphere('input/zahnle_earth_new_noparticles.yaml',\
                     outfile+'_settings_quench.yaml',\
                     "input/k2_18b_stellar_flux.txt",\
@@ -299,12 +323,19 @@ def make_picaso_input_neptune(outfile):
                     "input/k2_18b_stellar_flux.txt",\
                     outfile+'_atmosphere_photochem_c.txt')
     
+    # The quench model extends above the bottom of the photochem model. When
+    # compacting, keep only the photochem model where they overlap, so the
+    # new grid does not resolve the jumps between the two.
+    q = np.ones(pc1.wrk.pressure.shape[0], dtype=bool)
+    if rt_grid_tol is not None:
+        q = pc1.wrk.pressure > np.max(pc2.wrk.pressure)
+
     mix = {}
-    mix['press'] = np.append(pc1.wrk.pressure,pc2.wrk.pressure)
-    mix['temp'] = np.append(pc1.var.temperature,pc2.var.temperature)
+    mix['press'] = np.append(pc1.wrk.pressure[q],pc2.wrk.pressure)
+    mix['temp'] = np.append(pc1.var.temperature[q],pc2.var.temperature)
     for i,sp in enumerate(pc1.dat.species_names[pc1.dat.np:-2]):
         ind = pc1.dat.species_names.index(sp)
-        tmp1 = pc1.wrk.densities[ind,:]/pc1.wrk.density
+        tmp1 = pc1.wrk.densities[ind,q]/pc1.wrk.density[q]
 
         ind = pc2.dat.species_names.index(sp)
         tmp2 = pc2.wrk.densities[ind,:]/pc2.wrk.density
@@ -312,27 +343,133 @@ def make_picaso_input_neptune(outfile):
         mix[sp] = np.append(tmp1,tmp2)
 
     species = pc1.dat.species_names[pc1.dat.np:-2]
-    utils.write_picaso_atmosphere(mix, outfile+'_picaso.pt', species)
+    df = utils.picaso_atmosphere(mix, species)
+    if rt_grid_tol is not None:
+        df = utils.compact_picaso_input(df, rt_grid_tol, outfile)
+    utils.write_picaso_table(df, outfile+'_picaso.pt', 25)
+    return df
     
 
+def default_grid_tol():
+    "Target accuracy of adaptive grids."
+    grid_tol = {}
+    grid_tol['T'] = 5.0 # K
+    grid_tol['log10mix'] = 0.1 # dex
+    grid_tol['log10edd'] = 0.1 # dex
+    grid_tol['min_mix'] = 1.0e-10 # species less abundant than this are ignored
+    return grid_tol
+
+def adaptive_quench_grid(P, T, ct_file, atoms, M_H_metalicity, CtoO, grid_tol):
+    """Given a finely resolved P-T profile, picks the pressure levels for the
+    equilibrium chemistry and the number of quench model layers from
+    gradients in T and in the equilibrium mixing ratios. Also returns the
+    equilibrium (equi, surf, mubar) interpolated to the new levels, so that
+    it does not need to be computed again.
+    """
+    radius = planets.k2_18b.radius*(constants.R_earth.value)*1e2
+    mass = planets.k2_18b.mass*(constants.M_earth.value)*1e3
+
+    equi, surf, mubar = chemical_equilibrium_PT(P, T, ct_file, atoms, M_H_metalicity, CtoO)
+    profiles = [T]
+    tols = [grid_tol['T']]
+    for sp in equi:
+        if np.max(equi[sp]) > grid_tol['min_mix']:
+            profiles.append(np.log10(np.maximum(equi[sp],1e-40)))
+            tols.append(grid_tol['log10mix'])
+
+    P_new = utils.adaptive_log_pressure_grid(P, profiles, tols, nz_max=P.shape[0])
+    T_new = np.interp(np.log10(P_new).copy()[::-1], np.log10(P).copy()[::-1], T.copy()[::-1])
+    T_new = T_new.copy()[::-1]
+
+    # Equilibrium on the new levels. The levels are placed so that this
+    # interpolation is within tolerance.
+    x = np.log10(P).copy()[::-1]
+    x_new = np.log10(P_new).copy()[::-1]
+    equi_new = {}
+    for sp in equi:
+        tmp = np.interp(x_new, x, np.log10(np.maximum(equi[sp],1e-300)).copy()[::-1])
+        equi_new[sp] = 10.0**tmp.copy()[::-1]
+    mubar_new = np.interp(x_new, x, mubar.copy()[::-1]).copy()[::-1]
+    surf_new = {sp: equi_new[sp][0] for sp in equi_new}
+
+    z = altitude_profile_PT(P, T, radius, mass, mubar[0])
+    nz_q = utils.adaptive_layer_count(z, profiles, tols, nz_min=10, nz_max=100)
+    return P_new, T_new, nz_q, (equi_new, surf_new, mubar_new)
+
+def photochem_profiles(T, edd, mix, grid_tol):
+    "Profiles that set the photochem grid, and their tolerances."
+    profiles = [T, np.log10(edd)]
+    tols = [grid_tol['T'], grid_tol['log10edd']]
+    for sp in mix:
+        if np.max(mix[sp]) > grid_tol['min_mix']:
+            profiles.append(np.log10(np.maximum(mix[sp],1e-40)))
+            tols.append(grid_tol['log10mix'])
+    return profiles, tols
+
+def photochem_layer_count(z, T, edd, mix, grid_tol, nz_min=20, nz_max=200):
+    """Number of photochem layers needed to represent T, eddy diffusion and
+    mixing ratios (dict of profiles) on the altitude grid z.
+    """
+    profiles, tols = photochem_profiles(T, edd, mix, grid_tol)
+    return utils.adaptive_layer_count(z, profiles, tols, nz_min, nz_max)
+
+def integrate_photochem_equilibrium(pc, prof, eddy, equilibrium_time):
+    pc.var.custom_binary_diffusion_fcn = utils.custom_binary_diffusion_fcn
+    pc.var.equilibrium_time = equilibrium_time
+    pc.var.atol = 1e-25
+    pc.var.rtol = 1e-3
+    pc.initialize_stepper(pc.wrk.usol)
+    tn = 0.0
+    counter = 0
+    nsteps = 0
+    try:
+        while tn < pc.var.equilibrium_time:
+            tn = pc.step()
+            counter += 1
+            nsteps += 1
+            if nsteps > 50_000:
+                # call it converged
+                break
+            if counter > 3000:
+                print(nsteps)
+                pc.update_vertical_grid(TOA_pressure=1e-8*1e6)
+                pc.set_press_temp_edd(prof.P, prof.T, eddy, prof.P_trop)
+                pc.initialize_stepper(pc.wrk.usol)
+                counter = 0
+    except KeyboardInterrupt:
+        # Manually stop integration, if desired.
+        pass
+
 def run_quench_photochem_model(settings_quench_in, settings_photochem_in, PTfile_in, outfile, P_bottom, P_top, M_H_metalicity, 
                                CtoO, ct_file, atoms, min_mix, nz_q, eddy_q,
-                               T_trop, P_top_clima, eddy_p, equilibrium_time):
-                               
+                               T_trop, P_top_clima, eddy_p, equilibrium_time, clima_cache=None, grid_tol=None, store=None, rt_grid_tol=None):
+    """If `grid_tol` is given (see `default_grid_tol`), the equilibrium chemistry
+    levels and the number of quench and photochem layers are chosen adaptively.
+    Otherwise `nz_q` and the layer count in the settings template are used.
+    If `store` is a directory, the quench and photochem results are also
+    appended to a results_io.ResultStore there. `rt_grid_tol` compacts the
+    picaso atmosphere (see `utils.default_rt_grid_tol`).
+    """
     settings_quench_out = outfile+"_settings_quench.yaml"
     settings_photochem_out = outfile+"_settings_photochem.yaml"
     atmosphere_quench_out = outfile+"_atmosphere_quench.txt"
     atmosphere_photochem_out = outfile+"_atmosphere_photochem.txt"
 
     P, T = P_T_from_file(PTfile_in, P_bottom, P_top)
-    write_quench_files(settings_quench_in, settings_quench_out, atmosphere_quench_out, P, T, M_H_metalicity, CtoO, ct_file, atoms, min_mix, nz_q, eddy_q)
+    equilibrium = None
+    if grid_tol is not None:
+        P, T, nz_q, equilibrium = adaptive_quench_grid(P, T, ct_file, atoms, M_H_metalicity, CtoO, grid_tol)
+        print('Adaptive grid: %i equilibrium levels, %i quench layers'%(P.shape[0], nz_q))
+    write_quench_files(settings_quench_in, settings_quench_out, atmosphere_quench_out, P, T, M_H_metalicity, CtoO, ct_file, atoms, min_mix, nz_q, eddy_q, equilibrium)
 
     pc_q = Atmosphere('input/zahnle_earth_new_noparticles.yaml',\
                     settings_quench_out,\
                     "input/k2_18b_stellar_flux.txt",\
                     atmosphere_quench_out)
     pc_q.var.custom_binary_diffusion_fcn = utils.custom_binary_diffusion_fcn
+    results_io.write_photochem_result(outfile+'_quench_eq_result.npz', pc_q)
     integrate_quench_equilibrium(pc_q, P, T, P_top)
+    results_io.write_photochem_result(outfile+'_quench_result.npz', pc_q)
 
     atmosphere_out_c = outfile+"_atmosphere_quench_c.txt"
     pc_q.out2atmosphere_txt(atmosphere_out_c, overwrite=True)
@@ -348,52 +485,69 @@ def run_quench_photochem_model(settings_quench_in, settings_photochem_in, PTfile
                        'input/neptune/settings_quench_climate.yaml',
                        'input/k2_18b_stellar_flux.txt')
     
-    surf, P_condense, P_trop = make_clima_profile_from_quench(c, pc_q, T_trop, P_top_clima)
+    surf, P_condense, P_trop, prof = make_clima_profile_from_quench(c, pc_q, T_trop, P_top_clima, clima_cache)
 
     settings_in = 'input/neptune/settings_neptune_photochem_template.yaml'
     min_mix_photochem = 1e-20
     sp_to_exclude = ['H2']
-    write_photochem_settings_file(settings_photochem_in, settings_photochem_out, surf, min_mix_photochem, sp_to_exclude, c.z[-1], c.P_surf, P_condense, P_trop)
-
-    log10P_trop = np.log10(c.P_trop/1e6)
-    log10P = np.log10(c.P/1e6)
+    log10P_trop = np.log10(prof.P_trop/1e6)
+    log10P = np.log10(prof.P/1e6)
     Kzz_trop = eddy_p
     eddy_ = utils.simple_eddy_diffusion_profile(log10P, log10P_trop, Kzz_trop)
-    c.out2atmosphere_txt(atmosphere_photochem_out, eddy_, overwrite=True)
+
+    nz_p = None
+    if grid_tol is not None:
+        mix = {sp: prof.f_i[:,i] for i,sp in enumerate(prof.species_names)}
+        nz_p = photochem_layer_count(prof.z, prof.T, eddy_, mix, grid_tol)
+        print('Adaptive grid: %i photochem layers'%(nz_p))
+    write_photochem_settings_file(settings_photochem_in, settings_photochem_out, surf, min_mix_photochem, sp_to_exclude, prof.z[-1], prof.P_surf, P_condense, P_trop, nz_p)
+    write_clima_atmosphere_file(atmosphere_photochem_out, prof, eddy_)
 
     pc = Atmosphere('input/zahnle_earth_new_S8.yaml',\
                     settings_photochem_out,\
                     "input/k2_18b_stellar_flux.txt",\
                     atmosphere_photochem_out)
-    pc.var.custom_binary_diffusion_fcn = utils.custom_binary_diffusion_fcn
-    pc.var.equilibrium_time = equilibrium_time
-    pc.var.atol = 1e-25
-    pc.var.rtol = 1e-3
-    pc.initialize_stepper(pc.wrk.usol)
-    tn = 0.0
-    counter = 0
-    nsteps = 0
-    try:
-        while tn < pc.var.equilibrium_time:
-            tn = pc.step()
-            counter += 1
-            nsteps += 1
-            if nsteps > 50_000:
-                # call it converged
-                break
-            if counter > 3000:
-                print(nsteps)
-                pc.update_vertical_grid(TOA_pressure=1e-8*1e6)
-                pc.set_press_temp_edd(c.P, c.T, eddy_, c.P_trop)
-                pc.initialize_stepper(pc.wrk.usol)
-                counter = 0
-    except KeyboardInterrupt:
-        # Manually stop integration, if desired.
-        pass
+    integrate_photochem_equilibrium(pc, prof, eddy_, equilibrium_time)
+
+    if grid_tol is not None:
+        # The converged solution can have structure (e.g. photochemical products
+        # in the upper atmosphere) that the clima profile did not. If so, regrid
+        # the converged solution to more layers and finish converging there.
+        # The need is judged from the curvature of the solution on its own grid.
+        mix = {}
+        for i,sp in enumerate(pc.dat.species_names[pc.dat.np:-2]):
+            ind = pc.dat.species_names.index(sp)
+            mix[sp] = pc.wrk.densities[ind,:]/pc.wrk.density
+        profiles, tols = photochem_profiles(pc.var.temperature, pc.var.edd, mix, grid_tol)
+        nz_needed = utils.resolved_layer_count(profiles, tols, nz_p)
+        if nz_needed > nz_p:
+            print('Adaptive grid: regridding converged solution to %i photochem layers'%(nz_needed))
+            atmosphere_regrid = outfile+"_atmosphere_photochem_regrid.txt"
+            pc.out2atmosphere_txt(atmosphere_regrid, overwrite=True)
+            with open(settings_photochem_out,'r') as f:
+                settings = yaml.load(f,Loader=Loader)
+            settings['atmosphere-grid']['top'] = float(pc.var.top_atmos)
+            settings['atmosphere-grid']['number-of-layers'] = int(nz_needed)
+            settings = FormatSettings_main(settings)
+            with open(settings_photochem_out,'w') as f:
+                yaml.dump(settings, f, Dumper=MyDumper ,sort_keys=False, width=70)
+            pc = Atmosphere('input/zahnle_earth_new_S8.yaml',\
+                            settings_photochem_out,\
+                            "input/k2_18b_stellar_flux.txt",\
+                            atmosphere_regrid)
+            integrate_photochem_equilibrium(pc, prof, eddy_, equilibrium_time)
 
     # save result
     atmosphere_out_c = outfile+"_atmosphere_photochem_c.txt"
     pc.out2atmosphere_txt(atmosphere_out_c,overwrite=True)
+    results_io.write_photochem_result(outfile+'_photochem_result.npz', pc)
+    if store is not None:
+        key = {'outfile': outfile, 'PTfile_in': PTfile_in, 'M_H_metalicity': M_H_metalicity, 'CtoO': CtoO,
+               'eddy_q': eddy_q, 'T_trop': T_trop, 'eddy_p': eddy_p}
+        arrays = results_io.photochem_arrays(pc)
+        for k, v in results_io.photochem_arrays(pc_q).items():
+            arrays['quench_'+k] = v
+        results_io.ResultStore(store).append(key, arrays)
 
     # Alter settings file with updated TOA
     with open(settings_photochem_out,'r') as f:
@@ -404,13 +558,17 @@ def run_quench_photochem_model(settings_quench_in, settings_photochem_in, PTfile
         yaml.dump(settings, f, Dumper=MyDumper ,sort_keys=False, width=70)
 
     # write picaso file
-    make_picaso_input_neptune(outfile)
+    make_picaso_input_neptune(outfile, rt_grid_tol)
 
     # make file for clouds
     haze_file = outfile+'_clouds.txt'
     make_cloud_file(pc, pc_q, P_trop, P_condense, haze_file)
     
-def make_cloud_file(pc, pc_q, P_trop, P_condense, outfile):
+def make_cloud_file(pc, pc_q, P_trop, P_condense, outfile=None, size_distributions={}):
+    """Returns the picaso cloud DataFrame, and writes it to `outfile` if given.
+    `size_distributions` replaces the single particle radius of any of the
+    'H2O', 'HC' and 'S' aerosols (see `utils.size_distribution`).
+    """
 
     particle_radius = {}
     col = {}
@@ -472,7 +630,8 @@ def make_cloud_file(pc, pc_q, P_trop, P_condense, outfile):
     for key in col:
         col[key] = col[key][:-1].copy()
     
-    utils.make_haze_opacity_file(pressure, col, particle_radius, outfile)
+    particle_radius.update(size_distributions)
+    return utils.make_haze_opacity_file(pressure, col, particle_radius, outfile)
 
 def default_params():
     params = {}
@@ -493,6 +652,9 @@ def default_params():
     params['P_top_clima'] = 5.0e-4
     params['eddy_p'] = 5.0e5 # choosen arbitrarily
     params['equilibrium_time'] = 1e17
+    params['grid_tol'] = None # e.g. default_grid_tol() for adaptive grids
+    params['store'] = None # results_io.ResultStore directory
+    params['rt_grid_tol'] = None # e.g. utils.default_rt_grid_tol() for fewer picaso layers
     return params
 
 def nominal_S():
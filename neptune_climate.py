@@ -7,13 +7,23 @@ import numpy as np
 import planets
 import utils
 import pickle
+import glob
+import os
+import re
 from threadpoolctl import threadpool_limits
-from pathos.multiprocessing import ProcessingPool as Pool
+from supervisor import SupervisedPool
 
 def make_outfile_name(mh, CtoO, tint):
     outfile = 'MH=%.3f_CO=%.3f_Tint=%.1f.pkl'%(mh, CtoO, tint)
     return outfile
 
+def parse_outfile_name(filename):
+    "Inverse of `make_outfile_name`. Returns None if the name does not match."
+    m = re.match(r'MH=(.+)_CO=(.+)_Tint=(.+)\.pkl$', os.path.basename(filename))
+    if m is None:
+        return None
+    return tuple(float(a) for a in m.groups())
+
 class NeptuneClimate():
 
     def __init__(self):
@@ -24,6 +34,70 @@ class NeptuneClimate():
         self.p_bottom = 3 # log10(bars)
         self.database_dir = 'input/picaso/climate/'
         self.outfolder = 'results/neptune/climate/'
+        # Start from the nearest converged result in `outfolder`, if there is one
+        self.warm_start = False
+        # Distances in (mh, C/O, Tint) are divided by these when finding the nearest result
+        self.warm_start_scales = (1.0, 1.0, 50.0)
+
+    def nearest_result(self, mh, CtoO, tint):
+        """Finds the converged result in `outfolder` closest to (mh, CtoO, tint),
+        other than the result for (mh, CtoO, tint) itself. Files that can't be
+        read are skipped. Returns (filename, result), or (None, None).
+        """
+        own = make_outfile_name(mh, CtoO, tint)
+        candidates = []
+        for filename in glob.glob(self.outfolder+'*.pkl'):
+            params = parse_outfile_name(filename)
+            if params is None or os.path.basename(filename) == own:
+                continue
+            dist = np.sqrt(np.sum(((np.array(params) - np.array([mh, CtoO, tint]))/np.array(self.warm_start_scales))**2))
+            candidates.append((dist, filename))
+
+        for dist, filename in sorted(candidates):
+            try:
+                with open(filename,'rb') as f:
+                    out = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+            return filename, out
+        return None, None
+
+    def convective_zones_match(self, out):
+        "True if the convective zones of result `out` can be used as the guess for this model."
+        if 'cvz_locs' not in out or len(out['pressure']) != self.nlevel:
+            return False
+        if out.get('nofczns') != self.nofczns:
+            return False
+        # cvz_locs is [0, top, bottom, top, bottom, ...], zero past the last zone
+        nzones = np.count_nonzero(np.array(out['cvz_locs'])[1:])//2
+        return nzones == self.nofczns
+
+    def initial_guess(self, cl_run, mh, CtoO, tint):
+        """Returns the initial temperature, pressure and convective zone guess,
+        and the file used for a warm start (None for a cold start).
+        """
+        nlevel = self.nlevel # number of plane-parallel levels in your code
+        Teq = planets.k2_18b.Teq # planet equilibrium temperature
+        pt = cl_run.guillot_pt(Teq, nlevel=nlevel, T_int = tint, p_bottom=self.p_bottom, p_top=-6)
+        temp_guess = pt['temperature'].values
+        pressure = pt['pressure'].values
+
+        nstr_upper = self.nstr_upper # top most level of guessed convective zone
+        nstr_deep = nlevel -2 # this is always the case. Dont change this
+        nstr = np.array([0,nstr_upper,nstr_deep,0,0,0]) # initial guess of convective zones
+
+        if not self.warm_start:
+            return temp_guess, pressure, nstr, None
+
+        filename, out = self.nearest_result(mh, CtoO, tint)
+        if filename is None:
+            return temp_guess, pressure, nstr, None
+
+        # Interpolate the converged profile to the new pressure grid
+        temp_guess = np.interp(np.log10(pressure), np.log10(out['pressure']), out['temperature'])
+        if self.convective_zones_match(out):
+            nstr = np.array(out['cvz_locs'])
+        return temp_guess, pressure, nstr, filename
 
     def run_climate_model(self, mh, CtoO, tint):
         print(mh, CtoO, tint)
@@ -58,16 +132,8 @@ class NeptuneClimate():
                     radius_unit=u.R_sun,semi_major= semi_major , semi_major_unit = u.AU, database='phoenix')
 
         # Initial temperature guess
-        nlevel = self.nlevel # number of plane-parallel levels in your code
-        Teq = planets.k2_18b.Teq # planet equilibrium temperature
-        pt = cl_run.guillot_pt(Teq, nlevel=nlevel, T_int = tint, p_bottom=self.p_bottom, p_top=-6)
-        temp_guess = pt['temperature'].values
-        pressure = pt['pressure'].values
-
+        temp_guess, pressure, nstr, warm_file = self.initial_guess(cl_run, mh, CtoO, tint)
         nofczns = self.nofczns # number of convective zones initially. Let's not play with this for now.
-        nstr_upper = self.nstr_upper # top most level of guessed convective zone
-        nstr_deep = nlevel -2 # this is always the case. Dont change this
-        nstr = np.array([0,nstr_upper,nstr_deep,0,0,0]) # initial guess of convective zones
         rfacv = self.rfacv
 
         # Set inputs
@@ -75,16 +141,43 @@ class NeptuneClimate():
                         nstr = nstr, nofczns = nofczns , rfacv = rfacv)
 
         # Run model
-        out = cl_run.climate(opacity_ck)
+        out = cl_run.climate(opacity_ck, save_all_profiles=True)
+
+        # Report the number of iterations
+        niters = len(out['all_profiles'])//self.nlevel
+        out['warm_start'] = warm_file
+        out['iterations'] = niters
+        out['nofczns'] = nofczns
+        if warm_file is None:
+            print('Cold start: %i iterations'%(niters))
+        else:
+            print('Warm start from %s: %i iterations'%(warm_file, niters))
 
-        # save output
+        # save output. Written to a temporary file first, so other workers
+        # looking for a warm start never load a partial file
         outfile = self.outfolder+make_outfile_name(mh, CtoO, tint)
-        with open(outfile,'wb') as f:
+        tmp = outfile+'.%i.tmp'%os.getpid()
+        with open(tmp,'wb') as f:
             pickle.dump(out,f)
+        os.replace(tmp, outfile)
+
+def run_climate_model(mh, CtoO, tint, **settings):
+    "Runs one climate model. `settings` overwrite NeptuneClimate attributes."
+    nc = NeptuneClimate()
+    for key in settings:
+        setattr(nc, key, settings[key])
+    nc.run_climate_model(mh, CtoO, tint)
+
+def retry_settings():
+    "Alternative solver settings to try if a climate model fails."
+    retries = [
+        {'nstr_upper': 80, 'rfacv': 0.5},
+        {'nstr_upper': 75, 'rfacv': 0.0}
+    ]
+    return retries
 
 def main():
     threadpool_limits(limits=1)
-    nc = NeptuneClimate()
 
     mhs = [2.0]
     CtoOs = [1.0]
@@ -93,12 +186,13 @@ def main():
     for mh in mhs:
         for CtoO in CtoOs:
             for tint in tints:
-                inputs.append((mh, CtoO, tint))
+                inputs.append({'mh': mh, 'CtoO': CtoO, 'tint': tint})
     
-    def wrap(params):
-        nc.run_climate_model(*params)
-    p = Pool(1)
-    p.map(wrap, inputs)
+    p = SupervisedPool(1, retries=retry_settings())
+    results = p.map(run_climate_model, inputs)
+    for params, res in zip(inputs, results):
+        if not res['success']:
+            print('Failed: '+make_outfile_name(params['mh'], params['CtoO'], params['tint'])+'\n'+res['error'])
 
 if __name__ == '__main__':
     main()
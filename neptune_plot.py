@@ -1,25 +1,14 @@
 import numpy as np
 from matplotlib import pyplot as plt
-from photochem import Atmosphere
+import results_io
 import neptune
 
 def figure3():
     params = neptune.nominal_S()
 
-    pc_eq = Atmosphere('input/zahnle_earth_new_noparticles.yaml',\
-                        params['outfile']+'_settings_quench.yaml',\
-                        "input/k2_18b_stellar_flux.txt",\
-                        params['outfile']+'_atmosphere_quench.txt')
-
-    pc1 = Atmosphere('input/zahnle_earth_new_noparticles.yaml',\
-                        params['outfile']+'_settings_quench.yaml',\
-                        "input/k2_18b_stellar_flux.txt",\
-                        params['outfile']+'_atmosphere_quench_c.txt')
-
-    pc2 = Atmosphere('input/zahnle_earth_new_S8.yaml',\
-                    params['outfile']+'_settings_photochem.yaml',\
-                    "input/k2_18b_stellar_flux.txt",\
-                    params['outfile']+'_atmosphere_photochem_c.txt')
+    res_eq = results_io.AtmosphereResult(params['outfile']+'_quench_eq_result.npz')
+    res1 = results_io.AtmosphereResult(params['outfile']+'_quench_result.npz')
+    res2 = results_io.AtmosphereResult(params['outfile']+'_photochem_result.npz')
     
     plt.rcParams.update({'font.size': 15.5})
     fig,ax = plt.subplots(1,1,figsize=[7,5])
@@ -29,26 +18,23 @@ def figure3():
     names = ['H$_2$O','CH$_4$','CO$_2$','H$_2$','CO','N$_2$','NH$_3$','HCN','H$_2$S','SO$_2$']
     colors = ['C0','C1','C2','C3','C4','C5','C7','C6','C8','C9']
     for i,sp in enumerate(species):
-        ind = pc1.dat.species_names.index(sp)
-        tmp = pc1.wrk.densities[ind,:]/pc1.wrk.density
-        ax.plot(tmp,pc1.wrk.pressure/1e6,label=names[i],c=colors[i], lw=2)
+        tmp = res1.mix(sp)
+        ax.plot(tmp,res1.pressure/1e6,label=names[i],c=colors[i], lw=2)
 
     for i,sp in enumerate(species):
-        ind = pc_eq.dat.species_names.index(sp)
-        tmp = pc_eq.wrk.densities[ind,:]/pc_eq.wrk.density
-        ax.plot(tmp,pc_eq.wrk.pressure/1e6,ls=':',c=colors[i],alpha=0.7)
+        tmp = res_eq.mix(sp)
+        ax.plot(tmp,res_eq.pressure/1e6,ls=':',c=colors[i],alpha=0.7)
 
     for i,sp in enumerate(species):
-        ind = pc2.dat.species_names.index(sp)
-        tmp = pc2.wrk.densities[ind,:]/pc2.wrk.density
-        ax.plot(tmp,pc2.wrk.pressure/1e6,ls='-',c=colors[i], lw=2)
+        tmp = res2.mix(sp)
+        ax.plot(tmp,res2.pressure/1e6,ls='-',c=colors[i], lw=2)
 
 
-    ax.axhline(pc1.wrk.pressure[-1]/1e6, c='k', ls='-', lw=3, alpha=0.5)
+    ax.axhline(res1.pressure[-1]/1e6, c='k', ls='-', lw=3, alpha=0.5)
 
     ax1 = ax.twiny()
-    ax1.plot(pc1.var.temperature, pc1.wrk.pressure/1e6,c='k', ls='--', lw=2)
-    ax1.plot(pc2.var.temperature, pc2.wrk.pressure/1e6,c='k', ls='--', lw=2)
+    ax1.plot(res1.temperature, res1.pressure/1e6,c='k', ls='--', lw=2)
+    ax1.plot(res2.temperature, res2.pressure/1e6,c='k', ls='--', lw=2)
 
     ax1.set_xlabel('Temperature (K)')
 
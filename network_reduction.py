@@ -0,0 +1,261 @@
+import numpy as np
+import os
+import copy
+from photochem import Atmosphere, PhotoException
+from photochem.utils._format import FormatReactions_main, FormatSettings_main, MyDumper, yaml
+
+import utils
+import inputcache
+from rate_diagnostics import RateDiagnostics
+
+def reaction_key(equation):
+    """Direction-independent description of a reaction: the sorted reactants
+    and products without M or hv. Returns the keys of both directions
+    for a reversible reaction.
+    """
+    eq = equation.replace('(+ M)','').replace('(+M)','')
+    reversible = '<=>' in eq
+    if reversible:
+        left, right = eq.split('<=>')
+    else:
+        left, right = eq.split('=>')
+    def side(s):
+        return tuple(sorted(a.strip() for a in s.split('+') if a.strip() not in ['','M','hv']))
+    keys = [(side(left), side(right))]
+    if reversible:
+        keys.append((side(right), side(left)))
+    return keys
+
+def reaction_importance(diag, species):
+    """For every reaction, its largest fractional contribution to the integrated
+    production or loss of any of `species`, from an evaluated RateDiagnostics.
+    Returns a dict of reaction key -> importance.
+    """
+    importance = {}
+    def update(rates):
+        total = np.sum(rates)
+        if total <= 0.0:
+            return
+        for j in np.nonzero(rates)[0]:
+            key = reaction_key(diag.reaction_equations[j])[0]
+            importance[key] = max(importance.get(key, 0.0), rates[j]/total)
+
+    for sp in species:
+        update(diag.integrated_production(sp))
+        update(diag.integrated_loss(sp))
+    return importance
+
+def required_species(settings, key_species, lower_bcs):
+    "Species that must stay: key species, forced boundary conditions and the background gas."
+    keep = set(key_species)
+    keep.add(settings['planet']['background-gas'])
+    for entry in settings.get('boundary-conditions',[]):
+        lb = entry.get('lower-boundary',{})
+        if lb.get('type') in ['mix','flux','press']:
+            keep.add(entry['name'])
+    for sp in lower_bcs:
+        if lower_bcs[sp]['type'] in ['mix','flux','press']:
+            keep.add(sp)
+    return keep
+
+def reduce_network(pc, network_file, settings_file, key_species, eps, lower_bcs={}):
+    """Directed-relation style reduction around the converged state of `pc`.
+    Reaction rates are evaluated once. Starting from the required species, keeps every reaction that contributes
+    at least a fraction `eps` to the production or loss of a kept species, and
+    then every species those reactions involve, until nothing new is added.
+    Returns the kept species (gases and particles) and reaction keys.
+    """
+    network = inputcache.reaction_network(network_file)
+    settings = inputcache.load_yaml(settings_file)
+
+    keep = required_species(settings, key_species, lower_bcs)
+    diag = RateDiagnostics(pc)
+    diag.evaluate(pc.wrk.usol)
+    importance = {}
+    evaluated = set()
+    rx_keep = set()
+    while True:
+        new = [sp for sp in keep if sp not in evaluated and sp in diag.species_inds]
+        if len(new) == 0:
+            break
+        for key, val in reaction_importance(diag, new).items():
+            importance[key] = max(importance.get(key, 0.0), val)
+        evaluated.update(new)
+
+        rx_keep = set(key for key in importance if importance[key] >= eps)
+        for reactants, products in rx_keep:
+            keep.update(reactants)
+            keep.update(products)
+
+        # Saturation particles need their gas
+        for entry in network.get('particles',[]):
+            if entry['name'] in keep and entry['formation'] == 'saturation':
+                keep.add(entry['gas-phase'])
+
+    return keep, rx_keep
+
+def write_reduced_network(network_file, settings_file, network_out, settings_out, keep, rx_keep, pc_ref, lower_bcs={}):
+    """Writes a reaction network with only the kept species and the reactions
+    (in either direction) in `rx_keep`, and a settings file without the
+    boundary conditions and particles of removed species. The settings file
+    gets the grid of `pc_ref` and the lower boundary conditions `lower_bcs`
+    (species -> settings file style lower-boundary dict).
+    """
+    network = copy.deepcopy(inputcache.reaction_network(network_file))
+    network['species'] = [a for a in network['species'] if a['name'] in keep]
+    if 'particles' in network:
+        network['particles'] = [a for a in network['particles'] if a['name'] in keep]
+    reactions = []
+    for rx in network['reactions']:
+        keys = reaction_key(rx['equation'])
+        species = set(keys[0][0] + keys[0][1])
+        if any(key in rx_keep for key in keys) and species.issubset(keep):
+            reactions.append(rx)
+    network['reactions'] = reactions
+
+    out = FormatReactions_main(network)
+    with open(network_out,'w') as f:
+        yaml.dump(out, f, Dumper=MyDumper, sort_keys=False, width=70)
+
+    settings = copy.deepcopy(inputcache.load_yaml(settings_file))
+    settings['atmosphere-grid']['top'] = float(pc_ref.var.top_atmos)
+    settings['atmosphere-grid']['number-of-layers'] = int(pc_ref.var.nz)
+    settings['planet']['surface-pressure'] = float(pc_ref.wrk.pressure[0]/1e6)
+    if 'water' in settings['planet'] and 'tropopause-altitude' in settings['planet']['water']:
+        settings['planet']['water']['tropopause-altitude'] = float(pc_ref.var.trop_alt)
+    if 'particles' in settings:
+        settings['particles'] = [a for a in settings['particles'] if a['name'] in keep]
+    bcs = [a for a in settings.get('boundary-conditions',[]) if a['name'] in keep]
+    for sp in lower_bcs:
+        entry = None
+        for a in bcs:
+            if a['name'] == sp:
+                entry = a
+        if entry is None:
+            entry = {'name': sp, 'upper-boundary': {'type': 'veff', 'veff': 0.0}}
+            bcs.append(entry)
+        entry['lower-boundary'] = dict(lower_bcs[sp])
+    settings['boundary-conditions'] = bcs
+    out = FormatSettings_main(settings)
+    with open(settings_out,'w') as f:
+        yaml.dump(out, f, Dumper=MyDumper, sort_keys=False, width=70)
+
+def write_reduced_atmosphere(pc, filename, keep):
+    "Writes the state of `pc` as an atmosphere file, with only kept species."
+    tmp = filename+'.tmp'
+    pc.out2atmosphere_txt(tmp, overwrite=True)
+    with open(tmp,'r') as f:
+        lines = f.readlines()
+    os.remove(tmp)
+    names = lines[0].split()
+    inds = [i for i,a in enumerate(names) if a in ['alt','press','den','temp','eddy'] or a in keep]
+    fmt = '{:25}'
+    with open(filename,'w') as f:
+        for line in lines:
+            vals = line.split()
+            f.write(''.join(fmt.format(vals[i]) for i in inds)+'\n')
+
+def integrate(pc, equilibrium_time, nsteps_max=20_000, nerrors_max=10):
+    pc.var.custom_binary_diffusion_fcn = utils.custom_binary_diffusion_fcn
+    pc.var.equilibrium_time = equilibrium_time
+    pc.initialize_stepper(pc.wrk.usol)
+    tn = 0.0
+    nsteps = 0
+    nerrors = 0
+    while tn < pc.var.equilibrium_time and nsteps < nsteps_max:
+        try:
+            tn = pc.step()
+            nsteps += 1
+        except PhotoException:
+            usol = np.clip(pc.wrk.usol,a_min=1.0e-40,a_max=np.inf)
+            pc.initialize_stepper(usol)
+            nerrors += 1
+            if nerrors > nerrors_max:
+                pc.destroy_stepper()
+                return False
+    pc.destroy_stepper()
+    return True
+
+def mixing_ratio(pc, sp):
+    ind = pc.dat.species_names.index(sp)
+    return pc.wrk.densities[ind,:]/pc.wrk.density
+
+def key_species_error(pc_ref, pc, key_species, min_mix=1e-20):
+    "Largest difference (dex) between the key species of two states, where they are above `min_mix`."
+    err = {}
+    for sp in key_species:
+        a = mixing_ratio(pc_ref, sp)
+        b = np.interp(pc_ref.var.z, pc.var.z, mixing_ratio(pc, sp))
+        inds = np.where(a > min_mix)
+        if len(inds[0]) == 0:
+            continue
+        err[sp] = np.max(np.abs(np.log10(np.maximum(b[inds],1e-40)) - np.log10(a[inds])))
+    return err
+
+def reduce_to_tolerance(pc_ref, network_file, settings_file, star_file, outfile, key_species, lower_bcs={},
+                        tol=0.05, eps_values=[1e-1,3e-2,1e-2,3e-3,1e-3,3e-4,1e-4], equilibrium_time=1e15):
+    """Finds the smallest reduced network whose steady state matches the
+    converged state of `pc_ref` within `tol` dex for every key species.
+    Thresholds in `eps_values` are tried from the most to the least aggressive,
+    and each candidate is checked by converging a photochemical model with it,
+    starting from the reference state. `lower_bcs` are the lower boundary
+    conditions of the reference model that differ from `settings_file`. Writes outfile+'_network.yaml' and
+    outfile+'_settings.yaml' and returns a summary, or None if no threshold works.
+    """
+    network_out = outfile+'_network.yaml'
+    settings_out = outfile+'_settings.yaml'
+    atmosphere_out = outfile+'_atmosphere.txt'
+    nreactions = len(inputcache.reaction_network(network_file)['reactions'])
+    nspecies = len(pc_ref.dat.species_names) - 2
+
+    for eps in eps_values:
+        keep, rx_keep = reduce_network(pc_ref, network_file, settings_file, key_species, eps, lower_bcs)
+        write_reduced_network(network_file, settings_file, network_out, settings_out, keep, rx_keep, pc_ref, lower_bcs)
+        write_reduced_atmosphere(pc_ref, atmosphere_out, keep)
+        pc = Atmosphere(network_out, settings_out, star_file, atmosphere_out)
+        success = integrate(pc, equilibrium_time)
+        err = key_species_error(pc_ref, pc, key_species)
+        nr = len(inputcache.reaction_network(network_out)['reactions'])
+        print('eps = %.1e: %i/%i species, %i/%i reactions, max error = %.3f dex'
+              %(eps, len(pc.dat.species_names)-2, nspecies, nr, nreactions, max(err.values())))
+        if success and max(err.values()) <= tol:
+            out = {}
+            out['eps'] = eps
+            out['species'] = sorted(keep)
+            out['nreactions'] = nr
+            out['error'] = err
+            return out
+
+    return None
+
+def habitable_key_species():
+    "Species the habitable spectra and haze output depend on."
+    return ['H2O','CH4','CO2','CO','NH3','HCN','C2H6','N2','H2','HCaer1','HCaer2','HCaer3']
+
+def habitable_lower_bcs(params):
+    "Lower boundary conditions that `PhotochemClima.reset` applies for habitable model parameters."
+    lower_bcs = {}
+    for sp in params['mix']:
+        if sp not in ['H2O','H2']:
+            lower_bcs[sp] = {'type': 'mix', 'mix': float(params['mix'][sp])}
+    for sp in params['flux']:
+        lower_bcs[sp] = {'type': 'flux', 'flux': float(params['flux'][sp])}
+    for sp in params['vdep']:
+        lower_bcs[sp] = {'type': 'vdep', 'vdep': float(params['vdep'][sp])}
+    return lower_bcs
+
+def main():
+    import habitable
+    p = habitable.make_PhotochemClima()
+    params = habitable.model2()
+    params['outfile'] = 'results/habitable/model2_reduction_ref'
+    habitable.run_model(p=p, **params)
+    out = reduce_to_tolerance(p.pc, 'input/zahnle_earth_new.yaml',
+                              'input/habitable/settings_habitable_template.yaml',
+                              'input/k2_18b_stellar_flux.txt',
+                              'results/habitable/model2_reduced', habitable_key_species(),
+                              habitable_lower_bcs(params), equilibrium_time=params['equilibrium_time'])
+    print(out)
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,20 @@ from photochem import Atmosphere, PhotoException
 from photochem.clima import AdiabatClimate
 import numpy as np
 import utils
+import inputcache
+import climacache
+
+def default_lower_boundary_conditions(settings_file):
+    """Reads the lower boundary conditions given in a photochem settings file.
+    Species not listed have a zero deposition velocity.
+    """
+    settings = inputcache.load_yaml(settings_file)
+
+    bcs = {}
+    for entry in settings.get('boundary-conditions',[]):
+        if 'lower-boundary' in entry:
+            bcs[entry['name']] = entry['lower-boundary']
+    return bcs
 
 class PhotochemClima():
 
@@ -9,10 +23,13 @@ class PhotochemClima():
                  clima_species_file, clima_settings_file, data_dir=None):
         
         self.pc = Atmosphere(species_file, settings_file, star_file, atmosphere_file, data_dir)
+        self.default_lower_bc = default_lower_boundary_conditions(settings_file)
         self.pc.var.custom_binary_diffusion_fcn = utils.custom_binary_diffusion_fcn # set our special binary diffusion parameter
         self.pc.var.atol = 1.0e-27
         self.pc.var.verbose = False
         self.c = AdiabatClimate(clima_species_file, clima_settings_file, star_file, data_dir)
+        self.clima_files = (clima_species_file, clima_settings_file, star_file)
+        self.clima_cache = None # optional climacache.ClimaProfileCache
         self.c.solve_for_T_trop = False
         self.c.T_trop = 215.0 # default tropopause temp
 
@@ -46,6 +63,69 @@ class PhotochemClima():
         self.T_interp = None
         self.max_dT = 0.0
 
+        # Species whose lower boundary was changed by `reset`
+        self.modified_lower_bc = set()
+        # Values `reset` falls back to when a parameter is not given
+        self.reset_defaults = {
+            'eddy': self.constant_eddy,
+            'T_trop': self.c.T_trop,
+            'relative_humidity': self.relative_humidity,
+            'equilibrium_time': self.pc.var.equilibrium_time,
+            'atol': self.pc.var.atol,
+            'atol_min': self.atol_min,
+            'atol_max': self.atol_max
+        }
+
+    def restore_lower_bc(self, sp):
+        bc = self.default_lower_bc.get(sp, {'type': 'vdep', 'vdep': 0.0})
+        self.pc.set_lower_bc(sp, bc_type=bc['type'], vdep=bc.get('vdep'), mix=bc.get('mix'),
+                             flux=bc.get('flux'), height=bc.get('height'))
+
+    def reset(self, params):
+        """Prepares the model for a new job without re-reading any input files.
+        Boundary conditions changed by the previous job are restored to the
+        settings file values, then `params` are applied. Recognized keys are
+        'mix', 'flux', 'vdep', 'eddy', 'T_trop', 'relative_humidity',
+        'equilibrium_time', 'atol', 'atol_min' and 'atol_max'.
+        """
+        for sp in self.modified_lower_bc:
+            self.restore_lower_bc(sp)
+        self.modified_lower_bc = set()
+
+        mix = params.get('mix', {})
+        for sp in mix:
+            if sp == 'H2O' or sp == 'H2':
+                continue
+            else:
+                self.pc.set_lower_bc(sp,bc_type='mix',mix=mix[sp])
+                self.modified_lower_bc.add(sp)
+        flux = params.get('flux', {})
+        for sp in flux:
+            self.pc.set_lower_bc(sp,bc_type='flux',flux=flux[sp])
+            self.modified_lower_bc.add(sp)
+        vdep = params.get('vdep', {})
+        for sp in vdep:
+            self.pc.set_lower_bc(sp,bc_type='vdep',vdep=vdep[sp])
+            self.modified_lower_bc.add(sp)
+
+        p = dict(self.reset_defaults)
+        for key in p:
+            if key in params:
+                p[key] = params[key]
+        self.constant_eddy = p['eddy']
+        self.c.T_trop = p['T_trop']
+        self.relative_humidity = p['relative_humidity']
+        self.pc.var.relative_humidity = p['relative_humidity']
+        self.pc.var.equilibrium_time = p['equilibrium_time']
+        self.pc.var.atol = p['atol']
+        self.atol_min = p['atol_min']
+        self.atol_max = p['atol_max']
+        self.max_dT = 0.0
+
+    def enable_clima_cache(self, maxsize=128, cache_dir=None):
+        "Reuse clima profiles computed for identical inputs."
+        self.clima_cache = climacache.ClimaProfileCache(*self.clima_files, maxsize=maxsize, cache_dir=cache_dir)
+
     def initialize_atmosphere(self, T_surf, mix):
 
         # Generate P-z-T-mix profile using clima
@@ -57,30 +137,30 @@ class PhotochemClima():
         P_i = f_i*P_surf
         self.c.RH = np.ones(len(self.c.species_names))*self.relative_humidity
         self.c.P_top = self.min_TOA_p
-        self.c.make_profile_bg_gas(T_surf, P_i, P_surf, self.bg_gas)
+        prof = climacache.make_profile_bg_gas(self.c, T_surf, P_i, P_surf, self.bg_gas, self.clima_cache)
 
         # Update photochem vertical grid to match clima
-        self.pc.update_vertical_grid(TOA_alt=self.c.z[-1])
+        self.pc.update_vertical_grid(TOA_alt=prof.z[-1])
         
         # Interpolate clima mixing ratios to photochem P-T grid
         usol = np.ones(self.pc.wrk.usol.shape)*1.0e-40
-        for i,sp in enumerate(self.c.species_names):
+        for i,sp in enumerate(prof.species_names):
             if sp != self.bg_gas:
                 ind = self.pc.dat.species_names.index(sp)
-                usol[ind,:] = np.interp(self.pc.var.z,self.c.z,self.c.f_i[:,i])
+                usol[ind,:] = np.interp(self.pc.var.z,prof.z,prof.f_i[:,i])
         self.pc.wrk.usol = usol
 
         # Set P-T-edd profile
-        self.P = np.append(self.c.P_surf + self.c.P_surf*1e-12, self.c.P)
-        self.T = np.append(self.c.T_surf, self.c.T)
+        self.P = np.append(prof.P_surf + prof.P_surf*1e-12, prof.P)
+        self.T = np.append(prof.T_surf, prof.T)
         if self.altitude_dependent_eddy:
             log10P = np.log10(self.P/1e6)
-            log10P_trop = np.log10(self.c.P_trop/1e6)
+            log10P_trop = np.log10(prof.P_trop/1e6)
             self.edd = utils.simple_eddy_diffusion_profile(log10P, log10P_trop, self.constant_eddy)
             self.edd[self.edd >= 1e6] = 1e6
         else:
             self.edd = np.ones(self.P.shape[0])*self.constant_eddy
-        self.P_trop = self.c.P_trop
+        self.P_trop = prof.P_trop
         self.log10P_interp = np.log10(self.P.copy()[::-1])
         self.T_interp = self.T.copy()[::-1]
         self.log10edd_interp = np.log10(self.edd.copy()[::-1])
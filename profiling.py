@@ -0,0 +1,189 @@
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import resource
+import threading
+from contextlib import contextmanager
+
+def _peak_rss_self():
+    "Peak resident memory of this process in MB, since the last reset if possible."
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return float(line.split()[1])/1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def _reset_peak_rss():
+    "Resets the peak RSS counter of this process (Linux only)."
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _descendant_pids(pid):
+    "Process ids of all live descendants of `pid`, from /proc (Linux only)."
+    children = {}
+    for stat in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat) as f:
+                line = f.read()
+        except OSError:
+            continue
+        fields = line[line.rfind(')')+2:].split()
+        children.setdefault(int(fields[1]), []).append(int(stat.split('/')[2]))
+    out = []
+    stack = [pid]
+    while len(stack) > 0:
+        for child in children.get(stack.pop(), []):
+            out.append(child)
+            stack.append(child)
+    return out
+
+def _rss_mb(pid):
+    try:
+        with open('/proc/%i/status'%pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return float(line.split()[1])/1024
+    except OSError:
+        pass
+    return 0.0
+
+class ChildMemorySampler():
+    """Samples the total resident memory of all live child processes (e.g.
+    pathos pool workers, reaped or not) every `interval` seconds in a
+    background thread, and keeps the peak. Linux only; elsewhere it stays 0.
+    """
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._done = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        pid = os.getpid()
+        while True:
+            rss = sum(_rss_mb(a) for a in _descendant_pids(pid))
+            self.peak_mb = max(self.peak_mb, rss)
+            if self._done.wait(self.interval):
+                break
+
+    def start(self):
+        if os.path.isdir('/proc'):
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._done.set()
+        if self._thread is not None:
+            self._thread.join()
+
+def top_functions(profile, n=15):
+    """Functions with the most cumulative time in a cProfile.Profile. Time in
+    compiled code (photochem, Cantera, picaso) counts toward the cumulative
+    time of the Python functions that called it.
+    """
+    stats = pstats.Stats(profile)
+    rows = []
+    for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+        rows.append({'function': '%s:%s'%(os.path.basename(filename), name),
+                     'total_s': ct,
+                     'self_s': tt})
+    rows.sort(key=lambda a: -a['total_s'])
+    return rows[:n]
+
+class PipelineProfiler():
+    """Records wall time, CPU time (this process and its finished child
+    processes) and peak memory of each pipeline stage. Peak memory of child
+    processes is sampled while the stage runs. With `profile=True`, each
+    stage is also run under cProfile. `save` writes a JSON and CSV report per
+    run and compares against the previous run.
+    """
+
+    def __init__(self, outfolder='results/profiling/', profile=False):
+        self.outfolder = outfolder
+        self.profile = profile
+        # Timestamp first, so reports sort by time. The suffix keeps runs
+        # started in the same second apart.
+        self.run_id = time.strftime('%Y%m%d-%H%M%S')+'-'+uuid.uuid4().hex[:8]
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        _reset_peak_rss()
+        children0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        memory = ChildMemorySampler()
+        memory.start()
+        profile = None
+        if self.profile:
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            memory.stop()
+            children1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+            entry = {
+                'stage': name,
+                'wall_s': time.perf_counter() - wall0,
+                'cpu_s': time.process_time() - cpu0,
+                'cpu_children_s': (children1.ru_utime - children0.ru_utime) + (children1.ru_stime - children0.ru_stime),
+                'peak_rss_mb': _peak_rss_self(),
+                'peak_rss_children_mb': memory.peak_mb
+            }
+            if profile is not None:
+                entry['functions'] = top_functions(profile)
+            self.stages.append(entry)
+
+    def previous_report(self):
+        files = sorted(glob.glob(os.path.join(self.outfolder, '*.json')))
+        files = [a for a in files if os.path.basename(a) != self.run_id+'.json']
+        if len(files) == 0:
+            return None
+        with open(files[-1],'r') as f:
+            return json.load(f)
+
+    def compare(self, previous):
+        "Prints wall time of each stage relative to a previous report."
+        old = {a['stage']: a for a in previous['stages']}
+        print('%-20s %10s %10s %8s'%('stage','wall (s)','prev (s)','ratio'))
+        for entry in self.stages:
+            if entry['stage'] in old:
+                prev = old[entry['stage']]['wall_s']
+                print('%-20s %10.1f %10.1f %8.2f'%(entry['stage'], entry['wall_s'], prev, entry['wall_s']/max(prev,1e-10)))
+            else:
+                print('%-20s %10.1f %10s %8s'%(entry['stage'], entry['wall_s'], '-', '-'))
+
+    def save(self):
+        os.makedirs(self.outfolder, exist_ok=True)
+        previous = self.previous_report()
+
+        report = {'run_id': self.run_id, 'argv': sys.argv, 'stages': self.stages}
+        with open(os.path.join(self.outfolder, self.run_id+'.json'),'w') as f:
+            json.dump(report, f, indent=2)
+
+        keys = ['stage','wall_s','cpu_s','cpu_children_s','peak_rss_mb','peak_rss_children_mb']
+        with open(os.path.join(self.outfolder, self.run_id+'.csv'),'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(keys)
+            for entry in self.stages:
+                writer.writerow([entry[key] for key in keys])
+
+        if previous is not None:
+            self.compare(previous)
+        return report
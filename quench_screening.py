@@ -0,0 +1,207 @@
+import numpy as np
+from scipy import constants as const
+from astropy import constants
+import cantera as ct
+import pickle
+import os
+import traceback
+from pathos.multiprocessing import ProcessingPool as Pool
+
+import planets
+
+# Chemical timescales (s) from Zahnle & Marley (2014). P in bar, T in K,
+# m is metallicity relative to solar.
+def t_CO(P, T, m):
+    "CO <-> CH4 interconversion"
+    return 1.5e-6*P**(-1.0)*m**(-0.7)*np.exp(42000.0/T)
+
+def t_NH3(P, T, m):
+    "NH3 <-> N2 interconversion"
+    return 1.0e-7*P**(-1.0)*np.exp(52000.0/T)
+
+def t_HCN(P, T, m):
+    "HCN <-> CH4 + NH3"
+    return 1.5e-4*P**(-1.0)*m**(-0.7)*np.exp(36000.0/T)
+
+def t_CO2(P, T, m):
+    "CO2 <-> CO + OH"
+    return 1.0e-10*P**(-0.5)*np.exp(38000.0/T)
+
+# The timescale that sets the quench level of each species
+QUENCH_TIMESCALES = {
+    'CH4': t_CO,
+    'CO': t_CO,
+    'H2O': t_CO,
+    'NH3': t_NH3,
+    'N2': t_NH3,
+    'HCN': t_HCN,
+    'CO2': t_CO2
+}
+
+# cantera Solutions owned by the current (worker) process
+_gases = {}
+
+def worker_gas(ct_file):
+    if ct_file not in _gases:
+        _gases[ct_file] = ct.Solution(ct_file)
+    return _gases[ct_file]
+
+def mixing_timescale(P, T, z, mubar, radius, mass, eddy):
+    "H^2/Kzz in s. CGS units."
+    import neptune
+    grav = neptune.gravity(radius, mass, z)
+    k_boltz = const.Boltzmann*1e7
+    H = (k_boltz*T*const.Avogadro)/(mubar*grav)
+    return H**2/eddy
+
+def quench_level(r):
+    """Given log(t_chem/t_mix) on P (bottom to top), finds the deepest level
+    where mixing becomes faster than chemistry. Returns the index of the level
+    below the crossing and the fractional distance to the next level, or
+    None if chemistry is fast everywhere.
+    """
+    inds = np.where(r >= 0.0)[0]
+    if len(inds) == 0:
+        return None
+    i = inds[0]
+    if i == 0:
+        return 0, 0.0
+    return i-1, r[i-1]/(r[i-1] - r[i])
+
+def quench_abundances(P, T, z, equi, mubar, M_H_metalicity, eddy, radius, mass):
+    """Estimates quenched mixing ratios by comparing chemical and mixing timescales.
+    Returns the `surf` dictionary (mixing ratios at the top of the P-T profile)
+    and the quench pressure of each species (dynes/cm^2, None if not quenched).
+    """
+    m = 10.0**M_H_metalicity
+    t_mix = mixing_timescale(P, T, z, mubar, radius, mass, eddy)
+
+    surf = {}
+    for sp in equi:
+        surf[sp] = equi[sp][-1]
+
+    P_quench = {}
+    for sp in QUENCH_TIMESCALES:
+        if sp not in equi:
+            continue
+        t_chem = QUENCH_TIMESCALES[sp](P/1e6, T, m)
+        q = quench_level(np.log(t_chem) - np.log(t_mix))
+        if q is None:
+            P_quench[sp] = None
+            continue
+        i, f = q
+        if f == 0.0:
+            P_quench[sp] = P[i]
+            surf[sp] = equi[sp][i]
+        else:
+            P_quench[sp] = 10.0**((1-f)*np.log10(P[i]) + f*np.log10(P[i+1]))
+            log10mix = (1-f)*np.log10(np.maximum(equi[sp][i],1e-40)) + f*np.log10(np.maximum(equi[sp][i+1],1e-40))
+            surf[sp] = 10.0**log10mix
+
+    # renormalize
+    total = np.sum([surf[sp] for sp in surf])
+    for sp in surf:
+        surf[sp] = surf[sp]/total
+
+    return surf, P_quench
+
+def quenched_profiles(P, equi, surf, P_quench):
+    """Mixing ratio profiles that follow equilibrium below each species' quench
+    level and are constant above it.
+    """
+    mix = {}
+    for sp in equi:
+        mix[sp] = equi[sp].copy()
+    for sp in P_quench:
+        if P_quench[sp] is not None:
+            mix[sp][P < P_quench[sp]] = surf[sp]
+
+    # renormalize
+    total = np.sum([mix[sp] for sp in mix], axis=0)
+    for sp in mix:
+        mix[sp] = mix[sp]/total
+    return mix
+
+def screen_quench(PTfile_in, P_bottom, P_top, M_H_metalicity, CtoO, eddies, ct_file, atoms, nz=100):
+    """Fast alternative to the quench kinetics model in `neptune.run_quench_photochem_model`.
+    Chemical equilibrium is computed once for the P-T profile, then quenched
+    abundances are estimated for each eddy diffusion coefficient in `eddies`.
+    Returns a list of dicts, one for each eddy. The 'surf' entry can be passed
+    to `neptune.write_photochem_settings_file`.
+    """
+    import neptune # imported here, so that importing this module does not need photochem
+    radius = planets.k2_18b.radius*(constants.R_earth.value)*1e2
+    mass = planets.k2_18b.mass*(constants.M_earth.value)*1e3
+
+    P, T = neptune.P_T_from_file(PTfile_in, P_bottom, P_top, nz)
+    gas = worker_gas(ct_file)
+    equi, _, mubar = neptune.chemical_equilibrium_PT(P, T, ct_file, atoms, M_H_metalicity, CtoO, gas)
+    z = neptune.altitude_profile_PT(P, T, radius, mass, mubar[0])
+
+    results = []
+    for eddy in eddies:
+        surf, P_quench = quench_abundances(P, T, z, equi, mubar, M_H_metalicity, eddy, radius, mass)
+        out = {}
+        out['PTfile'] = PTfile_in
+        out['M_H_metalicity'] = M_H_metalicity
+        out['CtoO'] = CtoO
+        out['eddy'] = eddy
+        out['surf'] = surf
+        out['P_quench'] = P_quench
+        results.append(out)
+    return results
+
+def screen_worker(args):
+    """Screens one climate model. If it fails, returns a single dict with
+    'success' False and the traceback in 'error', as `workqueue.run_job` does.
+    """
+    from neptune_climate import parse_outfile_name
+    PTfile_in, eddies, P_bottom, P_top, ct_file, atoms = args
+    mh, CtoO, tint = parse_outfile_name(PTfile_in)
+    try:
+        results = screen_quench(PTfile_in, P_bottom, P_top, mh, CtoO, eddies, ct_file, atoms)
+        for out in results:
+            out['success'] = True
+            out['error'] = None
+    except Exception:
+        out = {'PTfile': PTfile_in, 'M_H_metalicity': mh, 'CtoO': CtoO,
+               'success': False, 'error': traceback.format_exc()}
+        results = [out]
+    for out in results:
+        out['tint'] = tint
+    return results
+
+def screen_climate_grid(climate_files, eddies, P_bottom=500.0e6, P_top=1.0e6,
+                        ct_file='input/zahnle_earth_new_ct.yaml', atoms=['H','He','C','O','N'], nprocesses=4):
+    """Screens every climate model in `climate_files` (named with
+    `neptune_climate.make_outfile_name`) for each eddy diffusion coefficient.
+    """
+    args = [(a, eddies, P_bottom, P_top, ct_file, atoms) for a in climate_files]
+    if nprocesses > 1 and len(args) > 1:
+        out = Pool(nprocesses).map(screen_worker, args)
+    else:
+        out = [screen_worker(a) for a in args]
+    results = []
+    for a in out:
+        results += a
+    return results
+
+def main():
+    from neptune_climate import parse_outfile_name
+    folder = 'results/neptune/climate/'
+    climate_files = [folder+a for a in sorted(os.listdir(folder)) if parse_outfile_name(a) is not None]
+    eddies = np.logspace(6,10,9)
+    results = screen_climate_grid(climate_files, eddies)
+    with open('results/neptune/quench_screening.pkl','wb') as f:
+        pickle.dump(results, f)
+
+    sp = ['CH4','CO','CO2','NH3','HCN']
+    print(('{:40}{:10}'+'{:10}'*len(sp)).format('climate','Kzz',*sp))
+    for out in results:
+        if not out['success']:
+            print('Failed: '+out['PTfile']+'\n'+out['error'])
+            continue
+        print(('{:40}{:<10.1e}'+'{:<10.1e}'*len(sp)).format(os.path.basename(out['PTfile']), out['eddy'], *[out['surf'].get(a, 0.0) for a in sp]))
+
+if __name__ == '__main__':
+    main()
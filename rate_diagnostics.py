@@ -0,0 +1,86 @@
+import numpy as np
+
+class RateDiagnostics():
+    """Reaction rates of a photochem Atmosphere, evaluated once per state.
+
+    `evaluate` computes every reaction rate at every altitude in one pass
+    (molecules/cm^3/s, shape (nreactions, nz)). Production and loss of any
+    species or set of species is then a product with stoichiometry matrices
+    built once in `__init__`, instead of one `pc.production_and_loss` call
+    (which evaluates all rates again) per species.
+
+    Uses `pc.prep_atmosphere`, `pc.wrk.rx_rates` (rate constants, including
+    photolysis rates and the third body density) and the reaction index
+    arrays in `pc.dat`, which are 1-based Fortran indices. hv and M are
+    given a density of 1.
+    """
+
+    def __init__(self, pc):
+        self.pc = pc
+        dat = pc.dat
+        self.species_names = dat.species_names[:dat.nsp]
+        self.species_inds = {sp: i for i,sp in enumerate(self.species_names)}
+        self.reaction_equations = list(dat.reaction_equations)
+        self.reaction_inds = {rx: i for i,rx in enumerate(self.reaction_equations)}
+        nrT = len(self.reaction_equations)
+
+        # Reactant index of each reaction, nsp for hv and M
+        nr_max = dat.reactants_sp_inds.shape[0]
+        self.reactants = np.full((nr_max, nrT), dat.nsp, dtype=int)
+        self.production = np.zeros((dat.nsp, nrT))
+        self.loss = np.zeros((dat.nsp, nrT))
+        for j in range(nrT):
+            for k in range(dat.nreactants[j]):
+                i = dat.reactants_sp_inds[k,j] - 1
+                if i < dat.nsp:
+                    self.reactants[k,j] = i
+                    self.loss[i,j] += 1
+            for k in range(dat.nproducts[j]):
+                i = dat.products_sp_inds[k,j] - 1
+                if i < dat.nsp:
+                    self.production[i,j] += 1
+
+        self.rates = None
+        self.integrated_rates = None
+
+    def evaluate(self, usol=None):
+        "Computes all reaction rates for `usol` (default: the current state)."
+        pc = self.pc
+        if usol is None:
+            usol = pc.wrk.usol
+        pc.prep_atmosphere(usol)
+        densities = np.ones((pc.dat.nsp+1, pc.var.nz))
+        densities[:pc.dat.nsp,:] = pc.wrk.densities[:pc.dat.nsp,:]
+
+        rates = pc.wrk.rx_rates.T.copy() # (nrT, nz)
+        for k in range(self.reactants.shape[0]):
+            rates *= densities[self.reactants[k,:],:]
+        self.rates = rates
+        dz = pc.var.z[1] - pc.var.z[0]
+        self.integrated_rates = np.sum(rates, axis=1)*dz # molecules/cm^2/s
+        return self.rates
+
+    def _rows(self, species):
+        if isinstance(species, str):
+            species = [species]
+        return [self.species_inds[sp] for sp in species]
+
+    def production_profile(self, species):
+        "Total production of one species, or summed over a list of species (molecules/cm^3/s)."
+        return np.sum(self.production[self._rows(species),:] @ self.rates, axis=0)
+
+    def loss_profile(self, species):
+        "Total loss of one species, or summed over a list of species (molecules/cm^3/s)."
+        return np.sum(self.loss[self._rows(species),:] @ self.rates, axis=0)
+
+    def integrated_production(self, species):
+        "Column integrated production (molecules/cm^2/s) from each reaction, shape (nreactions,)."
+        return np.sum(self.production[self._rows(species),:], axis=0)*self.integrated_rates
+
+    def integrated_loss(self, species):
+        "Column integrated loss (molecules/cm^2/s) from each reaction, shape (nreactions,)."
+        return np.sum(self.loss[self._rows(species),:], axis=0)*self.integrated_rates
+
+    def reaction_rate(self, equation):
+        "Column integrated rate (molecules/cm^2/s) of one reaction."
+        return self.integrated_rates[self.reaction_inds[equation]]
@@ -0,0 +1,227 @@
+import numpy as np
+import time
+import csv
+import sys
+import os
+import subprocess
+from importlib import metadata
+
+from photochem.utils._format import FormatSettings_main, MyDumper, Loader, yaml
+from photochemclima import PhotochemClima
+import habitable
+import neptune
+import make_spectra
+import results_io
+import jwst_data
+import likelihood
+
+# Reduced-size versions of the pipeline, compared against golden outputs
+# with per-quantity tolerances. Run `python regression.py --update` to
+# (re)make the golden outputs after an intended change to the science. The
+# commit and package versions they were made with are saved alongside them.
+
+OUTFOLDER = 'results/regression/'
+GOLDEN_FILE = OUTFOLDER+'golden.npz'
+HISTORY_FILE = OUTFOLDER+'history.csv'
+
+# Packages whose versions are saved with the golden outputs
+PACKAGES = ['numpy','scipy','photochem','picaso','cantera','miepython','pandas']
+
+def provenance():
+    """The git commit and package versions that outputs are made with. 'dirty'
+    is True if the working tree has uncommitted changes.
+    """
+    out = {}
+    try:
+        out['commit'] = subprocess.run(['git','rev-parse','HEAD'], capture_output=True, text=True).stdout.strip()
+        out['dirty'] = subprocess.run(['git','status','--porcelain','--untracked-files=no'], capture_output=True, text=True).stdout.strip() != ''
+    except OSError:
+        out['commit'] = ''
+        out['dirty'] = True
+    for package in PACKAGES:
+        try:
+            out[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            out[package] = ''
+    return out
+
+def tolerances():
+    """Allowed absolute differences, keyed by quantity. If 'log' is True,
+    the quantity is compared in log10 space (i.e. atol is in dex).
+    """
+    tol = {
+        'mix': {'log': True, 'atol': 0.05},
+        'temperature': {'log': False, 'atol': 0.1},
+        'opd': {'log': True, 'atol': 0.05},
+        'w0': {'log': False, 'atol': 1.0e-3},
+        'g0': {'log': False, 'atol': 1.0e-3},
+        'rprs2': {'log': False, 'atol': 2.0e-6},
+        'rchi2': {'log': False, 'atol': 1.0e-2},
+        'sig': {'log': False, 'atol': 1.0e-2}
+    }
+    return tol
+
+def write_reduced_settings(settings_in, settings_out, nz):
+    with open(settings_in,'r') as f:
+        settings = yaml.load(f,Loader=Loader)
+    settings['atmosphere-grid']['number-of-layers'] = int(nz)
+    settings = FormatSettings_main(settings)
+    with open(settings_out,'w') as f:
+        yaml.dump(settings, f, Dumper=MyDumper ,sort_keys=False, width=70)
+
+def result_outputs(prefix, filename, species):
+    res = results_io.AtmosphereResult(filename)
+    out = {}
+    out[prefix+'/temperature'] = res.temperature.copy()
+    for sp in species:
+        out[prefix+'/mix/'+sp] = res.mix(sp).copy()
+    return out
+
+def cloud_outputs(prefix, filename):
+    tmp = np.loadtxt(filename, skiprows=1)
+    out = {}
+    out[prefix+'/opd'] = tmp[:,2]
+    out[prefix+'/w0'] = tmp[:,3]
+    out[prefix+'/g0'] = tmp[:,4]
+    return out
+
+def run_habitable():
+    settings_file = OUTFOLDER+'settings_habitable.yaml'
+    write_reduced_settings('input/habitable/settings_habitable_template.yaml', settings_file, 50)
+    p = PhotochemClima('input/zahnle_earth_new.yaml',
+                       settings_file,
+                       'input/k2_18b_stellar_flux.txt',
+                       'input/habitable/atmosphere_init.txt',
+                       'input/habitable/species_climate.yaml',
+                       'input/habitable/settings_climate_scale=0.7.yaml')
+    params = habitable.model2()
+    params['outfile'] = OUTFOLDER+'habitable'
+    params['equilibrium_time'] = 1.0e8
+    habitable.run_model(p=p, **params)
+
+    out = result_outputs('habitable', params['outfile']+'_result.npz', ['H2O','CH4','CO2','CO','NH3','HCN'])
+    out.update(cloud_outputs('habitable', params['outfile']+'_clouds.txt'))
+    return out
+
+def run_neptune():
+    params = neptune.nominal_S()
+    params['outfile'] = OUTFOLDER+'neptune'
+    params['nz_q'] = 10
+    params['equilibrium_time'] = 1.0e6
+    neptune.run_quench_photochem_model(**params)
+
+    species = ['H2O','CH4','CO2','CO','NH3','HCN','H2S','SO2']
+    out = result_outputs('neptune_quench', params['outfile']+'_quench_result.npz', species)
+    out.update(result_outputs('neptune', params['outfile']+'_photochem_result.npz', species))
+    out.update(cloud_outputs('neptune', params['outfile']+'_clouds.txt'))
+    return out
+
+def run_spectra():
+    wv_range = [3.0,5.0] # microns
+    opa = make_spectra.make_opannection(wave_range=wv_range)
+    case1 = make_spectra.make_case(opa)
+    data = jwst_data.load_data('lowres')
+
+    # Same offset fits as `make_spectra.compute_statistics`: one offset, and
+    # separate SOSS and G395H offsets
+    single = likelihood.CorrelatedLikelihood(data, ['all'], wv_range)
+    split = likelihood.CorrelatedLikelihood(data, ['soss','g395h'], wv_range)
+
+    out = {}
+    for name in ['habitable','neptune']:
+        case1.atmosphere(filename = OUTFOLDER+name+'_picaso.pt', delim_whitespace=True)
+        case1.clouds(filename = OUTFOLDER+name+'_clouds.txt', delim_whitespace=True)
+        wv, rprs2 = make_spectra.transmission_spectrum(case1, opa)
+        st = single.statistics(wv, rprs2)
+        out['spectra_'+name+'/rprs2'] = st['rprs2_b'][0]
+        out['spectra_'+name+'/rchi2'] = np.array([st['rchi2']])
+        out['spectra_'+name+'/sig'] = np.array([st['sig']])
+        st = split.statistics(wv, rprs2)
+        out['spectra_'+name+'_split/rchi2'] = np.array([st['rchi2']])
+        out['spectra_'+name+'_split/sig'] = np.array([st['sig']])
+    return out
+
+def compare(golden, new, tol):
+    "Returns a list of descriptions of every output that is not within tolerance."
+    failures = []
+    for key in golden:
+        if key not in new:
+            failures.append(key+': missing')
+            continue
+        a = np.asarray(new[key], dtype=float)
+        b = np.asarray(golden[key], dtype=float)
+        if a.shape != b.shape:
+            failures.append(key+': shape %s != %s'%(a.shape, b.shape))
+            continue
+        t = tol[key.split('/')[1]]
+        if t['log']:
+            a = np.log10(np.maximum(a,1e-40))
+            b = np.log10(np.maximum(b,1e-40))
+        err = np.max(np.abs(a - b))
+        if not err <= t['atol']:
+            failures.append(key+': max difference %.3e > %.3e'%(err, t['atol']))
+    return failures
+
+def append_history(case, wall_time, nfailures):
+    new_file = not os.path.isfile(HISTORY_FILE)
+    with open(HISTORY_FILE,'a', newline='') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(['time','case','wall_s','nfailures'])
+        writer.writerow([time.strftime('%Y-%m-%d %H:%M:%S'), case, '%.2f'%wall_time, nfailures])
+
+def main(update=False):
+    os.makedirs(OUTFOLDER, exist_ok=True)
+    np.random.seed(0)
+
+    golden = {}
+    info = provenance()
+    if update:
+        if info['dirty']:
+            raise Exception('Golden outputs must be made from a committed version of the code. '
+                            'Commit or stash changes first.')
+    else:
+        if not os.path.isfile(GOLDEN_FILE):
+            raise Exception('No golden outputs at "'+GOLDEN_FILE+'". Run `python regression.py --update` '
+                            'on a trusted version of the code to make them.')
+        with np.load(GOLDEN_FILE) as f:
+            golden = {key: f[key] for key in f.files if not key.startswith('provenance/')}
+            golden_info = {key.split('/')[1]: str(f[key]) for key in f.files if key.startswith('provenance/')}
+        print('Golden outputs from commit %s'%golden_info.get('commit','unknown'))
+        for package in PACKAGES:
+            if golden_info.get(package, '') != info[package]:
+                print('Warning: %s is %s, golden outputs used %s'%(package, info[package] or 'missing', golden_info.get(package,'unknown') or 'missing'))
+
+    cases = [('habitable', run_habitable), ('neptune', run_neptune), ('spectra', run_spectra)]
+    outputs = {}
+    failures = []
+    for case, fcn in cases:
+        start = time.perf_counter()
+        out = fcn()
+        wall_time = time.perf_counter() - start
+        outputs.update(out)
+        if update:
+            append_history(case, wall_time, 0)
+            continue
+        golden_case = {key: golden[key] for key in golden if key.split('/')[0].startswith(case)}
+        f = compare(golden_case, out, tolerances())
+        if len(golden_case) == 0:
+            f.append(case+': no golden outputs, run `python regression.py --update`')
+        f += [key+': not in the golden outputs' for key in out if key not in golden_case]
+        append_history(case, wall_time, len(f))
+        print('%-10s %8.1f s   %i failures'%(case, wall_time, len(f)))
+        failures += f
+
+    if update:
+        for key in info:
+            outputs['provenance/'+key] = np.array(str(info[key]))
+        np.savez(GOLDEN_FILE, **outputs)
+        return True
+
+    for f in failures:
+        print(f)
+    return len(failures) == 0
+
+if __name__ == '__main__':
+    success = main(update='--update' in sys.argv)
+    sys.exit(0 if success else 1)
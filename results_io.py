@@ -0,0 +1,251 @@
+import numpy as np
+import os
+import json
+import uuid
+import fcntl
+import hashlib
+from contextlib import contextmanager
+
+# Everything in here only depends on numpy, so that plotting scripts
+# can read results without importing photochem.
+
+def write_atmosphere_result(filename, pressure, temperature, z, edd, species, mix, success=True):
+    """Writes a self-describing atmosphere result. CGS units.
+    `mix` has shape (len(species), len(pressure)).
+    """
+    mix = np.asarray(mix)
+    assert mix.shape == (len(species), len(pressure))
+    np.savez(filename,
+             pressure=np.asarray(pressure),
+             temperature=np.asarray(temperature),
+             z=np.asarray(z),
+             edd=np.asarray(edd),
+             species=np.array(species),
+             mix=mix,
+             success=bool(success))
+
+def photochem_arrays(pc):
+    "The current state of a photochem Atmosphere object, as a dict of arrays."
+    species = pc.dat.species_names[:-2]
+    mix = np.empty((len(species), pc.wrk.pressure.shape[0]))
+    for i,sp in enumerate(species):
+        mix[i,:] = pc.wrk.densities[i,:]/pc.wrk.density
+    out = {}
+    out['pressure'] = pc.wrk.pressure.copy()
+    out['temperature'] = pc.var.temperature.copy()
+    out['z'] = pc.var.z.copy()
+    out['edd'] = pc.var.edd.copy()
+    out['species'] = np.array(species)
+    out['mix'] = mix
+    return out
+
+def write_photochem_result(filename, pc, success=True):
+    "Writes the current state of a photochem Atmosphere object."
+    a = photochem_arrays(pc)
+    write_atmosphere_result(filename, a['pressure'], a['temperature'], a['z'], a['edd'],
+                            a['species'], a['mix'], success)
+
+class AtmosphereResult():
+    """Reads a file written by `write_atmosphere_result`. Arrays are
+    only read from disk the first time they are accessed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._npz = np.load(filename)
+        self._cache = {}
+        self.species_names = [str(a) for a in self._npz['species']]
+        self.success = bool(self._npz['success'])
+
+    def _get(self, key):
+        if key not in self._cache:
+            self._cache[key] = self._npz[key]
+        return self._cache[key]
+
+    @property
+    def pressure(self):
+        "dynes/cm^2"
+        return self._get('pressure')
+
+    @property
+    def temperature(self):
+        "K"
+        return self._get('temperature')
+
+    @property
+    def z(self):
+        "cm"
+        return self._get('z')
+
+    @property
+    def edd(self):
+        "cm^2/s"
+        return self._get('edd')
+
+    def mix(self, sp):
+        "Mixing ratio profile of species `sp`."
+        ind = self.species_names.index(sp)
+        return self._get('mix')[ind,:]
+
+    def close(self):
+        self._npz.close()
+
+
+def flatten_params(params, prefix=''):
+    """Scalar entries of a (nested) parameter dict, with keys like 'mix.CO2'.
+    Non-scalar entries are dropped.
+    """
+    out = {}
+    for key in params:
+        val = params[key]
+        if isinstance(val, dict):
+            out.update(flatten_params(val, prefix+key+'.'))
+        elif isinstance(val, (bool, int, float, str, np.integer, np.floating)) or val is None:
+            if isinstance(val, np.generic):
+                val = val.item()
+            out[prefix+key] = val
+    return out
+
+def run_id(params):
+    "Identifier of a run, from a hash of its flattened parameters."
+    s = json.dumps(flatten_params(params), sort_keys=True)
+    return hashlib.sha256(s.encode()).hexdigest()[:16]
+
+class ResultStore():
+    """A directory of results from many runs, keyed by run parameters.
+
+    directory/runs/<id>.npz     arrays of one run, compressed
+    directory/index.jsonl       one line per appended run: id, parameters,
+                                and the shape and dtype of each array
+    directory/consolidated/     each variable stacked across runs in one
+                                .npy file, written by `consolidate`
+
+    Any number of processes can `append` at once; the index is protected by a
+    file lock and run files are written atomically. After `consolidate`, a
+    variable from thousands of runs is a memory-mapped array, so slicing it
+    only reads what is needed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        for folder in ['runs','consolidated']:
+            os.makedirs(os.path.join(directory, folder), exist_ok=True)
+        self.index_file = os.path.join(directory, 'index.jsonl')
+        self.lock_file = os.path.join(directory, 'index.lock')
+
+    @contextmanager
+    def _lock(self):
+        with open(self.lock_file,'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _run_file(self, rid):
+        return os.path.join(self.directory, 'runs', rid+'.npz')
+
+    def append(self, params, arrays):
+        "Adds (or replaces) the run with parameters `params`. Returns its id."
+        rid = run_id(params)
+        filename = self._run_file(rid)
+        tmp = filename+'.'+uuid.uuid4().hex+'.tmp.npz'
+        np.savez_compressed(tmp, **arrays)
+
+        entry = {}
+        entry['id'] = rid
+        entry['params'] = flatten_params(params)
+        entry['arrays'] = {key: [list(np.shape(arrays[key])), np.asarray(arrays[key]).dtype.str] for key in arrays}
+        with self._lock():
+            # Replace the run file under the lock, so it always matches the index
+            os.replace(tmp, filename)
+            with open(self.index_file,'a') as f:
+                f.write(json.dumps(entry)+'\n')
+        return rid
+
+    def index(self):
+        "Index entries, one per run. A run that was appended twice keeps its last entry."
+        entries = {}
+        if not os.path.isfile(self.index_file):
+            return []
+        with open(self.index_file,'r') as f:
+            for line in f:
+                if line.strip() == '':
+                    continue
+                entry = json.loads(line)
+                entries[entry['id']] = entry
+        return list(entries.values())
+
+    def select(self, **params):
+        """Index entries of runs whose parameters match `params`. Use the
+        flattened names with '.' replaced by '__', e.g. select(mix__CO2=0.008).
+        """
+        out = []
+        for entry in self.index():
+            match = True
+            for key in params:
+                if entry['params'].get(key.replace('__','.')) != params[key]:
+                    match = False
+                    break
+            if match:
+                out.append(entry)
+        return out
+
+    def load(self, rid, key):
+        "One array of one run. Only that array is decompressed."
+        with np.load(self._run_file(rid)) as npz:
+            return npz[key]
+
+    def consolidate(self):
+        """Stacks every variable that has the same shape and a numeric dtype
+        in all runs into consolidated/<variable>.npy. The order of the runs is
+        saved in consolidated/runs.json. The lock is held throughout, so runs
+        can't change while they are read, and every file is written to a
+        temporary file and moved into place.
+        """
+        folder = os.path.join(self.directory, 'consolidated')
+        with self._lock():
+            entries = self.index()
+            ids = [entry['id'] for entry in entries]
+            keys = set()
+            for entry in entries:
+                keys.update(entry['arrays'].keys())
+
+            written = []
+            for key in sorted(keys):
+                shapes = set(tuple(entry['arrays'][key][0]) if key in entry['arrays'] else None for entry in entries)
+                dtypes = set(entry['arrays'][key][1] if key in entry['arrays'] else None for entry in entries)
+                if len(shapes) != 1 or None in shapes or len(dtypes) != 1:
+                    continue
+                dtype = np.dtype(dtypes.pop())
+                if dtype.kind not in 'biuf':
+                    continue
+                shape = (len(ids),) + shapes.pop()
+                tmp = os.path.join(folder, key+'.'+uuid.uuid4().hex+'.tmp.npy')
+                out = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+                for i,rid in enumerate(ids):
+                    out[i] = self.load(rid, key)
+                out.flush()
+                del out
+                os.replace(tmp, os.path.join(folder, key+'.npy'))
+                written.append(key)
+
+            tmp = os.path.join(folder, 'runs.json.'+uuid.uuid4().hex+'.tmp')
+            with open(tmp,'w') as f:
+                json.dump({'ids': ids, 'variables': written}, f)
+            os.replace(tmp, os.path.join(folder, 'runs.json'))
+        return written
+
+    def variable(self, key):
+        """A variable across all consolidated runs, as a read-only memory-mapped
+        array with shape (nruns, ...), and the run ids in the same order.
+        Runs appended after the last `consolidate` are not included.
+        """
+        folder = os.path.join(self.directory, 'consolidated')
+        with self._lock():
+            with open(os.path.join(folder, 'runs.json'),'r') as f:
+                info = json.load(f)
+            if key not in info['variables']:
+                raise KeyError(key+' is not consolidated')
+            out = np.load(os.path.join(folder, key+'.npy'), mmap_mode='r')
+        return out, info['ids']
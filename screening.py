@@ -0,0 +1,217 @@
+import numpy as np
+from astropy import constants
+import os
+import pickle
+import pandas as pd
+from threadpoolctl import threadpool_limits
+from pathos.multiprocessing import ProcessingPool as Pool
+
+import utils
+import planets
+import neptune
+import make_spectra
+import quench_screening
+from neptune_climate import make_outfile_name
+from supervisor import SupervisedPool
+from profiling import PipelineProfiler
+
+OUTFOLDER = 'results/neptune/screening/'
+
+def default_settings():
+    settings = {}
+    settings['climate_folder'] = 'results/neptune/climate/'
+    settings['data_file'] = 'data/osfstorage-archive/lowres.pkl'
+    settings['wv_range'] = [0.8,5.3] # microns
+    settings['resample'] = make_spectra.resample_for_R(1000) # opacity resampling for tiers 1 and 2
+    settings['P_bottom'] = 500.0e6
+    settings['P_top'] = 1.0e-2 # tier 1 atmosphere extends high enough for transmission
+    settings['ct_file'] = 'input/zahnle_earth_new_ct.yaml'
+    settings['atoms'] = ['H','He','C','O','N']
+    settings['sig_max'] = 3.0 # scenarios ruled out at more than this are dropped
+    settings['n_tier2'] = 10 # at most this many go to photochemistry
+    settings['n_tier3'] = 3 # at most this many get full resolution spectra
+    settings['nprocesses'] = 4
+    settings['timeout'] = None # s, for each tier 2 model
+    return settings
+
+def scenario_name(scenario):
+    name = make_outfile_name(scenario['mh'], scenario['CtoO'], scenario['tint'])[:-4]
+    return name+'_Kzz=%.1e'%scenario['eddy']
+
+# Opacities owned by the current (worker) process
+_opas = {}
+
+def worker_opannection(wv_range, resample):
+    key = (tuple(wv_range), resample)
+    if key not in _opas:
+        opa = make_spectra.make_opannection(wave_range=wv_range, resample=resample)
+        _opas[key] = (opa, make_spectra.make_case(opa))
+    return _opas[key]
+
+def fit_spectrum(atm, clouds, data, wv_range, resample):
+    "Transmission spectrum of picaso atmosphere and cloud DataFrames and its fit to the data."
+    opa, case1 = worker_opannection(wv_range, resample)
+    case1.atmosphere(df = atm)
+    if clouds is not None:
+        case1.clouds(df = clouds)
+    wv, rprs2 = make_spectra.transmission_spectrum(case1, opa)
+    rprs2_b, rchi2, sig = make_spectra.spectrum_statistics(wv, rprs2, data, wv_range)
+    return wv, rprs2, rchi2, sig
+
+def tier1_worker(args):
+    """Quench estimate and low resolution spectrum of all scenarios that share
+    a climate model, so that chemical equilibrium is only computed once.
+    """
+    scenarios, data, settings = args
+    threadpool_limits(limits=1)
+    s = scenarios[0]
+    radius = planets.k2_18b.radius*(constants.R_earth.value)*1e2
+    mass = planets.k2_18b.mass*(constants.M_earth.value)*1e3
+
+    PTfile = settings['climate_folder']+make_outfile_name(s['mh'], s['CtoO'], s['tint'])
+    P, T = neptune.P_T_from_file(PTfile, settings['P_bottom'], settings['P_top'])
+    gas = quench_screening.worker_gas(settings['ct_file'])
+    equi, _, mubar = neptune.chemical_equilibrium_PT(P, T, settings['ct_file'], settings['atoms'], s['mh'], s['CtoO'], gas)
+    z = neptune.altitude_profile_PT(P, T, radius, mass, mubar[0])
+
+    results = []
+    for scenario in scenarios:
+        surf, P_quench = quench_screening.quench_abundances(P, T, z, equi, mubar, scenario['mh'], scenario['eddy'], radius, mass)
+        mix = quench_screening.quenched_profiles(P, equi, surf, P_quench)
+        mix['press'] = P
+        mix['temp'] = T
+        atm = utils.picaso_atmosphere(mix, list(equi.keys()))
+
+        _, _, rchi2, sig = fit_spectrum(atm, None, data, settings['wv_range'], settings['resample'])
+        out = dict(scenario)
+        out['surf'] = surf
+        out['P_quench'] = P_quench
+        out['rchi2'] = rchi2
+        out['sig'] = sig
+        results.append(out)
+    return results
+
+def run_tier2(outfile, PTfile_in, M_H_metalicity, CtoO, eddy_q):
+    "Full quench-photochem model of one scenario."
+    threadpool_limits(limits=1)
+    params = neptune.nominal_S()
+    params['outfile'] = outfile
+    params['PTfile_in'] = PTfile_in
+    params['M_H_metalicity'] = M_H_metalicity
+    params['CtoO'] = CtoO
+    params['eddy_q'] = eddy_q
+    neptune.run_quench_photochem_model(**params)
+
+def spectrum_worker(args):
+    scenario, data, settings, resample = args
+    threadpool_limits(limits=1)
+    outfile = OUTFOLDER+'tier2/'+scenario_name(scenario)
+    atm = pd.read_csv(outfile+'_picaso.pt', delim_whitespace=True)
+    clouds = pd.read_csv(outfile+'_clouds.txt', delim_whitespace=True)
+    wv, rprs2, rchi2, sig = fit_spectrum(atm, clouds, data, settings['wv_range'], resample)
+    out = dict(scenario)
+    out['rchi2'] = rchi2
+    out['sig'] = sig
+    if resample == 1:
+        out['wv'] = wv
+        out['rprs2'] = rprs2
+    return out
+
+def pool_map(fcn, args, nprocesses):
+    if nprocesses > 1 and len(args) > 1:
+        p = Pool(nprocesses)
+        out = p.map(fcn, args)
+        # reap the workers so their CPU time is charged to the tier
+        p.close()
+        p.join()
+        p.clear()
+        return out
+    return [fcn(a) for a in args]
+
+def rank(results, sig_max, n):
+    "The `n` best fitting results that the data do not rule out."
+    out = [a for a in results if np.isfinite(a['sig']) and a['sig'] < sig_max]
+    out = sorted(out, key=lambda a: a['rchi2'])
+    return out[:n]
+
+def run_screening(scenarios, settings):
+    """Tier 1: quench estimate + low resolution spectrum for every scenario.
+    Tier 2: quench-photochem model + low resolution spectrum for the best tier 1 scenarios.
+    Tier 3: full resolution spectrum for the best tier 2 scenarios.
+    Scenarios are dicts with keys 'mh', 'CtoO', 'tint' and 'eddy'. The compute
+    spent on each tier is recorded by a PipelineProfiler.
+    """
+    for folder in ['tier2/']:
+        os.makedirs(OUTFOLDER+folder, exist_ok=True)
+    with open(settings['data_file'],'rb') as f:
+        data = pickle.load(f)
+    profiler = PipelineProfiler(outfolder=OUTFOLDER+'profiling/')
+    nprocesses = settings['nprocesses']
+
+    # Tier 1. Group scenarios by climate model.
+    groups = {}
+    for scenario in scenarios:
+        key = (scenario['mh'], scenario['CtoO'], scenario['tint'])
+        groups.setdefault(key, []).append(scenario)
+    with profiler.stage('tier1'):
+        out = pool_map(tier1_worker, [(groups[key], data, settings) for key in groups], nprocesses)
+        tier1 = []
+        for a in out:
+            tier1 += a
+    profiler.stages[-1]['nscenarios'] = len(tier1)
+
+    # Tier 2
+    candidates = rank(tier1, settings['sig_max'], settings['n_tier2'])
+    with profiler.stage('tier2'):
+        inputs = []
+        for scenario in candidates:
+            inputs.append({
+                'outfile': OUTFOLDER+'tier2/'+scenario_name(scenario),
+                'PTfile_in': settings['climate_folder']+make_outfile_name(scenario['mh'], scenario['CtoO'], scenario['tint']),
+                'M_H_metalicity': scenario['mh'],
+                'CtoO': scenario['CtoO'],
+                'eddy_q': scenario['eddy']
+            })
+        p = SupervisedPool(nprocesses, timeout=settings['timeout'])
+        res = p.map(run_tier2, inputs)
+        for scenario, r in zip(inputs, res):
+            if not r['success']:
+                print('Failed: '+scenario['outfile']+'\n'+r['error'])
+        succeeded = [a for a, r in zip(candidates, res) if r['success']]
+        tier2 = pool_map(spectrum_worker, [(a, data, settings, settings['resample']) for a in succeeded], nprocesses)
+    profiler.stages[-1]['nscenarios'] = len(candidates)
+
+    # Tier 3
+    finalists = rank(tier2, settings['sig_max'], settings['n_tier3'])
+    with profiler.stage('tier3'):
+        tier3 = pool_map(spectrum_worker, [(a, data, settings, 1) for a in finalists], nprocesses)
+    profiler.stages[-1]['nscenarios'] = len(finalists)
+
+    report = profiler.save()
+    print('%-8s %10s %10s %14s'%('tier','scenarios','wall (s)','cpu/scenario'))
+    for entry in report['stages']:
+        cpu = entry['cpu_s'] + entry['cpu_children_s']
+        print('%-8s %10i %10.1f %14.1f'%(entry['stage'], entry['nscenarios'], entry['wall_s'], cpu/max(entry['nscenarios'],1)))
+
+    out = {}
+    out['settings'] = settings
+    out['tier1'] = tier1
+    out['tier2'] = tier2
+    out['tier3'] = tier3
+    out['compute'] = report['stages']
+    with open(OUTFOLDER+'screening.pkl','wb') as f:
+        pickle.dump(out, f)
+    return out
+
+def main():
+    settings = default_settings()
+    scenarios = []
+    for mh in [2.0]:
+        for CtoO in [1.0]:
+            for tint in [60.0]:
+                for eddy in np.logspace(6,10,5):
+                    scenarios.append({'mh': mh, 'CtoO': CtoO, 'tint': tint, 'eddy': eddy})
+    run_screening(scenarios, settings)
+
+if __name__ == '__main__':
+    main()
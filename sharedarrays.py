@@ -0,0 +1,99 @@
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+class SharedArrays():
+    """Publishes named, read-only numpy arrays in shared memory so that
+    worker processes can use them without copies or pickling. Only the
+    small `handle` is sent to workers, which then call `attach` or `use`.
+    The process that publishes the arrays owns them and must call `close`.
+    """
+
+    def __init__(self):
+        self.blocks = {} # name -> SharedMemory
+        self.handle = {} # name -> (shared memory name, shape, dtype)
+
+    def publish(self, name, array):
+        array = np.ascontiguousarray(array)
+        if name in self.blocks:
+            raise Exception('"'+name+'" has already been published.')
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes,1))
+        tmp = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        tmp[...] = array
+        self.blocks[name] = shm
+        self.handle[name] = (shm.name, array.shape, array.dtype.str)
+
+    def publish_dict(self, prefix, d):
+        "Publishes every array in a nested dictionary, with names like 'prefix/key/key'."
+        for key in d:
+            if isinstance(d[key], dict):
+                self.publish_dict(prefix+'/'+key, d[key])
+            else:
+                self.publish(prefix+'/'+key, d[key])
+
+    def close(self):
+        for name in self.blocks:
+            self.blocks[name].close()
+            self.blocks[name].unlink()
+        self.blocks = {}
+        self.handle = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Shared memory attached by this process, and the handle set by `use`
+_attached = {}
+_handle = None
+
+def attach(handle, name):
+    "Returns a read-only view of a published array. Views are reused within a process."
+    shm_name, shape, dtype = handle[name]
+    if shm_name not in _attached:
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name, track=False)
+        except TypeError:
+            # Python < 3.13. Keep the resource tracker from taking ownership
+            # of (and later unlinking) memory this process did not create.
+            register = resource_tracker.register
+            resource_tracker.register = lambda *args, **kwargs: None
+            try:
+                shm = shared_memory.SharedMemory(name=shm_name)
+            finally:
+                resource_tracker.register = register
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        array.flags.writeable = False
+        _attached[shm_name] = (shm, array)
+    return _attached[shm_name][1]
+
+def attach_dict(handle, prefix):
+    "Rebuilds a nested dictionary published with `publish_dict`. Returns None if it was not published."
+    out = None
+    for name in handle:
+        if not name.startswith(prefix+'/'):
+            continue
+        if out is None:
+            out = {}
+        keys = name[len(prefix)+1:].split('/')
+        d = out
+        for key in keys[:-1]:
+            d = d.setdefault(key, {})
+        d[keys[-1]] = attach(handle, name)
+    return out
+
+def use(handle):
+    "Sets the handle that `get` and `get_dict` look in for this process."
+    global _handle
+    _handle = handle
+
+def get(name):
+    "A published array, or None if this process has no handle or the array was not published."
+    if _handle is None or name not in _handle:
+        return None
+    return attach(_handle, name)
+
+def get_dict(prefix):
+    if _handle is None:
+        return None
+    return attach_dict(_handle, prefix)
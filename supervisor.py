@@ -0,0 +1,135 @@
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import traceback
+import resource
+import time
+
+def _worker_loop(conn, memory_limit):
+    if memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        fcn, kwargs = job
+        try:
+            result = fcn(**kwargs)
+            conn.send(('ok', result))
+        except BaseException:
+            conn.send(('error', traceback.format_exc()))
+
+class _Worker():
+
+    def __init__(self, ctx, memory_limit):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_loop, args=(child_conn, memory_limit), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.job = None # (index, attempt) being run
+        self.start_time = None
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.kill()
+
+class SupervisedPool():
+    """Runs jobs in supervised worker processes. A job that raises, crashes its
+    process (e.g. a segfault in Fortran), runs longer than `timeout` seconds, or
+    exceeds `memory_limit` bytes is recorded as a failure and the rest of the
+    jobs keep running. Crashed or hung workers are replaced.
+
+    After a failure, a job is tried again with each dictionary in `retries`
+    merged into its keyword arguments, in order, until one attempt succeeds.
+
+    Workers are persistent, so per-process state (e.g. a model built once
+    per worker) is kept between jobs. Workers are started with fork.
+    """
+
+    def __init__(self, nprocesses, timeout=None, memory_limit=None, retries=None):
+        self.nprocesses = nprocesses
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.retries = retries if retries is not None else []
+        self.ctx = mp.get_context('fork')
+
+    def map(self, fcn, inputs):
+        """Calls `fcn(**kwargs)` for every kwargs dictionary in `inputs`. Returns a
+        list of dictionaries with keys 'success', 'result', 'error' and 'attempts'.
+        """
+        results = [{'success': False, 'result': None, 'error': None, 'attempts': []} for a in inputs]
+        pending = [(i, 0) for i in range(len(inputs))][::-1]
+        workers = [_Worker(self.ctx, self.memory_limit) for i in range(min(self.nprocesses, len(inputs)))]
+
+        def failed(worker, error):
+            i, attempt = worker.job
+            results[i]['attempts'].append({'error': error, 'wall_time': time.time() - worker.start_time})
+            results[i]['error'] = error
+            if attempt < len(self.retries):
+                pending.append((i, attempt+1))
+            worker.job = None
+
+        try:
+            while True:
+                # Hand out jobs
+                for worker in workers:
+                    if worker.job is None and len(pending) > 0:
+                        i, attempt = pending.pop()
+                        kwargs = dict(inputs[i])
+                        if attempt > 0:
+                            kwargs.update(self.retries[attempt-1])
+                        worker.job = (i, attempt)
+                        worker.start_time = time.time()
+                        worker.conn.send((fcn, kwargs))
+
+                busy = [w for w in workers if w.job is not None]
+                if len(busy) == 0:
+                    break
+
+                wait_time = None
+                if self.timeout is not None:
+                    wait_time = max(min(w.start_time + self.timeout for w in busy) - time.time(), 0.0)
+                ready = wait([w.conn for w in busy], timeout=wait_time)
+
+                for j,worker in enumerate(workers):
+                    if worker.job is None:
+                        continue
+                    if worker.conn in ready:
+                        try:
+                            status, out = worker.conn.recv()
+                        except EOFError:
+                            worker.process.join()
+                            failed(worker, 'Worker died with exit code %s'%(worker.process.exitcode))
+                            worker.conn.close()
+                            workers[j] = _Worker(self.ctx, self.memory_limit)
+                            continue
+                        if status == 'ok':
+                            i, attempt = worker.job
+                            results[i]['attempts'].append({'error': None, 'wall_time': time.time() - worker.start_time})
+                            results[i]['success'] = True
+                            results[i]['result'] = out
+                            results[i]['error'] = None
+                            worker.job = None
+                        else:
+                            failed(worker, out)
+                    elif self.timeout is not None and time.time() - worker.start_time > self.timeout:
+                        worker.kill()
+                        failed(worker, 'Timed out after %.1f s'%(self.timeout))
+                        workers[j] = _Worker(self.ctx, self.memory_limit)
+        finally:
+            for worker in workers:
+                if worker.job is None:
+                    worker.stop()
+                else:
+                    worker.kill()
+
+        return results
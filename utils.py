@@ -1,9 +1,16 @@
 import numpy as np
 from scipy import constants as const
+from scipy import stats
 import miepython
 from photochem.clima import rebin
 import numba as nb
+import os
 import pickle
+import hashlib
+import pandas as pd
+import inputcache
+import sharedarrays
+from rate_diagnostics import RateDiagnostics
 
 @nb.cfunc(nb.double(nb.double, nb.double, nb.double))
 def custom_binary_diffusion_fcn(mu_i, mubar, T):
@@ -140,24 +147,30 @@ def equilibrium_temperature(stellar_radiation, bond_albedo):
     T_eq = ((stellar_radiation*(1.0 - bond_albedo))/(4.0*const.sigma))**(0.25)
     return T_eq 
 
-def write_picaso_atmosphere(mix, outfile, species):
-    fmt = '{:25}'
+def write_picaso_table(df, outfile, width):
+    "Writes a DataFrame as the fixed-width text tables picaso reads with delim_whitespace=True."
     with open(outfile,'w') as f:
-        f.write(fmt.format('pressure'))
-        f.write(fmt.format('temperature'))
-        for sp in species:
-            f.write(fmt.format(sp))
+        for key in df.columns:
+            f.write(('{:%i}'%width).format(key))
         f.write('\n')
-    
-        P = mix['press'][::-1]/1e6
-        T = mix['temp'][::-1]
-    
-        for i in range(P.shape[0]):
-            f.write(fmt.format('%e'%P[i]))
-            f.write(fmt.format('%e'%T[i]))
-            for j,sp in enumerate(species):
-                f.write(fmt.format('%e'%(mix[sp][P.shape[0]-i-1])))
-            f.write('\n')
+        np.savetxt(f, df.to_numpy(dtype=float), fmt='%%-%ie'%width, delimiter='')
+
+def picaso_atmosphere(mix, species):
+    """DataFrame for `case1.atmosphere(df=...)`. `mix` has 'press' (dynes/cm^2),
+    'temp' and mixing ratios, from the bottom of the atmosphere up.
+    """
+    P = mix['press'][::-1]/1e6
+    data = {}
+    data['pressure'] = P
+    data['temperature'] = mix['temp'][::-1]
+    for sp in species:
+        data[sp] = mix[sp][::-1]
+    return pd.DataFrame(data)
+
+def write_picaso_atmosphere(mix, outfile, species):
+    df = picaso_atmosphere(mix, species)
+    write_picaso_table(df, outfile, 25)
+    return df
 
 def residuals(data_y, err, expected_y):
     return (data_y - expected_y)/err
@@ -236,11 +249,164 @@ def make_haze_opacity_file_OLD(pressure, haze_column, outfile):
                 f.write(fmt.format('%e'%(out[key][i])))
             f.write('\n')
 
-def make_haze_opacity_file(pressure, cols, particle_radius, outfile):
-    # pressure in dynes/cm^2
-    # cols in particles/cm^2
-    # particle_radius in microns
-    
+def load_aerosol_optical_props():
+    "Aerosol optical properties, from shared memory if they were published there."
+    opt = sharedarrays.get_dict('aerosol_optical_props')
+    if opt is None:
+        with open('data/aerosol_optical_props.pkl','rb') as f:
+            opt = pickle.load(f)
+    return opt
+
+# Mie efficiencies on a (radius, wavelength) grid, for each aerosol
+_mie_tables = {}
+
+def mie_table(key, opt, radii=np.logspace(-3,2,300)):
+    """Mie efficiencies of aerosol `key` for all `radii` (microns) and the
+    wavelengths of `opt`, with one vectorized miepython call. Tables are kept
+    in memory and in the input cache, keyed by the optical constants and grid.
+    Returns a dict with radii, qext, qsca and g, each (radius, wavelength).
+    """
+    h = hashlib.sha256()
+    for a in [radii, opt['wv'], opt[key]['nr'], opt[key]['ni']]:
+        h.update(np.ascontiguousarray(a, dtype=float).tobytes())
+    sha = h.hexdigest()[:16]
+    if sha in _mie_tables:
+        return _mie_tables[sha]
+
+    cache_file = os.path.join(inputcache.CACHE_DIR, 'mie_'+key+'_'+sha+'.npz')
+    if os.path.isfile(cache_file):
+        with np.load(cache_file) as npz:
+            table = {a: npz[a] for a in npz.files}
+    else:
+        nr, nw = radii.shape[0], opt['wv'].shape[0]
+        x = 2 * np.pi * radii[:,None] / opt['wv'][None,:]
+        m = np.tile(opt[key]['nr'] - 1j*opt[key]['ni'], nr)
+        qext, qsca, qback, g = miepython.mie(m, x.ravel())
+        table = {'radii': radii.copy(),
+                 'qext': qext.reshape((nr, nw)),
+                 'qsca': qsca.reshape((nr, nw)),
+                 'g': g.reshape((nr, nw))}
+        os.makedirs(inputcache.CACHE_DIR, exist_ok=True)
+        tmp = cache_file+'.'+str(os.getpid())+'.tmp.npz'
+        np.savez(tmp, **table)
+        os.replace(tmp, cache_file)
+    _mie_tables[sha] = table
+    return table
+
+def _size_distributions(dist):
+    """The number and cross sectional area distributions of `dist` (see
+    `size_distribution`), as scipy.stats distributions of ln(r) for the
+    lognormal and of r for the gamma distribution. Returns (number, area, log).
+    """
+    if dist['type'] == 'lognormal':
+        lns = np.log(dist['sigma_g'])
+        mu = np.log(dist['r_g'])
+        # r^2 times a lognormal is a lognormal with the median shifted by 2 ln(sigma)^2
+        return stats.norm(mu, lns), stats.norm(mu + 2*lns**2, lns), True
+    elif dist['type'] == 'gamma':
+        a, b = dist['r_eff'], dist['v_eff']
+        # n(r) ~ r^((1-3b)/b) exp(-r/(a b)), and r^2 n(r) has shape 1/b
+        return stats.gamma((1 - 2*b)/b, scale=a*b), stats.gamma(1/b, scale=a*b), False
+    else:
+        raise ValueError('Unknown size distribution: '+str(dist['type']))
+
+def size_distribution_range(dist, tail=1.0e-8):
+    """Radii (microns) between which all but `tail` of both the number and the
+    cross sectional area of the distribution lie, and its width in ln(r).
+    """
+    number, area, log = _size_distributions(dist)
+    r = np.array([number.ppf(tail), area.ppf(tail), number.ppf(1 - tail), area.ppf(1 - tail)])
+    if log:
+        r = np.exp(r)
+        width = np.log(dist['sigma_g'])
+    else:
+        width = np.sqrt(dist['v_eff']) # standard deviation of ln(r), when v_eff is small
+    return np.min(r[:2]), np.max(r[2:]), width
+
+def size_distribution_fraction(dist, r_min, r_max):
+    "Fractions of the number and of the cross sectional area of `dist` between r_min and r_max."
+    number, area, log = _size_distributions(dist)
+    if log:
+        r_min, r_max = np.log(r_min), np.log(r_max)
+    return number.cdf(r_max) - number.cdf(r_min), area.cdf(r_max) - area.cdf(r_min)
+
+def size_distribution(radii, dist, tol=1.0e-3):
+    """Fraction of particles in each radius bin of `radii` (microns, log spaced).
+    `dist` is {'type': 'lognormal', 'r_g': .., 'sigma_g': ..} (median radius in
+    microns and geometric standard deviation) or {'type': 'gamma', 'r_eff': ..,
+    'v_eff': ..} (Hansen 1971, effective radius in microns and variance).
+    Raises a ValueError if more than `tol` of the number or the cross sectional
+    area of the distribution lies outside of `radii`.
+    """
+    inside = size_distribution_fraction(dist, radii[0], radii[-1])
+    if np.min(inside) < 1 - tol:
+        raise ValueError('Only %.3g of the number and %.3g of the area of the size distribution %s '
+                         'are within %.3g-%.3g microns.'%(inside[0], inside[1], str(dist), radii[0], radii[-1]))
+    if dist['type'] == 'lognormal':
+        lns = np.log(dist['sigma_g'])
+        dn_dlnr = np.exp(-0.5*(np.log(radii/dist['r_g'])/lns)**2)
+    else:
+        a, b = dist['r_eff'], dist['v_eff']
+        # n(r) ~ r^((1-3b)/b) exp(-r/(a b)), so dn/dlnr = r n(r)
+        log_dn = ((1 - 3*b)/b + 1)*np.log(radii) - radii/(a*b)
+        dn_dlnr = np.exp(log_dn - np.max(log_dn))
+    w = dn_dlnr*np.gradient(np.log(radii))
+    return w/np.sum(w)
+
+# Radius grid points per unit of the ln(r) width of a size distribution. The
+# ripples in the Mie efficiencies need about this many; with 8, sigma_ext of
+# narrow distributions of weakly absorbing particles is off by ~1%.
+MIE_POINTS_PER_WIDTH = 32
+
+def size_distribution_radii(table_radii, dist):
+    """Radius grid to integrate `dist` over. This is `table_radii` if the
+    distribution lies within it and is resolved by at least
+    MIE_POINTS_PER_WIDTH points per its ln(r) width, and otherwise a log-spaced grid
+    around the distribution with that resolution.
+    """
+    r_min, r_max, width = size_distribution_range(dist)
+    dlnr = width/MIE_POINTS_PER_WIDTH
+    dlnr_table = np.log(table_radii[1]/table_radii[0])
+    if r_min >= table_radii[0] and r_max <= table_radii[-1] and dlnr_table <= dlnr:
+        return table_radii
+    n = int(np.ceil(np.log(r_max/r_min)/min(dlnr, dlnr_table))) + 1
+    return np.logspace(np.log10(r_min), np.log10(r_max), n)
+
+def aerosol_optical_properties(key, opt, particle_radius):
+    """Extinction cross section per particle (cm^2), single scattering albedo
+    and asymmetry parameter at each wavelength of `opt`. `particle_radius`
+    is a radius in microns, or a size distribution (see `size_distribution`).
+    Distributions are integrated over a cached Mie table when they lie within
+    it and are resolved by it, and otherwise over a Mie table on a grid made
+    for the distribution (see `size_distribution_radii`). Tails beyond 1e-8
+    of the number and area are dropped. Compared to converged direct
+    integrations of miepython, sigma_ext is within 0.1% for lognormal and
+    gamma distributions with radii of 0.05-300 microns.
+    """
+    if not isinstance(particle_radius, dict):
+        r_cm = particle_radius*(1/1e6)*(1e2/1) # convert from um to cm
+        x = 2 * np.pi * particle_radius / opt['wv']
+        m = opt[key]['nr'] - 1j*opt[key]['ni']
+        qext, qsca, qback, g = miepython.mie(m, x)
+        return qext*np.pi*r_cm**2, qsca/qext, g
+
+    table = mie_table(key, opt)
+    radii = size_distribution_radii(table['radii'], particle_radius)
+    if radii is not table['radii']:
+        table = mie_table(key, opt, radii)
+    w = size_distribution(table['radii'], particle_radius)
+    area = w*np.pi*(table['radii']*1e-4)**2 # cm^2
+    sigma_ext = area @ table['qext']
+    sigma_sca = area @ table['qsca']
+    g = (area @ (table['qsca']*table['g']))/sigma_sca
+    return sigma_ext, sigma_sca/sigma_ext, g
+
+def haze_opacity(pressure, cols, particle_radius):
+    """DataFrame for `case1.clouds(df=...)` with the optical properties of
+    the S, HC and H2O aerosols at each pressure and wavelength.
+    pressure in dynes/cm^2, cols in particles/cm^2. particle_radius has
+    a radius in microns or a size distribution for each aerosol.
+    """
     for key in ['S','HC','H2O']:
         assert key in cols
         assert key in particle_radius
@@ -249,82 +415,60 @@ def make_haze_opacity_file(pressure, cols, particle_radius, outfile):
     assert len(cols['HC']) == len(pressure)
     assert len(cols['H2O']) == len(pressure)
 
-    # Convert
-    particle_radius_cm = {}
-    for key in particle_radius:
-        particle_radius_cm[key] = particle_radius[key]*(1/1e6)*(1e2/1) # convert from um to cm
-    
     # Load all optical data
-    with open('data/aerosol_optical_props.pkl','rb') as f:
-        opt = pickle.load(f)
+    opt = load_aerosol_optical_props()
     
     # Compute optical properties with mie theory
     mie = {}
     for key in particle_radius:
-        x = 2 * np.pi * particle_radius[key] / opt['wv']
-        m = opt[key]['nr'] - 1j*opt[key]['ni']
-        qext, qsca, qback, g = miepython.mie(m, x)
-        w0 = qsca/qext
-    
         mie[key] = {}
-        mie[key]['qext'] = qext
-        mie[key]['w0'] = w0
-        mie[key]['g'] = g
+        mie[key]['sigma'], mie[key]['w0'], mie[key]['g'] = aerosol_optical_properties(key, opt, particle_radius[key])
     
     # At each altitude and wavelength, compute the optical
-    # properties considering the particle density
-    keys = ['pressure','wavenumber','opd','w0','g0']
+    # properties considering the particle density. Arrays are (altitude, wavelength).
+    taup = 0.0
+    tausp = 0.0
+    tausp_1 = {}
+    for key in mie:
+        taup_1 = np.outer(np.asarray(cols[key]), mie[key]['sigma'])
+        taup = taup + taup_1
+        tausp_1[key] = mie[key]['w0']*taup_1
+        tausp = tausp + tausp_1[key]
+    gt = 0.0
+    for key in mie:
+        gt = gt + mie[key]['g']*tausp_1[key]/tausp
+    gt = np.minimum(gt,0.99999999)
+    w0 = np.minimum(0.9999999,tausp/taup)
+
+    nz, nw = taup.shape
     out = {}
-    for key in keys:
-        out[key] = []
-    
-    for j in range(pressure.shape[0]): # over altitude
-        for i in range(opt['wv'].shape[0]): # over wavelength
-            tausp_1 = {}
-            taup = 0.0
-            tausp = 0.0
-            for k,key in enumerate(mie):
-                taup_1 = mie[key]['qext'][i]*np.pi*particle_radius_cm[key]**2*cols[key][j]
-                taup += taup_1
-                tausp_1[key] = mie[key]['w0'][i]*taup_1
-                tausp += tausp_1[key]
-            gt = 0.0
-            for k,key in enumerate(mie):
-                gt += mie[key]['g'][i]*tausp_1[key]/(tausp)
-            gt = np.minimum(gt,0.99999999)
-            w0 = np.minimum(0.9999999,tausp/taup)
-                
-            out['pressure'].append(pressure[j]/1e6)
-            out['wavenumber'].append(1e4/opt['wv'][i])
-            out['opd'].append(taup)
-            out['w0'].append(w0)
-            out['g0'].append(gt)
-            
-    # Save the results
-    fmt = '{:20}'
-    with open(outfile,'w') as f:
-        for key in out:
-            f.write(fmt.format(key))
-        f.write('\n')
-        for i in range(len(out['pressure'])):
-            for key in out:
-                f.write(fmt.format('%e'%(out[key][i])))
-            f.write('\n')
+    out['pressure'] = np.repeat(np.asarray(pressure)/1e6, nw)
+    out['wavenumber'] = np.tile(1e4/opt['wv'], nz)
+    out['opd'] = taup.ravel()
+    out['w0'] = w0.ravel()
+    out['g0'] = gt.ravel()
+    return pd.DataFrame(out)
+
+def make_haze_opacity_file(pressure, cols, particle_radius, outfile=None):
+    "Like `haze_opacity`, and also writes the result to `outfile`, if given."
+    df = haze_opacity(pressure, cols, particle_radius)
+    if outfile is not None:
+        write_picaso_table(df, outfile, 20)
+    return df
+
+def haze_production_rate(pc, diag=None):
+    """Haze production in the current state of `pc`. Reaction rates are
+    evaluated once. Pass a rate_diagnostics.RateDiagnostics to reuse its
+    index maps when calling this often (e.g. every step).
+    """
+    if diag is None:
+        diag = RateDiagnostics(pc)
+    diag.evaluate(pc.wrk.usol)
 
-def haze_production_rate(pc):
     res = {}
-    
-    pl = pc.production_and_loss('HCaer1',pc.wrk.usol)
-    ind = pl.production_rx.index('C2H + C4H2 => HCaer1 + H')
-    res['HCaer1_prod'] = pl.integrated_production[ind]
-    
-    pl = pc.production_and_loss('HCaer2',pc.wrk.usol)
-    ind = pl.production_rx.index('H2CN + HCN => HCaer2')
-    res['HCaer2_prod'] = pl.integrated_production[ind]
-    
-    pl = pc.production_and_loss('HCaer3',pc.wrk.usol)
-    ind = pl.production_rx.index('C4H + HCCCN => HCaer3')
-    res['HCaer3_prod'] = pl.integrated_production[ind]
+    res['HCaer1_prod'] = diag.reaction_rate('C2H + C4H2 => HCaer1 + H')
+    res['HCaer2_prod'] = diag.reaction_rate('H2CN + HCN => HCaer2')
+    res['HCaer3_prod'] = diag.reaction_rate('C4H + HCCCN => HCaer3')
 
     # molecules/cm^2/s * mol/molecules * g/mol = g/cm^2/s
     haze_prod = 0.0
@@ -342,4 +486,143 @@ def gravity(radius, mass, z):
     G_grav = const.G
     grav = G_grav * (mass/1.0e3) / ((radius + z)/1.0e2)**2.0
     grav = grav*1.0e2 # convert to cgs
-    return grav # cm/s^2
\ No newline at end of file
+    return grav # cm/s^2
+
+def adaptive_log_pressure_grid(P, profiles, tols, dlog10P_max=0.5, nz_min=10, nz_max=200):
+    """Places pressure levels so that linear interpolation between levels
+    reproduces each profile to within its tolerance, and no gap exceeds
+    `dlog10P_max`. `profiles` are given on the pressure grid `P` (e.g. T,
+    log10 Kzz, log10 mixing ratios), with one tolerance each. Levels are
+    concentrated where profiles curve. Returns the new pressures.
+    """
+    x = np.log10(P)
+    # The interpolation error over an interval h is about h^2*|f''|/8, so
+    # spacing levels by equal steps of sqrt(|f''|/(8*tol))*dx keeps it below tol.
+    density = np.ones(x.shape[0])/dlog10P_max
+    for prof, tol in zip(profiles, tols):
+        d2 = np.gradient(np.gradient(prof, x), x)
+        density = np.maximum(density, np.sqrt(np.abs(d2)/(8*tol)))
+    dm = 0.5*(density[1:] + density[:-1])*np.abs(np.diff(x))
+    M = np.append(0.0, np.cumsum(dm))
+
+    nz = int(np.ceil(M[-1])) + 1
+    nz = min(max(nz, nz_min), nz_max)
+    x_new = np.interp(np.linspace(0.0, M[-1], nz), M, x)
+    return 10.0**x_new
+
+def adaptive_layer_count(z, profiles, tols, nz_min=20, nz_max=200):
+    """Smallest number of evenly spaced altitude layers that can represent
+    every profile on `z` to within its tolerance, checked by interpolating
+    to the coarse grid and back.
+    """
+    def max_error(nz):
+        z_c = np.linspace(z[0], z[-1], nz)
+        err = 0.0
+        for prof, tol in zip(profiles, tols):
+            tmp = np.interp(z, z_c, np.interp(z_c, z, prof))
+            err = max(err, np.max(np.abs(tmp - prof))/tol)
+        return err
+
+    if max_error(nz_max) > 1.0:
+        return nz_max
+    lo, hi = nz_min, nz_max
+    while lo < hi:
+        mid = (lo + hi)//2
+        if max_error(mid) <= 1.0:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def resolved_layer_count(profiles, tols, nz, nz_max=200):
+    """Number of evenly spaced layers needed, judged from profiles that are
+    already on a grid of `nz` layers. Linear interpolation between levels is
+    off by about |second difference|/8, and that error scales with the
+    square of the spacing, so the layers are increased by sqrt(error/tol).
+    """
+    err = 0.0
+    for prof, tol in zip(profiles, tols):
+        d2 = np.abs(prof[2:] - 2.0*prof[1:-1] + prof[:-2])
+        err = max(err, np.max(d2)/(8.0*tol))
+    return min(max(nz, int(np.ceil(nz*np.sqrt(err)))), nz_max)
+
+def default_rt_grid_tol():
+    "Target accuracy of compacted picaso atmospheres."
+    grid_tol = {}
+    grid_tol['T'] = 5.0 # K
+    grid_tol['log10mix'] = 0.05 # dex
+    grid_tol['min_mix'] = 1.0e-8 # less abundant species don't set the grid
+    grid_tol['dlog10P_max'] = 0.25
+    grid_tol['nz_max'] = 200
+    return grid_tol
+
+def compact_picaso_atmosphere(df, grid_tol=None, niter=10):
+    """Resamples a picaso atmosphere DataFrame onto a smaller log-P grid, with
+    levels placed by `adaptive_log_pressure_grid` from T and the log10 mixing
+    ratios of the abundant species. Mixing ratios are then adjusted so that
+    the column of every species between new levels (int f dP, which is the
+    column up to a factor g*mubar) matches the original atmosphere. Returns the
+    new DataFrame and the largest relative column error that remains.
+    """
+    if grid_tol is None:
+        grid_tol = default_rt_grid_tol()
+    df = df.sort_values('pressure').drop_duplicates('pressure')
+    P = df['pressure'].to_numpy()
+    x = np.log10(P)
+    species = [a for a in df.columns if a not in ['pressure','temperature']]
+
+    profiles = [df['temperature'].to_numpy()]
+    tols = [grid_tol['T']]
+    for sp in species:
+        if np.max(df[sp]) > grid_tol['min_mix']:
+            profiles.append(np.log10(np.maximum(df[sp].to_numpy(), 1e-40)))
+            tols.append(grid_tol['log10mix'])
+    P_new = adaptive_log_pressure_grid(P, profiles, tols, grid_tol['dlog10P_max'], nz_max=grid_tol['nz_max'])
+    P_new[0] = P[0]
+    P_new[-1] = P[-1]
+    x_new = np.log10(P_new)
+    dP = np.diff(P_new)
+
+    data = {}
+    data['pressure'] = P_new
+    data['temperature'] = np.interp(x_new, x, df['temperature'].to_numpy())
+    err = 0.0
+    for sp in species:
+        f = df[sp].to_numpy()
+        col = np.append(0.0, np.cumsum(0.5*(f[1:] + f[:-1])*np.diff(P)))
+        col = np.diff(np.interp(P_new, P, col))
+        v = 10.0**np.interp(x_new, x, np.log10(np.maximum(f, 1e-40)))
+        # Scale each level by the column mismatch of the layers around it.
+        # Layers with no column, or entirely at the 1e-40 floor, are left alone.
+        for i in range(niter):
+            ok = (col > 0.0) & (np.maximum(v[1:], v[:-1]) > 1e-40)
+            q = np.ones(col.shape[0])
+            q[ok] = col[ok]/(0.5*(v[1:][ok] + v[:-1][ok])*dP[ok])
+            s = np.empty(v.shape[0])
+            s[0] = q[0]
+            s[-1] = q[-1]
+            s[1:-1] = np.sqrt(q[:-1]*q[1:])
+            v *= s
+        inds = np.where(col > grid_tol['min_mix']*dP)[0]
+        if len(inds) > 0:
+            q = 0.5*(v[1:][inds] + v[:-1][inds])*dP[inds]/col[inds]
+            err = max(err, np.max(np.abs(q - 1.0)))
+        data[sp] = v
+
+    return pd.DataFrame(data), err
+
+def compact_picaso_input(df, grid_tol, outfile=None):
+    """Compacts a picaso atmosphere with `compact_picaso_atmosphere` and
+    reports the layer counts and column error. If `outfile` is given, they are
+    also saved to outfile+'_picaso_compaction.pkl'. The error is kept in
+    df.attrs['col_err'] of the returned DataFrame.
+    """
+    nz = df.shape[0]
+    df, err = compact_picaso_atmosphere(df, grid_tol)
+    df.attrs['col_err'] = err
+    print('Compacted picaso atmosphere: %i -> %i levels, column error %.1e'%(nz, df.shape[0], err))
+    if outfile is not None:
+        out = {'nz': nz, 'nz_compact': df.shape[0], 'col_err': err, 'grid_tol': grid_tol}
+        with open(outfile+'_picaso_compaction.pkl','wb') as f:
+            pickle.dump(out, f)
+    return df
@@ -0,0 +1,219 @@
+import os
+import sys
+import glob
+import time
+import uuid
+import pickle
+import socket
+import threading
+import importlib
+import traceback
+
+def _write_atomic(filename, obj):
+    tmp = filename+'.'+uuid.uuid4().hex+'.tmp'
+    with open(tmp,'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(tmp, filename)
+
+def _read(filename):
+    with open(filename,'rb') as f:
+        return pickle.load(f)
+
+def resolve_function(name):
+    "'module:function' -> function"
+    module, fcn = name.split(':')
+    return getattr(importlib.import_module(module), fcn)
+
+class WorkQueue():
+    """A work queue kept in a directory on a shared filesystem, so that
+    workers on any number of nodes can take part.
+
+    directory/pending/  jobs waiting to run
+    directory/leased/   jobs being run. A worker claims a job by renaming it
+                        here (atomic), then keeps touching it as a heartbeat.
+    directory/results/  one result per job
+    directory/sealed    exists once every job has been submitted
+
+    A leased job whose heartbeat is older than `lease_timeout` seconds is
+    assumed to belong to a lost worker and is put back in pending/. A job
+    that has been leased more than `max_leases` times (e.g. because it kills
+    its worker) gets a failed result instead.
+    Jobs are given as a 'module:function' name and keyword arguments, so any
+    worker that can import the module can run them, e.g.
+    'habitable:run_model_pooled' with habitable model parameters,
+    'neptune:run_quench_photochem_model' or 'neptune_climate:run_climate_model'.
+    """
+
+    def __init__(self, directory, lease_timeout=120.0, max_leases=3):
+        self.directory = directory
+        self.lease_timeout = lease_timeout
+        self.max_leases = max_leases
+        for folder in ['pending','leased','results']:
+            os.makedirs(os.path.join(directory, folder), exist_ok=True)
+
+    def _path(self, folder, job_id):
+        return os.path.join(self.directory, folder, job_id+'.pkl')
+
+    def _job_ids(self, folder):
+        return sorted(os.path.basename(a)[:-4] for a in glob.glob(os.path.join(self.directory, folder, '*.pkl')))
+
+    def submit(self, fcn, kwargs, job_id=None):
+        if job_id is None:
+            job_id = uuid.uuid4().hex
+        job = {'fcn': fcn, 'kwargs': kwargs, 'leases': 0}
+        _write_atomic(self._path('pending', job_id), job)
+        return job_id
+
+    def seal(self):
+        "Marks that all jobs have been submitted."
+        open(os.path.join(self.directory, 'sealed'),'w').close()
+
+    def is_sealed(self):
+        return os.path.isfile(os.path.join(self.directory, 'sealed'))
+
+    def claim(self):
+        "Leases the next pending job. Returns (job_id, job), or None if nothing is pending."
+        for job_id in self._job_ids('pending'):
+            try:
+                # Touch first, so the lease never carries an old mtime
+                os.utime(self._path('pending', job_id))
+                os.rename(self._path('pending', job_id), self._path('leased', job_id))
+            except FileNotFoundError:
+                continue # another worker got it first
+            try:
+                return job_id, _read(self._path('leased', job_id))
+            except FileNotFoundError:
+                continue # requeued before we could read it
+        return None
+
+    def heartbeat(self, job_id):
+        try:
+            os.utime(self._path('leased', job_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, job_id, result, leases=None):
+        """Saves the result of a job and ends its lease. `leases` is the job's
+        lease count when it was claimed. If the job has been requeued since,
+        the lease belongs to another worker and is left alone.
+        """
+        _write_atomic(self._path('results', job_id), result)
+        filename = self._path('leased', job_id)
+        try:
+            if leases is not None and _read(filename)['leases'] != leases:
+                return
+            os.remove(filename)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            pass
+
+    def requeue_expired(self):
+        "Moves jobs with stale heartbeats back to pending/. Returns their ids."
+        requeued = []
+        now = time.time()
+        for job_id in self._job_ids('leased'):
+            filename = self._path('leased', job_id)
+            try:
+                if now - os.path.getmtime(filename) < self.lease_timeout:
+                    continue
+                if os.path.isfile(self._path('results', job_id)):
+                    os.remove(filename)
+                    continue
+                job = _read(filename)
+                job['leases'] += 1
+                if job['leases'] > self.max_leases:
+                    result = {'success': False, 'result': None, 'error': 'lease limit', 'wall_time': None}
+                    _write_atomic(self._path('results', job_id), result)
+                    os.remove(filename)
+                    print('Job '+job_id+' exceeded the lease limit')
+                    continue
+                _write_atomic(filename, job)
+                os.rename(filename, self._path('pending', job_id))
+                requeued.append(job_id)
+            except FileNotFoundError:
+                continue
+        return requeued
+
+    def status(self):
+        return {folder: len(self._job_ids(folder)) for folder in ['pending','leased','results']}
+
+    def collect(self, store_file=None):
+        "Gathers all results into one dictionary, optionally saved to `store_file`."
+        results = {}
+        for job_id in self._job_ids('results'):
+            results[job_id] = _read(self._path('results', job_id))
+        if store_file is not None:
+            _write_atomic(store_file, results)
+        return results
+
+def run_job(job):
+    start = time.time()
+    try:
+        result = resolve_function(job['fcn'])(**job['kwargs'])
+        out = {'success': True, 'result': result, 'error': None}
+    except Exception:
+        out = {'success': False, 'result': None, 'error': traceback.format_exc()}
+    out['wall_time'] = time.time() - start
+    return out
+
+def run_worker(directory, heartbeat=10.0, idle_exit=None, lease_timeout=120.0):
+    """Runs jobs from the queue until it is empty for `idle_exit` seconds
+    (forever if None). A background thread renews the lease every `heartbeat` s.
+    """
+    queue = WorkQueue(directory, lease_timeout)
+    worker_id = '%s-%i'%(socket.gethostname(), os.getpid())
+    idle_since = time.time()
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            if idle_exit is not None and time.time() - idle_since > idle_exit:
+                break
+            time.sleep(min(heartbeat, 1.0))
+            continue
+
+        job_id, job = claimed
+        done = threading.Event()
+        def beat():
+            while not done.wait(heartbeat):
+                queue.heartbeat(job_id)
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+
+        out = run_job(job)
+        out['worker'] = worker_id
+        done.set()
+        thread.join()
+        queue.complete(job_id, out, job['leases'])
+        idle_since = time.time()
+
+def run_coordinator(directory, store_file, poll=5.0, lease_timeout=120.0, max_leases=3):
+    """Requeues jobs of lost workers until the queue is sealed (see
+    `WorkQueue.seal`) and every job has a result, then collects them.
+    """
+    queue = WorkQueue(directory, lease_timeout, max_leases)
+    while True:
+        requeued = queue.requeue_expired()
+        if len(requeued) > 0:
+            print('Requeued %i jobs from lost workers'%(len(requeued)))
+        status = queue.status()
+        if queue.is_sealed() and status['pending'] == 0 and status['leased'] == 0:
+            break
+        time.sleep(poll)
+    return queue.collect(store_file)
+
+def main():
+    # python workqueue.py worker <directory>
+    # python workqueue.py coordinator <directory> <store file>
+    # python workqueue.py seal <directory>
+    mode, directory = sys.argv[1], sys.argv[2]
+    if mode == 'worker':
+        run_worker(directory)
+    elif mode == 'seal':
+        WorkQueue(directory).seal()
+    elif mode == 'coordinator':
+        run_coordinator(directory, sys.argv[3])
+    else:
+        raise Exception('Unknown mode "'+mode+'"')
+
+if __name__ == '__main__':
+    main()